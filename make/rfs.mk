@@ -51,6 +51,7 @@ RFS: clean
 	$(ONL_V_at) [ -f $(RFS_DIR)/$(RFS_MANIFEST) ] && sudo cp $(RFS_DIR)/$(RFS_MANIFEST) $(LOCAL_MANIFEST)
 
 clean:
+	$(ONL_V_at) if mountpoint -q $(RFS_DIR); then sudo umount $(RFS_DIR); fi
 	$(ONL_V_at) sudo rm -rf $(RFS_WORKDIR)
 
 show-packages:
@@ -16,6 +16,7 @@ sys.path.append(pydir)
 import onl.YamlUtils
 
 from onlpm import *
+import onlu
 pm = defaultPm()
 
 class Image(object):
@@ -309,6 +310,8 @@ if __name__ == '__main__':
     ap.add_argument("--arch", choices=['powerpc', 'armel', 'armhf', 'arm64'], required=True)
     ops=ap.parse_args()
 
+    onlu.trace_process()
+
     fit = FlatImageTree(ops.desc)
     initrd=None
 
@@ -348,6 +351,15 @@ if __name__ == '__main__':
 
 
     if ops.add_platform:
+        # Require all platform packages at once.
+        pkgs = [ "onl-vendor-config-onl:all" ]
+        for plist in ops.add_platform:
+            for platform in plist:
+                if (":%s" % ops.arch) not in platform:
+                    platform = "onl-platform-config-%s:%s" % (platform, ops.arch)
+                pkgs.append(platform)
+        pm.require_all(pkgs, build_missing=True)
+
         for plist in ops.add_platform:
             for platform in plist:
                 fit.add_platform(platform)
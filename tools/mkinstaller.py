@@ -11,6 +11,7 @@ import logging
 import tempfile
 import shutil
 import subprocess
+import onlu
 
 NAME="mkinstaller"
 logging.basicConfig()
@@ -198,6 +199,9 @@ if __name__ == '__main__':
                     help="Specify a Python plugin (runs from within the installer chroot)")
 
     ops = ap.parse_args()
+
+    onlu.trace_process()
+
     installer = InstallerShar(ops.onl_version, ops.arch, ops.work_dir)
 
     if ops.arch == 'amd64':
@@ -0,0 +1,412 @@
+#!/usr/bin/python2
+############################################################
+#
+# Debian Package Archive Support
+#
+# Reads and writes .deb files in-process. A .deb is an ar(1)
+# archive containing 'debian-binary', 'control.tar.*' and
+# 'data.tar.*'.
+#
+############################################################
+import os
+import stat
+import time
+import gzip
+import tarfile
+import hashlib
+import tempfile
+import shutil
+import errno
+import subprocess
+import StringIO
+
+class OnlDebError(Exception):
+    """General Error Exception"""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return self.value
+
+
+class OnlDebArWriter(object):
+    """Minimal ar(1) archive writer (common format, as used by dpkg)."""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.handle.write("!<arch>\n")
+
+    def add(self, name, fileobj, size, mtime=None, mode=0100644):
+        if mtime is None:
+            mtime = int(time.time())
+        self.handle.write("%-16s%-12d%-6d%-6d%-8o%-10d`\n" % (name, mtime, 0, 0, mode, size))
+        shutil.copyfileobj(fileobj, self.handle)
+        if size % 2:
+            self.handle.write("\n")
+
+    def add_data(self, name, data, mtime=None):
+        self.add(name, StringIO.StringIO(data), len(data), mtime)
+
+
+class _Md5Reader(object):
+    """File wrapper which computes the md5sum of the data read through it."""
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.md5.update(data)
+        return data
+
+
+class OnlDebWriter(object):
+    """Debian Package Writer
+
+    Package contents are declared with the add_*() methods and are
+    streamed from their sources directly into the data tarball when
+    write() is called. No staging tree is created.
+
+    All paths are relative to the target filesystem root. Later
+    declarations for the same path replace earlier ones, matching
+    the behavior of copying into a staging directory."""
+
+    # Control script names accepted by add_script()
+    SCRIPTS = [ 'preinst', 'postinst', 'prerm', 'postrm' ]
+
+    def __init__(self):
+        self.entries = {}
+        self.scripts = {}
+        self.conffiles = []
+
+    @staticmethod
+    def __norm(path):
+        path = os.path.normpath('/' + path).lstrip('/')
+        return path
+
+    def __parents(self, path):
+        d = os.path.dirname(path)
+        while d and d not in self.entries:
+            self.entries[d] = ('dir', 0755, None)
+            d = os.path.dirname(d)
+
+    def add_dir(self, path, mode=0755, mtime=None):
+        path = self.__norm(path)
+        if path:
+            self.__parents(path)
+            if self.entries.get(path, ('',))[0] != 'dir' or mtime is not None:
+                self.entries[path] = ('dir', mode, mtime)
+
+    def add_file(self, src, path, mode=None):
+        path = self.__norm(path)
+        self.__parents(path)
+        self.entries[path] = ('file', src, mode)
+
+    def add_symlink(self, path, target):
+        path = self.__norm(path)
+        self.__parents(path)
+        self.entries[path] = ('link', target)
+
+    def add_data(self, path, data, mode=0644):
+        path = self.__norm(path)
+        self.__parents(path)
+        self.entries[path] = ('data', data, mode)
+
+    def add_tree(self, src, path, symlinks=False):
+        """Add a directory tree. Mirrors shutil.copytree()."""
+        st = os.stat(src)
+        self.add_dir(path, stat.S_IMODE(st.st_mode), st.st_mtime)
+        for name in sorted(os.listdir(src)):
+            s = os.path.join(src, name)
+            d = os.path.join(path, name)
+            if symlinks and os.path.islink(s):
+                self.add_symlink(d, os.readlink(s))
+            elif os.path.isdir(s):
+                self.add_tree(s, d, symlinks)
+            else:
+                self.add_file(s, d)
+
+    def add(self, src, dst, symlinks=False):
+        """Add a source file or directory with OnlPackage.copyf() semantics.
+
+        A directory source is copied to 'dst'. A file source is copied into
+        'dst' if it ends in '/', otherwise it is renamed to 'dst'."""
+        if os.path.isdir(src):
+            self.add_tree(src, dst, symlinks)
+        elif dst.endswith('/'):
+            self.add_dir(dst)
+            self.add_file(src, os.path.join(dst, os.path.basename(src)))
+        else:
+            self.add_file(src, dst)
+
+    def add_script(self, name, data):
+        if name not in self.SCRIPTS:
+            raise OnlDebError("'%s' is not a valid maintainer script." % name)
+        self.scripts[name] = data
+
+    def add_conffile(self, path):
+        self.conffiles.append('/' + self.__norm(path))
+
+    def add_default_conffiles(self):
+        """Mark every regular file under /etc as a conffile, as fpm does."""
+        for path in sorted(self.entries):
+            if path.startswith('etc/') and self.entries[path][0] in [ 'file', 'data' ]:
+                if '/' + path not in self.conffiles:
+                    self.add_conffile(path)
+
+    def installed_size(self):
+        """Installed size in KiB. Sum of non-directory sizes, as fpm does."""
+        total = 0
+        for e in self.entries.itervalues():
+            if e[0] == 'file':
+                total += os.path.getsize(e[1])
+            elif e[0] == 'data':
+                total += len(e[1])
+            elif e[0] == 'link':
+                total += len(e[1])
+        return total / 1024
+
+    def __tarinfo(self, path):
+        ti = tarfile.TarInfo('./' + path if path else './')
+        ti.uid = ti.gid = 0
+        ti.uname = ti.gname = 'root'
+        ti.mtime = int(time.time())
+        return ti
+
+    def __write_data(self, handle):
+        md5sums = []
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=handle)
+        tar = tarfile.open(fileobj=gz, mode='w', format=tarfile.GNU_FORMAT)
+
+        root = self.__tarinfo('')
+        root.type = tarfile.DIRTYPE
+        root.mode = 0755
+        tar.addfile(root)
+
+        for path in sorted(self.entries, key=lambda p: p.split('/')):
+            e = self.entries[path]
+            ti = self.__tarinfo(path)
+            if e[0] == 'dir':
+                ti.type = tarfile.DIRTYPE
+                ti.mode = e[1]
+                if e[2] is not None:
+                    ti.mtime = int(e[2])
+                tar.addfile(ti)
+            elif e[0] == 'link':
+                ti.type = tarfile.SYMTYPE
+                ti.linkname = e[1]
+                ti.mode = 0777
+                tar.addfile(ti)
+            elif e[0] == 'data':
+                ti.size = len(e[1])
+                ti.mode = e[2]
+                tar.addfile(ti, StringIO.StringIO(e[1]))
+                md5sums.append((hashlib.md5(e[1]).hexdigest(), path))
+            else:
+                src = e[1]
+                st = os.stat(src)
+                ti.size = st.st_size
+                ti.mode = e[2] if e[2] is not None else stat.S_IMODE(st.st_mode)
+                ti.mtime = int(st.st_mtime)
+                with open(src, 'rb') as f:
+                    r = _Md5Reader(f)
+                    tar.addfile(ti, r)
+                md5sums.append((r.md5.hexdigest(), path))
+
+        tar.close()
+        gz.close()
+        return md5sums
+
+    def __write_control(self, control, md5sums):
+        buf = StringIO.StringIO()
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=buf)
+        tar = tarfile.open(fileobj=gz, mode='w', format=tarfile.GNU_FORMAT)
+
+        root = self.__tarinfo('')
+        root.type = tarfile.DIRTYPE
+        root.mode = 0755
+        tar.addfile(root)
+
+        members = [ ('control', control, 0644),
+                    ('md5sums', "".join("%s  %s\n" % m for m in md5sums), 0644) ]
+        if self.conffiles:
+            members.append(('conffiles', "".join("%s\n" % c for c in self.conffiles), 0644))
+        for name in self.SCRIPTS:
+            if name in self.scripts:
+                members.append((name, self.scripts[name], 0755))
+
+        for (name, data, mode) in members:
+            ti = self.__tarinfo(name)
+            ti.size = len(data)
+            ti.mode = mode
+            tar.addfile(ti, StringIO.StringIO(data))
+
+        tar.close()
+        gz.close()
+        return buf.getvalue()
+
+    def write(self, fname, control):
+        """Write the package to 'fname'.
+
+        control : The contents of the control file."""
+
+        d = os.path.dirname(os.path.abspath(fname))
+        with tempfile.TemporaryFile(dir=d) as data:
+            md5sums = self.__write_data(data)
+            size = data.tell()
+            data.seek(0)
+
+            with tempfile.NamedTemporaryFile(dir=d, delete=False) as out:
+                try:
+                    ar = OnlDebArWriter(out)
+                    ar.add_data('debian-binary', "2.0\n")
+                    ar.add_data('control.tar.gz', self.__write_control(control, md5sums))
+                    ar.add('data.tar.gz', data, size)
+                except:
+                    os.unlink(out.name)
+                    raise
+
+        os.chmod(out.name, 0644)
+        os.rename(out.name, fname)
+        return fname
+
+
+class _ArMemberFile(object):
+    """Read-only view of a single ar member."""
+    def __init__(self, f, offset, size):
+        self.f = f
+        self.f.seek(offset)
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class OnlDebReader(object):
+    """Debian Package Reader
+
+    The data tarball is streamed, so only the members being extracted
+    are ever written to disk."""
+
+    def __init__(self, path):
+        self.path = path
+        self.members = {}
+        with open(path, 'rb') as f:
+            if f.read(8) != "!<arch>\n":
+                raise OnlDebError("%s is not a debian package." % path)
+            while True:
+                header = f.read(60)
+                if len(header) < 60:
+                    break
+                name = header[0:16].strip().rstrip('/')
+                size = int(header[48:58])
+                self.members[name] = (f.tell(), size)
+                f.seek(size + (size % 2), os.SEEK_CUR)
+
+        data = [ m for m in self.members if m.startswith('data.tar') ]
+        if len(data) != 1:
+            raise OnlDebError("%s does not contain a data archive." % path)
+        self.data = data[0]
+
+    def __open_data(self, f):
+        """Return a (tarfile, process) tuple streaming the data tarball."""
+        (offset, size) = self.members[self.data]
+        if self.data.endswith('.xz'):
+            # Python 2 has no lzma support.
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.lseek(fd, offset, os.SEEK_SET)
+                p = subprocess.Popen(['xz', '-dc', '--single-stream'], stdin=fd, stdout=subprocess.PIPE)
+            finally:
+                os.close(fd)
+            return (tarfile.open(fileobj=p.stdout, mode='r|'), p)
+        return (tarfile.open(fileobj=_ArMemberFile(f, offset, size), mode='r|*'), None)
+
+    @staticmethod
+    def __name(member):
+        name = os.path.normpath('/' + member.name).lstrip('/')
+        if name == '.':
+            return ''
+        return name
+
+    @staticmethod
+    def __current(dst, member):
+        try:
+            st = os.lstat(dst)
+        except OSError:
+            return False
+        return (stat.S_ISREG(st.st_mode) and st.st_size == member.size and
+                int(st.st_mtime) == member.mtime and stat.S_IMODE(st.st_mode) == member.mode)
+
+    def extract(self, dstdir, select=None, stop=False):
+        """Extract the package contents into 'dstdir'.
+
+        select : Optional callable. Only members whose normalized name
+                 it returns True for are extracted.
+        stop   : Stop reading once a member has been extracted.
+
+        Regular files which already exist with the same size, mtime and
+        mode are not rewritten.
+
+        Returns the list of (name, type, size, mtime) tuples for every
+        member read."""
+
+        listing = []
+        with open(self.path, 'rb') as f:
+            (tar, p) = self.__open_data(f)
+            try:
+                for member in tar:
+                    name = self.__name(member)
+                    if not name:
+                        continue
+                    listing.append((name, member.type, member.size, member.mtime))
+
+                    if select and not select(name):
+                        continue
+
+                    dst = os.path.join(dstdir, name)
+                    parent = os.path.dirname(dst)
+                    if not os.path.isdir(parent):
+                        os.makedirs(parent)
+
+                    if member.isdir():
+                        if not os.path.isdir(dst):
+                            os.makedirs(dst)
+                        os.chmod(dst, member.mode | 0700)
+                        continue
+
+                    if member.isfile() and self.__current(dst, member):
+                        continue
+
+                    if os.path.lexists(dst) and (os.path.islink(dst) or not os.path.isdir(dst)):
+                        os.unlink(dst)
+
+                    if member.issym():
+                        os.symlink(member.linkname, dst)
+                    elif member.islnk():
+                        target = os.path.join(dstdir, os.path.normpath('/' + member.linkname).lstrip('/'))
+                        if os.path.exists(target):
+                            os.link(target, dst)
+                    elif member.isfile():
+                        src = tar.extractfile(member)
+                        with open(dst, 'wb') as out:
+                            shutil.copyfileobj(src, out)
+                        os.chmod(dst, member.mode)
+                        os.utime(dst, (member.mtime, member.mtime))
+                    else:
+                        # Device nodes and fifos cannot be created unprivileged.
+                        continue
+
+                    if stop:
+                        break
+            finally:
+                tar.close()
+                if p:
+                    p.stdout.close()
+                    p.wait()
+
+        return listing
@@ -4,26 +4,44 @@
 # ONL Package Management
 #
 ############################################################
-import argparse
 import os
 import sys
+
+if __name__ == '__main__' and os.environ.get('ONLPM_OPTION_SERVER') and '--serve' not in sys.argv:
+    # Let a running 'onlpm.py --serve' answer, if there is one.
+    import onlpmd
+    onlpmd.forward(os.environ['ONLPM_OPTION_SERVER'], sys.argv[1:])
+
+import argparse
 import logging
-import yaml
 import tempfile
 import shutil
 import pprint
 import subprocess
 import glob
-import submodules
-import onlyaml
 import onlu
 from string import Template
 import re
 import json
-import lsb_release
+import time
+import StringIO
 import cPickle as pickle
-
-g_dist_codename = lsb_release.get_distro_information().get('CODENAME')
+import threading
+import Queue
+import hashlib
+import errno
+
+# Not needed by repository queries.
+yaml = onlu.LazyModule('yaml')
+submodules = onlu.LazyModule('submodules')
+onlyaml = onlu.LazyModule('onlyaml')
+onldeb = onlu.LazyModule('onldeb')
+gzip = onlu.LazyModule('gzip')
+tarfile = onlu.LazyModule('tarfile')
+lsb_release = onlu.LazyModule('lsb_release')
+
+# setup.env exports the suite; asking lsb_release can be slow.
+g_dist_codename = os.environ.get('ONL_DEBIAN_SUITE') or lsb_release.get_distro_information().get('CODENAME')
 
 logger = onlu.init_logging('onlpm', logging.INFO)
 
@@ -64,9 +82,13 @@ class OnlPackageServiceScript(object):
             raise AttributeError("The SCRIPT attribute must be provided by the deriving class.")
 
         with tempfile.NamedTemporaryFile(dir=dir, delete=False) as f:
-            f.write(self.SCRIPT % dict(service=os.path.basename(service.replace(".init", ""))))
+            f.write(self.text(service))
             self.name = f.name
 
+    @classmethod
+    def text(klass, service):
+        return klass.SCRIPT % dict(service=os.path.basename(service.replace(".init", "")))
+
 
 class OnlPackageAfterInstallScript(OnlPackageServiceScript):
     SCRIPT = """#!/bin/sh
@@ -143,42 +165,82 @@ class OnlPackage(object):
         'DISTS' : g_dist_codename,
         }
 
+    # Resolved package defaults, by directory. See package_defaults_dir().
+    DEFAULTS_CACHE = {}
+
+    @staticmethod
+    def __defaults_stamp(searchdir, files):
+        try:
+            return [ os.stat(f).st_mtime for f in [ searchdir ] + files if isinstance(f, basestring) ]
+        except OSError:
+            return None
+
     @classmethod
-    def package_defaults_get(klass, pkg):
-        # Default key value dictionary
-        ddict = klass.DEFAULTS.copy()
+    def package_defaults_dir(klass, searchdir):
+        """Get the merged default package keys for a directory.
+
+        Returns (ddict, deps). Each directory is resolved at most once
+        and revalidated against the mtimes of the directory and of the
+        defaults files (and their includes) found there."""
+
+        if searchdir in [ '/', '' ]:
+            return (klass.DEFAULTS, [])
+
+        (pdict, pdeps) = klass.package_defaults_dir(os.path.dirname(searchdir))
+
+        entry = klass.DEFAULTS_CACHE.get(searchdir)
+        if (entry is not None and entry['parent'] is pdict and
+            entry['stamp'] == klass.__defaults_stamp(searchdir, entry['files'])):
+            return (entry['ddict'], entry['deps'])
 
         #
-        # Walk up the directory heirarchy looking for either:
+        # Look in this directory for either:
         #
         # [.]PKG_DEFAULTS.yml -- an onlyaml file containing default package keys.
         # [.]PKG_DEFAULTS -- An executable producing yaml containing default package keys.
         #
-        # All matches are evaluated and applied in reverse order such that
-        # keys deeper in the directory heirarchy override shallower keys.
+        # Keys deeper in the directory heirarchy override shallower keys.
         #
-        try:
-            searchdir = os.path.dirname(pkg)
-            results = []
-            while searchdir != '/':
-                for prefix in [ '', '.']:
-                    f = os.path.join(searchdir, "%sPKG_DEFAULTS.yml" % prefix)
-                    if os.path.exists(f):
-                        results.append(onlyaml.loadf(f))
-                    f = os.path.join(searchdir, "%sPKG_DEFAULTS" % prefix)
-                    if os.path.exists(f) and os.access(f, os.X_OK):
-                        results.append(yaml.load(subprocess.check_output(f, shell=True)))
-                searchdir = os.path.dirname(searchdir)
-
+        results = []
+        files = []
+        for prefix in [ '', '.']:
+            f = os.path.join(searchdir, "%sPKG_DEFAULTS.yml" % prefix)
+            if os.path.exists(f):
+                results.append(onlyaml.loadf(f, deps=files))
+            f = os.path.join(searchdir, "%sPKG_DEFAULTS" % prefix)
+            if os.path.exists(f) and os.access(f, os.X_OK):
+                output = subprocess.check_output(f, shell=True)
+                results.append(yaml.load(output))
+                files.append(os.path.abspath(f))
+                files.append((os.getcwd(), f, hashlib.sha1(output).hexdigest()))
+
+        if files:
+            ddict = pdict.copy()
             for d in reversed(results):
                 if d:
                     ddict.update(d)
+        else:
+            ddict = pdict
+
+        entry = dict(parent=pdict, ddict=ddict, files=files,
+                     deps=files + pdeps,
+                     stamp=klass.__defaults_stamp(searchdir, files))
+        klass.DEFAULTS_CACHE[searchdir] = entry
+        return (entry['ddict'], entry['deps'])
+
+    @classmethod
+    def package_defaults_get(klass, pkg, deps=None):
+        try:
+            (ddict, files) = klass.package_defaults_dir(os.path.dirname(os.path.abspath(pkg)))
+            if deps is not None:
+                deps.extend(files)
         except Exception, e:
             sys.stderr.write("%s\n" % e)
             sys.stderr.write("package file: %s\n" % pkg)
             raise
 
-        return ddict
+        # Default key value dictionary
+        return ddict.copy()
 
     ############################################################
     #
@@ -285,13 +347,17 @@ class OnlPackage(object):
         return True
 
 
+    def file_tuples(self, key, required=True):
+        """Return the resolved (src, dst) file tuples for the given key."""
+        return onlu.validate_src_dst_file_tuples(self.dir,
+                                                 self.pkg[key],
+                                                 dict(PKG=self.pkg['name'], PKG_INSTALL='/usr/share/onl/packages/%s/%s' % (self.pkg['arch'], self.pkg['name'])),
+                                                 OnlPackageError,
+                                                 required=required)
+
     def _validate_files(self, key, required=True):
         """Validate the existence of the required input files for the current package."""
-        self.pkg[key] = onlu.validate_src_dst_file_tuples(self.dir,
-                                                          self.pkg[key],
-                                                          dict(PKG=self.pkg['name'], PKG_INSTALL='/usr/share/onl/packages/%s/%s' % (self.pkg['arch'], self.pkg['name'])),
-                                                          OnlPackageError,
-                                                          required=required)
+        self.pkg[key] = self.file_tuples(key, required)
     def _validate(self):
         """Validate the package contents."""
 
@@ -384,6 +450,155 @@ class OnlPackage(object):
         if dir_ is None:
             dir_ = self.dir
 
+        if self.fpm_required():
+            with onlu.Profiler() as profiler:
+                path = self.build_fpm(dir_)
+            profiler.record('fpm', package=self.id())
+            return path
+
+        with onlu.Profiler() as profiler:
+            path = self.build_deb(dir_)
+        profiler.log("deb %(name)s" % self.pkg)
+        profiler.record('deb', package=self.id())
+        return path
+
+    # Package keys which are only supported by the fpm builder.
+    FPM_KEYS = [ 'after-upgrade', 'before-upgrade', 'deb-systemd', 'asr' ]
+
+    def fpm_required(self):
+        """Whether this package must be built with fpm rather than in-process."""
+        if os.environ.get('ONLPM_OPTION_FPM', False):
+            return True
+        for k in self.FPM_KEYS:
+            if self.pkg.get(k, False):
+                return True
+        return False
+
+    @staticmethod
+    def fix_dependency(dep):
+        """Normalize a dependency the way fpm does."""
+        if not re.search(r'[\(,\|]', dep):
+            fields = dep.split()
+            if len(fields) == 3:
+                (name, op, version) = fields
+                op = { '>' : '>>', '<' : '<<', '==' : '=' }.get(op, op)
+                dep = "%s (%s %s)" % (name, op, version)
+        m = re.match(r'^[^ \(]+', dep)
+        if m:
+            dep = m.group(0).lower() + dep[m.end():]
+        return dep.replace('_', '-').rstrip()
+
+    def control(self, installed_size):
+        """Generate the debian control file. Field layout matches fpm."""
+        fields = [
+            ('Package', self.pkg['name']),
+            ('Version', self.pkg['version']),
+            ('License', self.pkg.get('license', None)),
+            ('Vendor', self.pkg.get('vendor', None) or None),
+            ('Architecture', self.pkg['arch']),
+            ('Maintainer', self.pkg['maintainer']),
+            ('Installed-Size', str(installed_size)),
+            ]
+
+        depends = [ self.fix_dependency(d) for d in self.pkg.get('depends', []) ]
+        provides = list(onlu.sflatten(self.pkg.get('provides', [])))
+        conflicts = list(onlu.sflatten(self.pkg.get('conflicts', [])))
+        replaces = list(onlu.sflatten(self.pkg.get('replaces', [])))
+        if 'virtual' in self.pkg:
+            for l in [ provides, conflicts, replaces ]:
+                l.append(self.pkg['virtual'])
+
+        if depends:
+            fields.append(('Depends', ", ".join(depends)))
+        if conflicts:
+            fields.append(('Conflicts', ", ".join(conflicts)))
+        if provides:
+            fields.append(('Provides', ", ".join([ p.split(" ")[0] for p in provides ])))
+        if replaces:
+            fields.append(('Replaces', ", ".join(replaces)))
+
+        fields.append(('Section', 'default'))
+        fields.append(('Priority', self.pkg.get('priority', 'extra')))
+        if self.pkg.get('build-depends', None):
+            fields.append(('Build-Depends', ", ".join(self.pkg['build-depends'])))
+        fields.append(('Homepage', self.pkg.get('url', None) or "http://nourlgiven.example.com/"))
+
+        lines = [ "%s: %s" % (k, v) for (k, v) in fields if v is not None ]
+
+        description = self.pkg['description'].split("\n")
+        # Trailing empty lines are dropped (Ruby String#split semantics).
+        while len(description) > 1 and description[-1] == "":
+            description.pop()
+        lines.append("Description: %s" % description[0])
+        for l in description[1:]:
+            lines.append(" ." if l.strip() == "" else " %s" % l)
+
+        return "\n".join(lines) + "\n"
+
+    def build_deb(self, dir_):
+        """Build the debian package in-process.
+
+        Package contents are streamed from their sources into the package
+        file. Control fields are identical to those produced by build_fpm()."""
+
+        deb = onldeb.OnlDebWriter()
+
+        for (src,dst) in self.pkg.get('files', {}):
+            deb.add(src, dst, symlinks=self.pkg.get('symlinks', False))
+
+        for (src,dst) in self.pkg.get('optional-files', {}):
+            if os.path.exists(src):
+                deb.add(src, dst)
+
+        for (link, src) in self.pkg.get('links', {}).iteritems():
+            logger.info("Linking %s -> %s..." % (link, src))
+            deb.add_symlink(link, src)
+
+        docpath = "usr/share/doc/%(name)s" % self.pkg
+        deb.add_dir(docpath)
+
+        for src in self.pkg.get('docs', []):
+            if not os.path.exists(src):
+                raise OnlPackageError("Documentation source file '%s' does not exist." % src)
+
+        # Generated changelog, as fpm does.
+        changelog = StringIO.StringIO()
+        with gzip.GzipFile(filename='', mode='wb', fileobj=changelog) as gz:
+            gz.write("%s (%s) whatever; urgency=medium\n\n  * Package created with FPM.\n\n -- %s  %s\n" % (
+                    self.pkg['name'], self.pkg['version'], self.pkg['maintainer'],
+                    time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime())))
+        deb.add_data(os.path.join(docpath, 'changelog.Debian.gz'), changelog.getvalue())
+
+        if 'init' in self.pkg:
+            if not os.path.exists(self.pkg['init']):
+                raise OnlPackageError("Init script '%s' does not exist." % self.pkg['init'])
+            deb.add_file(self.pkg['init'],
+                         "/etc/init.d/%s" % os.path.basename(self.pkg['init']).replace(".init", ""),
+                         mode=0755)
+            if self.pkg.get('init-after-install', True):
+                deb.add_script('postinst', OnlPackageAfterInstallScript.text(self.pkg['init']))
+            if self.pkg.get('init-before-remove', True):
+                deb.add_script('prerm', OnlPackageBeforeRemoveScript.text(self.pkg['init']))
+            if self.pkg.get('init-after-remove', True):
+                deb.add_script('postrm', OnlPackageAfterRemoveScript.text(self.pkg['init']))
+
+        scripts = { 'before-install' : 'preinst', 'after-install' : 'postinst',
+                    'before-remove' : 'prerm', 'after-remove' : 'postrm' }
+        for (cmd, script) in scripts.iteritems():
+            if cmd in self.pkg:
+                if not os.path.exists(self.pkg[cmd]):
+                    raise OnlPackageError("%s script '%s' does not exist." % (cmd, self.pkg[cmd]))
+                deb.add_script(script, open(self.pkg[cmd]).read())
+
+        deb.add_default_conffiles()
+
+        path = os.path.join(dir_, "%(name)s_%(version)s_%(arch)s.deb" % self.pkg)
+        deb.write(path, self.control(deb.installed_size()))
+        return path
+
+    def build_fpm(self, dir_):
+        """Build the debian package using fpm."""
+
         workdir = tempfile.mkdtemp()
         root = os.path.join(workdir, "root");
         os.mkdir(root);
@@ -581,9 +796,12 @@ class OnlPackageGroup(object):
         if not os.path.exists(pkg):
             raise OnlPackageError("Package file '%s' does not exist." % pkg)
 
-        ddict = OnlPackage.package_defaults_get(pkg)
+        # All files contributing to this package group.
+        deps = []
 
-        pkg_data = onlyaml.loadf(pkg, ddict)
+        ddict = OnlPackage.package_defaults_get(pkg, deps)
+
+        pkg_data = onlyaml.loadf(pkg, ddict, deps)
 
         pkglist = []
 
@@ -611,14 +829,53 @@ class OnlPackageGroup(object):
         self._pkgs['__source'] = os.path.abspath(pkg)
         self._pkgs['__directory'] = os.path.dirname(self._pkgs['__source'])
         self._pkgs['__mtime'] = os.path.getmtime(pkg)
+        self._pkgs['__inputs'] = dict((f, onlu.file_fingerprint(f))
+                                      for f in set(deps) if isinstance(f, basestring))
+        # Script outputs, by (cwd, command line)
+        self._pkgs['__scripts'] = dict(((d[0], d[1]), d[2])
+                                       for d in deps if not isinstance(d, basestring))
 
     def reload(self):
-        """Reload our package file if it has changed."""
-
-        if ( (self._pkgs['__mtime'] != os.path.getmtime(self._pkgs['__source']))  or
-             (self._pkgs.get('reload', False)) ):
+        """Reload our package file if it or any of its inputs have changed.
+
+        Input files are hashed only when their mtime or size changed.
+        The outputs of the scripts used by the group are then compared,
+        reusing the cached script results while they are valid. Groups
+        which set 'reload' always rerun their scripts, and are always
+        reloaded if they have none.
+
+        Returns True if the group was modified and should be written back
+        to the package cache."""
+
+        inputs = self._pkgs.get('__inputs', {})
+        scripts = self._pkgs.get('__scripts', {})
+        rerun = self._pkgs.get('reload', False)
+        refreshed = {}
+        stale = not inputs or (rerun and not scripts)
+        for (f, fp) in inputs.iteritems():
+            if stale:
+                break
+            refreshed[f] = onlu.fingerprint_refresh(f, fp)
+            if refreshed[f] is None:
+                stale = True
+        for ((cwd, directive), digest) in scripts.iteritems():
+            if stale:
+                break
+            if onlyaml.script_digest(directive, cwd, cached=not rerun) != digest:
+                logger.debug("The output of '%s' has changed." % directive)
+                stale = True
+
+        if stale:
             logger.debug("Reloading updated package file %s..." % self._pkgs['__source'])
             self.load(self._pkgs['__source'])
+            return True
+
+        if refreshed != inputs:
+            # Touched but identical inputs. Record the new timestamps.
+            self._pkgs['__inputs'] = refreshed
+            return True
+
+        return False
 
 
     def __str__(self):
@@ -661,15 +918,165 @@ class OnlPackageGroup(object):
                 MAKE = os.environ.get('MAKE', "make")
                 V = " V=1 " if logger.level < logging.INFO else ""
                 cmd = MAKE + V + ' -C ' + bp + " " + os.environ.get('ONLPM_MAKE_OPTIONS', "") + " " + os.environ.get('ONL_MAKE_PARALLEL', "") + " " + target
-                onlu.execute(cmd,
-                             ex=OnlPackageError('%s failed.' % operation))
+                with onlu.Profiler() as profiler:
+                    onlu.execute(cmd,
+                                 ex=OnlPackageError('%s failed.' % operation))
+                profiler.record('make', group=self._pkgs['__source'], target=target)
 
-    def build(self, dir_=None):
+    # Source hashes of shared inputs, by path.
+    __source_digests = {}
+
+    @classmethod
+    def __source_hash(klass, path, h):
+        """Hash the source files under the given path.
+
+        Inside a git work tree only tracked and unignored files are
+        considered, so build products do not perturb the result.
+        Inputs shared between groups are only hashed once."""
+        if path not in klass.__source_digests:
+            s = hashlib.sha1()
+            if os.path.isdir(path):
+                try:
+                    names = subprocess.check_output(['git', 'ls-files', '-z', '--cached', '--others',
+                                                     '--exclude-standard', '.'],
+                                                    cwd=path, stderr=open(os.devnull, 'w')).split('\0')
+                except (subprocess.CalledProcessError, OSError):
+                    names = None
+                    onlu.path_hash(path, s)
+                for name in sorted(set(names or [])):
+                    f = os.path.join(path, name)
+                    if name and (os.path.islink(f) or os.path.isfile(f)):
+                        s.update(name + "\0")
+                        onlu.path_hash(f, s)
+            elif os.path.exists(path):
+                onlu.path_hash(path, s)
+            klass.__source_digests[path] = s.hexdigest()
+        h.update(klass.__source_digests[path])
+
+    @staticmethod
+    def __ignored(paths, cwd):
+        """Return the subset of paths ignored by git (i.e. build products)."""
+        if not paths:
+            return set()
+        try:
+            p = subprocess.Popen(['git', 'check-ignore', '-z', '--stdin'], cwd=cwd,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 stderr=open(os.devnull, 'w'))
+        except OSError:
+            return set()
+        (out, _) = p.communicate("\0".join(paths) + "\0")
+        return set(out.split('\0')) - set([ '' ])
+
+    __submodules = None
+
+    @classmethod
+    def __submodule_status(klass):
+        """The checked out commits of all submodules (cached)."""
+        if klass.__submodules is None:
+            try:
+                klass.__submodules = subprocess.check_output(['git', 'submodule', 'status'],
+                                                             cwd=os.environ.get('ONL', '.'),
+                                                             stderr=open(os.devnull, 'w'))
+            except (subprocess.CalledProcessError, OSError):
+                klass.__submodules = ''
+        return klass.__submodules
+
+    def artifact_key(self, prerequisites):
+        """Compute the content address of this group's build products.
+
+        prerequisites : A list of (package, digest) tuples identifying the
+                        repository contents of each prerequisite package.
+
+        The key covers the package specifications after defaults, the
+        contents of the 'files' and 'optional-files' sources which are
+        not build products, the sources in the builds/ tree, any
+        additional paths listed in 'artifact-inputs', the prerequisite
+        packages, $ONL/make and the submodule commits.
+
+        The inputs of a build step (or of generated files) outside the
+        group directory cannot be known, so groups with a builds/ tree
+        or generated files are only cached if they list their other
+        inputs in 'artifact-inputs' (which may be empty). Paths there
+        are relative to the group directory, or absolute, and may
+        contain wildcards.
+
+        Returns None if the group must not be cached."""
+
+        if not self._pkgs.get('artifact-cache', True) or 'release' in self._pkgs:
+            return None
+
+        for p in self.packages:
+            if 'external' in p.pkg:
+                return None
+
+        directory = self._pkgs['__directory']
+        builds = [ os.path.join(directory, b) for b in [ 'builds', 'BUILDS' ] ]
+
+        sources = []
+        for p in self.packages:
+            for key in [ 'files', 'optional-files' ]:
+                if key in p.pkg:
+                    sources += [ src for (src, dst) in p.file_tuples(key, required=False) ]
+
+        generated = self.__ignored([ src for src in sources if os.path.exists(src) ], directory)
+        generated |= set([ src for src in sources
+                           if not os.path.exists(src) or
+                           any(src.startswith(b + os.sep) for b in builds) ])
+
+        if 'artifact-inputs' not in self._pkgs and (generated or any(os.path.isdir(b) for b in builds)):
+            logger.debug("%s has a build step but no artifact-inputs and will not be cached." % self._pkgs['__source'])
+            return None
+
+        # Keys must be identical between work trees at different locations.
+        onl = os.environ.get('ONL', None)
+        def relocate(s):
+            return s.replace(onl, '$ONL') if onl else s
+
+        def serialize(d):
+            return relocate(json.dumps(dict((k, v) for (k, v) in d.iteritems() if not k.startswith('__')),
+                                       sort_keys=True, default=str))
+
+        h = hashlib.sha1()
+        h.update(serialize(self._pkgs))
+
+        for p in self.packages:
+            h.update(serialize(p.pkg))
+            for key in [ 'files', 'optional-files' ]:
+                if key in p.pkg:
+                    for (src, dst) in p.file_tuples(key, required=False):
+                        h.update(relocate("%s\0%s\0" % (src, dst)))
+                        if src not in generated:
+                            onlu.path_hash(src, h)
+
+        inputs = list(builds)
+        for i in onlu.sflatten(self._pkgs.get('artifact-inputs', [])):
+            i = os.path.join(directory, i)
+            inputs += sorted(glob.glob(i)) or [ i ]
+        if os.environ.get('ONL', None):
+            inputs.append(os.path.join(os.environ['ONL'], 'make'))
+        for path in inputs:
+            h.update(relocate(path) + "\0")
+            self.__source_hash(path, h)
+
+        h.update(self.__submodule_status())
+
+        for (pr, digest) in sorted(prerequisites):
+            h.update("%s\0%s\0" % (pr, digest))
+
+        return h.hexdigest()
+
+    def build(self, dir_=None, artifacts=None, prerequisites=None):
         """Build all packages in the current group.
 
         dir_ : The output directory for the package group.
                The default is the package group parent directory.
 
+        artifacts : An optional OnlPackageArtifactCache. If the group's
+                    artifact key is found there the cached package files
+                    are returned and no build is performed.
+
+        prerequisites : The (package, digest) list passed to artifact_key().
+
         The option to build individual packages is not provided.
         The assumption is that the packages defined in the group are
         related and should always be built together.
@@ -684,13 +1091,33 @@ class OnlPackageGroup(object):
         the build steps.
         """
 
+        with onlu.Profiler() as profiler:
+            (products, cached) = self.__build(dir_, artifacts, prerequisites)
+        profiler.record('build', group=self._pkgs['__source'],
+                        packages=[ p.id() for p in self.packages ], cached=cached)
+        return products
+
+    def __build(self, dir_, artifacts, prerequisites):
         products = []
 
         with onlu.Lock(os.path.join(self._pkgs['__directory'], '.lock')):
+            key = None
+            if artifacts:
+                key = self.artifact_key(prerequisites or [])
+
+            if key:
+                cached = artifacts.get(key)
+                if cached:
+                    logger.info("Using cached artifacts %s for %s" % (key, self._pkgs['__source']))
+                    return (cached, True)
+
             self.gmake_locked("", 'Build')
             for p in self.packages:
                 products.append(p.build(dir_=dir_))
 
+            if key:
+                artifacts.put(key, products)
+
 
         if 'release' in self._pkgs:
             for (src, dst) in onlu.validate_src_dst_file_tuples(self._pkgs['__directory'],
@@ -702,12 +1129,73 @@ class OnlPackageGroup(object):
                                     g_dist_codename)
                 OnlPackage.copyf(src, dst, root)
 
-        return products
+        return (products, False)
 
     def clean(self, dir_=None):
         with onlu.Lock(os.path.join(self._pkgs['__directory'], '.lock')):
             self.gmake_locked("clean", 'Clean')
 
+class OnlPackageArtifactCache(object):
+    """Content-addressed Package Artifact Store
+
+    The package files produced by a package group are stored under the
+    group's artifact key (see OnlPackageGroup.artifact_key). A store is a
+    plain directory tree and can be shared between work trees and builders.
+
+    root   : The local, writable store. May be None.
+    shared : Additional read-only stores (e.g. on NFS) which are searched
+             after the local store.
+    lookup : If False, the store is write-only. Used for forced builds."""
+
+    def __init__(self, root=None, shared=None, lookup=True):
+        self.root = root
+        self.shared = shared or []
+        self.lookup = lookup
+
+    def __nonzero__(self):
+        return bool(self.root or self.shared)
+
+    @staticmethod
+    def __path(base, key):
+        return os.path.join(base, key[:2], key)
+
+    def get(self, key):
+        """Return the list of cached package files for the given key, or None."""
+        if not self.lookup:
+            return None
+        for base in ([ self.root ] if self.root else []) + self.shared:
+            products = sorted(glob.glob(os.path.join(self.__path(base, key), '*.deb')))
+            if products:
+                return products
+        return None
+
+    def put(self, key, products):
+        """Store the given package files under the given key."""
+        if not self.root:
+            return
+        dst = self.__path(self.root, key)
+        if os.path.exists(dst):
+            return
+        parent = os.path.dirname(dst)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        # Populate a private directory and rename it into place so concurrent
+        # readers only ever see complete entries.
+        tmp = tempfile.mkdtemp(dir=parent)
+        try:
+            for p in products:
+                shutil.copy(p, tmp)
+            os.chmod(tmp, 0755)
+            os.rename(tmp, dst)
+            logger.debug("Stored artifacts %s" % key)
+        except OSError:
+            if os.path.exists(dst):
+                # Lost the race with another builder.
+                shutil.rmtree(tmp)
+            else:
+                raise
+
+
 class OnlPackageRepoUnlocked(object):
     """Package Repository and Interchange Class
 
@@ -736,6 +1224,75 @@ class OnlPackageRepoUnlocked(object):
         # The extract cache goes here
         self.extracts = os.path.join(root, 'extracts')
 
+        # In-memory copies of the per-arch package indexes.
+        self.indexes = {}
+
+        # Extract cache manifests, by extract directory.
+        self.manifests = {}
+
+    ############################################################
+    #
+    # Package Index
+    #
+    # Each binary-<arch> directory has an index mapping package
+    # names to package files. The index is stored in the repo
+    # directory (so writing it does not touch binary-<arch>) and
+    # is valid as long as the binary-<arch> mtime is unchanged.
+    #
+    ############################################################
+    def __index_name(self, arch):
+        return os.path.join(self.repo, '.index.binary-%s' % arch)
+
+    def __index_write(self, arch, mtime, index):
+        self.indexes[arch] = (mtime, index)
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.repo, delete=False) as f:
+                pickle.dump((mtime, index), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(f.name, self.__index_name(arch))
+        except (IOError, OSError), e:
+            # Read-only repositories simply do not persist the index.
+            logger.debug("Could not write package index for %s: %s" % (arch, e))
+
+    def __index(self, arch):
+        """Return the package name -> [ package files ] index for the given arch."""
+        dirname = os.path.join(self.repo, "binary-" + arch)
+        try:
+            mtime = os.stat(dirname).st_mtime
+        except OSError:
+            return {}
+
+        if self.indexes.get(arch, (None,))[0] == mtime:
+            return self.indexes[arch][1]
+
+        try:
+            with open(self.__index_name(arch), "rb") as f:
+                (imtime, index) = pickle.load(f)
+            if imtime == mtime:
+                self.indexes[arch] = (mtime, index)
+                return index
+        except Exception:
+            pass
+
+        logger.debug("Indexing %s..." % dirname)
+        index = {}
+        for f in sorted(os.listdir(dirname)):
+            if f.endswith('.deb'):
+                index.setdefault(f.split('_')[0], []).append(os.path.join(dirname, f))
+        self.__index_write(arch, mtime, index)
+        return index
+
+    def __index_update(self, arch, index, name, path):
+        """Record the addition (path) or removal (path=None) of a package file.
+
+        'index' must be the index as it was before the change was made."""
+        dirname = os.path.join(self.repo, "binary-" + arch)
+        index = dict(index)
+        if path:
+            index[name] = [ path ]
+        else:
+            index.pop(name, None)
+        self.__index_write(arch, os.stat(dirname).st_mtime, index)
+
     def add_packages(self, pkglist):
         """Add a package or list of packages to the repository."""
         for p in pkglist if type(pkglist) is list else [ pkglist ]:
@@ -752,6 +1309,7 @@ class OnlPackageRepoUnlocked(object):
             if not os.path.exists(dstdir):
                 os.makedirs(dstdir)
             logger.info("dstdir=%s"% dstdir)
+            index = self.__index(arch)
 
             # Remove any existing versions of this package.
             for existing in glob.glob(os.path.join(dstdir, "%s_*.deb" % package)):
@@ -759,7 +1317,9 @@ class OnlPackageRepoUnlocked(object):
                 os.unlink(existing)
 
             shutil.copy(p, dstdir)
-            extract_dir = os.path.join(self.extracts, arch, package)
+            self.__index_update(arch, index, package, os.path.join(dstdir, os.path.basename(p)))
+            extract_dir = os.path.join(self.extracts, "%s_%s" % (package, arch))
+            self.manifests.pop(extract_dir, None)
             if os.path.exists(extract_dir):
                 # Make sure the package gets re-extracted the next time it's requested by clearing any existing extract in the cache.
                 logger.info("removed previous extract directory %s...", extract_dir)
@@ -770,18 +1330,16 @@ class OnlPackageRepoUnlocked(object):
         for p in pkglist if type(pkglist) is list else [ pkglist ]:
             path = self.lookup(p)
             if path:
+                (name, arch) = OnlPackage.idparse(p)
+                index = self.__index(arch)
                 logger.info("removing package %s..." % p)
                 os.unlink(path)
+                self.__index_update(arch, index, name, None)
 
     def lookup_all(self, pkg):
         """Lookup all packages in the repo matching the given package identifier."""
-        rv = []
         (name, arch) = OnlPackage.idparse(pkg)
-        dirname = os.path.join(self.repo, "binary-" + arch)
-        if os.path.exists(dirname):
-            manifest = os.listdir(dirname)
-            rv = [ os.path.join(dirname, x) for x in manifest if arch in x and "%s_" % name in x ]
-        return rv
+        return list(self.__index(arch).get(name, []))
 
     def __contains__(self, pkg):
         r = self.lookup_all(pkg)
@@ -801,6 +1359,132 @@ class OnlPackageRepoUnlocked(object):
         else:
             return r[0]
 
+    # Stamp file whose mtime matches the extracted package file.
+    PKG_TIMESTAMP = '.PKG.TIMESTAMP'
+
+    # Index of the files and directories in an extract cache entry.
+    PKG_MANIFEST = '.PKG.MANIFEST'
+
+    def __stamp(self, path):
+        st = os.stat(path)
+        return [ st.st_mtime, st.st_size ]
+
+    def __manifest_write(self, edir, path, listing):
+        """Index the package contents by file and directory basename.
+
+        listing : The member list returned by OnlDebReader.extract()."""
+        files = {}
+        dirs = {}
+        members = {}
+        seen = set()
+
+        def adddir(d):
+            if d and d not in seen:
+                adddir(os.path.dirname(d))
+                seen.add(d)
+                dirs.setdefault(os.path.basename(d), []).append(d)
+
+        for (name, type_, size, mtime) in listing:
+            if type_ == tarfile.DIRTYPE:
+                adddir(name)
+            else:
+                adddir(os.path.dirname(name))
+                files.setdefault(os.path.basename(name), []).append(name)
+                members[name] = (type_, size, mtime)
+
+        manifest = dict(package=self.__stamp(path), files=files, dirs=dirs, members=members)
+        with open(os.path.join(edir, self.PKG_MANIFEST), "w") as f:
+            json.dump(manifest, f)
+        self.manifests[edir] = manifest
+        return manifest
+
+    def __manifest(self, edir, path=None):
+        """Return the manifest for the given extract cache entry.
+
+        If 'path' is given the manifest is only returned if it describes
+        that package file."""
+        manifest = self.manifests.get(edir, None)
+        if manifest is None:
+            try:
+                with open(os.path.join(edir, self.PKG_MANIFEST)) as f:
+                    manifest = json.load(f)
+            except (IOError, ValueError):
+                return None
+            if 'package' not in manifest:
+                return None
+            self.manifests[edir] = manifest
+        if path and manifest['package'] != self.__stamp(path):
+            return None
+        return manifest
+
+    def __manifest_rebuild(self, edir, path):
+        """Regenerate the manifest of a complete extract from the package listing."""
+        return self.__manifest_write(edir, path, onldeb.OnlDebReader(path).extract(edir, lambda n: False))
+
+    def __extract_valid(self, edir, path):
+        ts = os.path.join(edir, self.PKG_TIMESTAMP)
+        return os.path.exists(ts) and os.path.getmtime(ts) == os.path.getmtime(path)
+
+    def __prune(self, edir, old, listing):
+        """Remove files of a previous extract which are not in the new package."""
+        names = set([ l[0] for l in listing ])
+        for name in old['members']:
+            if name not in names:
+                f = os.path.join(edir, name)
+                if os.path.lexists(f) and not os.path.isdir(f):
+                    logger.debug("rm %s" % f)
+                    os.unlink(f)
+
+    def __extract_prepare(self, edir, old, clean):
+        """Prepare an extract directory for (re)extraction."""
+        if clean and os.path.exists(edir) and old is None:
+            logger.debug("rm -rf %s" % edir)
+            shutil.rmtree(edir)
+        if not os.path.exists(edir):
+            os.makedirs(edir)
+        # The extract is not valid until it is stamped again.
+        ts = os.path.join(edir, self.PKG_TIMESTAMP)
+        if os.path.exists(ts):
+            os.unlink(ts)
+
+    def __extract(self, path, edir, cache, clean):
+        """Extract a package file in-process.
+
+        Unchanged files from a previous extract of the same entry are left
+        in place and files which no longer exist in the package are removed."""
+        old = self.__manifest(edir) if cache else None
+        self.__extract_prepare(edir, old, clean)
+
+        listing = onldeb.OnlDebReader(path).extract(edir)
+        if old:
+            self.__prune(edir, old, listing)
+
+        ts = os.path.join(edir, self.PKG_TIMESTAMP)
+        open(ts, "w").close()
+        st = os.stat(path)
+        os.utime(ts, (st.st_atime, st.st_mtime))
+
+        if cache:
+            self.__manifest_write(edir, path, listing)
+
+    def __extract_member(self, path, edir, filename):
+        """Extract only the first file with the given basename into the extract cache."""
+        logger.debug("Extracting %s from %s..." % (filename, path))
+        old = self.__manifest(edir)
+        self.__extract_prepare(edir, old, True)
+
+        found = []
+        def select(name):
+            if not found and os.path.basename(name) == filename:
+                found.append(name)
+                return True
+            return False
+
+        listing = onldeb.OnlDebReader(path).extract(edir, select)
+        if old:
+            self.__prune(edir, old, listing)
+        return self.__manifest_write(edir, path, listing)
+
     def extract(self, pkg, dstdir=None, prefix=True, force=False, remove_ts=False, sudo=False):
         """Extract the given package.
 
@@ -809,8 +1493,6 @@ class OnlPackageRepoUnlocked(object):
                  The default is the local repo's extract cache.
         force: If True, the package will be extracted even if its contents are already valid in the extract cache."""
 
-        PKG_TIMESTAMP = '.PKG.TIMESTAMP'
-
         path = self.lookup(pkg)
         if path:
 
@@ -822,8 +1504,8 @@ class OnlPackageRepoUnlocked(object):
             else:
                 edir = dstdir
 
-            if not force and os.path.exists(os.path.join(edir, PKG_TIMESTAMP)):
-                if (os.path.getmtime(os.path.join(edir, PKG_TIMESTAMP)) ==
+            if not force and os.path.exists(os.path.join(edir, self.PKG_TIMESTAMP)):
+                if (os.path.getmtime(os.path.join(edir, self.PKG_TIMESTAMP)) ==
                     os.path.getmtime(path)):
                     # Existing extract is identical to source package
                     logger.debug("Existing extract for %s matches the package file." % pkg)
@@ -836,17 +1518,25 @@ class OnlPackageRepoUnlocked(object):
                 force=True
 
             if force:
-                if os.path.exists(edir) and prefix:
-                    logger.debug("rm -rf %s" % edir)
-                    shutil.rmtree(edir)
-                if not os.path.exists(edir):
-                    os.makedirs(edir)
-
-                onlu.execute([ 'dpkg', '-x', path, edir ], sudo=sudo)
-                onlu.execute([ 'touch', '-r', path, os.path.join(edir, PKG_TIMESTAMP) ], sudo=sudo)
+                with onlu.Profiler() as profiler:
+                    if sudo:
+                        # Privileged extracts (e.g. into a root filesystem) need dpkg
+                        # to preserve ownership and device nodes.
+                        if os.path.exists(edir) and prefix:
+                            logger.debug("rm -rf %s" % edir)
+                            shutil.rmtree(edir)
+                        if not os.path.exists(edir):
+                            os.makedirs(edir)
+
+                        onlu.execute([ 'dpkg', '-x', path, edir ], sudo=sudo)
+                        onlu.execute([ 'touch', '-r', path, os.path.join(edir, self.PKG_TIMESTAMP) ], sudo=sudo)
+                    else:
+                        self.__extract(path, edir, dstdir == self.extracts, prefix)
+                profiler.log("extract %s" % pkg)
+                profiler.record('extract', package=pkg)
 
-            if remove_ts and os.path.exists(os.path.join(edir, PKG_TIMESTAMP)):
-                onlu.execute([ 'rm', os.path.join(edir, PKG_TIMESTAMP) ], sudo=sudo)
+            if remove_ts and os.path.exists(os.path.join(edir, self.PKG_TIMESTAMP)):
+                onlu.execute([ 'rm', os.path.join(edir, self.PKG_TIMESTAMP) ], sudo=sudo)
 
             return edir
 
@@ -867,11 +1557,31 @@ class OnlPackageRepoUnlocked(object):
 
         force: Passed to extract() as the force option."""
 
-        edir = self.extract(pkg, force=force)
-        for root, dirs, files in os.walk(edir):
-            for file_ in files:
-                if file_ == filename:
-                    return os.path.join(root, file_)
+        path = self.lookup(pkg)
+        if path:
+            edir = os.path.join(self.extracts, pkg.replace(':', '_'))
+            if force:
+                self.extract(pkg, force=force)
+
+            manifest = self.__manifest(edir, path)
+            if manifest is None:
+                if self.__extract_valid(edir, path):
+                    manifest = self.__manifest_rebuild(edir, path)
+                else:
+                    # Only the requested file is extracted.
+                    manifest = self.__extract_member(path, edir, filename)
+
+            paths = manifest['files'].get(filename, [])
+            if paths:
+                f = os.path.join(edir, paths[0])
+                (type_, size, mtime) = manifest['members'][paths[0]]
+                if type_ in [ tarfile.LNKTYPE, tarfile.SYMTYPE ]:
+                    # Links need their target. Extract everything.
+                    self.extract(pkg)
+                elif not os.path.lexists(f) or (type_ in tarfile.REGULAR_TYPES and
+                                                (os.path.getsize(f) != size or int(os.path.getmtime(f)) != mtime)):
+                    onldeb.OnlDebReader(path).extract(edir, lambda n: n == paths[0], stop=True)
+                return f
 
         if ex:
             raise OnlPackageMissingFileError(pkg, filename)
@@ -892,10 +1602,12 @@ class OnlPackageRepoUnlocked(object):
             apath = os.path.join(edir, dirname[1:]);
             if os.path.isdir(apath):
                 return apath
-        else:
-            for root, dirs, files in os.walk(edir):
-                if os.path.basename(root) == dirname and root != edir:
-                    return root
+        elif edir:
+            path = self.lookup(pkg)
+            manifest = self.__manifest(edir, path) or self.__manifest_rebuild(edir, path)
+            paths = manifest['dirs'].get(dirname, [])
+            if paths:
+                return os.path.join(edir, paths[0])
 
         if ex:
             raise OnlPackageMissingDirError(pkg, dirname)
@@ -904,56 +1616,162 @@ class OnlPackageRepoUnlocked(object):
 
 
 class OnlPackageRepo(object):
+    """Locked Package Repository
+
+    Read operations hold the repository lock shared and modifications
+    hold it exclusive. Extract cache entries are additionally locked
+    per package, so concurrent extractions of different packages do
+    not block each other."""
+
     def __init__(self, root, packagedir='packages'):
         self.r = OnlPackageRepoUnlocked(root, packagedir)
-        self.lock = onlu.Lock(os.path.join(root, '.lock'))
+        self.lockfile = os.path.join(root, '.lock')
+
+    # A new Lock per acquisition, so concurrent build workers
+    # never share a lock object or its file handle.
+    @property
+    def rlock(self):
+        return onlu.Lock(self.lockfile, shared=True)
+
+    @property
+    def wlock(self):
+        return onlu.Lock(self.lockfile)
+
+    def __extract_lock(self, pkg, dstdir=None):
+        """Exclusive lock for the extract cache entry of the given package."""
+        if dstdir is not None:
+            # Extracts outside the cache are owned by the caller.
+            return onlu.NoLock()
+        if not os.path.exists(self.r.extracts):
+            try:
+                os.makedirs(self.r.extracts)
+            except OSError:
+                pass
+        return onlu.Lock(os.path.join(self.r.extracts, '.%s.lock' % pkg.replace(':', '_')))
 
     def __contains__(self, pkg):
-        with self.lock:
+        with self.rlock:
             return self.r.__contains__(pkg)
 
     def get_dir(self, pkg, dirname, force=False, ex=True):
-        with self.lock:
+        with self.rlock, self.__extract_lock(pkg):
             return self.r.get_dir(pkg, dirname, force, ex)
 
     def get_file(self, pkg, filename, force=False, ex=True):
-        with self.lock:
+        with self.rlock, self.__extract_lock(pkg):
             return self.r.get_file(pkg, filename, force, ex)
 
     def add_packages(self, pkglist):
-        with self.lock:
+        with self.wlock:
             return self.r.add_packages(pkglist)
 
     def remove_packages(self, pkglist):
-        with self.lock:
+        with self.wlock:
             return self.r.remove_packages(pkglist)
 
     def lookup(self, pkg, ex=False):
-        with self.lock:
+        with self.rlock:
             return self.r.lookup(pkg, ex)
 
     def lookup_all(self, pkg):
-        with self.lock:
+        with self.rlock:
             return self.r.lookup_all(pkg)
 
     def extract(self, pkg, dstdir=None, prefix=True, force=False, remove_ts=False, sudo=False):
-        with self.lock:
+        with self.rlock, self.__extract_lock(pkg, dstdir):
             return self.r.extract(pkg, dstdir, prefix, force, remove_ts, sudo)
 
     def contents(self, pkg):
-        with self.lock:
+        with self.rlock:
             return self.r.contents(pkg)
 
+    def contains_all(self, pkgs):
+        """Return the set of the given packages which are in the repo."""
+        with self.rlock:
+            return set([ p for p in pkgs if self.r.__contains__(p) ])
+
+    def lookup_batch(self, pkgs):
+        """Return a dict mapping each of the given packages to its package files."""
+        with self.rlock:
+            return dict([ (p, self.r.lookup_all(p)) for p in pkgs ])
+
+    @staticmethod
+    def __overlaps(a, b):
+        a = os.path.join(os.path.abspath(a), '')
+        b = os.path.join(os.path.abspath(b), '')
+        return a.startswith(b) or b.startswith(a)
+
+    def extract_batch(self, entries, force=False, remove_ts=False, sudo=False, jobs=None):
+        """Extract packages into the given directories.
+
+        entries : A list of (package, dstdir) tuples. Each package is
+                  extracted directly into its dstdir, as by --extract-dir.
+        jobs    : The maximum number of concurrent extractions
+                  (default: the number of cpus).
+
+        The whole list is resolved under a single acquisition of the repo
+        lock. Entries whose destinations overlap (the same directory, or
+        one inside the other) are extracted in list order; the others are
+        extracted concurrently. Returns the list of extract directories."""
+
+        with self.rlock:
+            for (pkg, dstdir) in entries:
+                if not self.r.lookup(pkg):
+                    raise OnlPackageMissingError(pkg)
+
+            # Group the entries into chains of overlapping destinations.
+            chains = []
+            for (i, (pkg, dstdir)) in enumerate(entries):
+                joined = [ c for c in chains if [ e for e in c if self.__overlaps(e[2], dstdir) ] ]
+                chains = [ c for c in chains if c not in joined ]
+                chains.append(sorted(sum(joined, []) + [ (i, pkg, dstdir) ]))
+
+            work = Queue.Queue()
+            for c in chains:
+                work.put(c)
+
+            rv = [ None ] * len(entries)
+            errors = []
+
+            def worker():
+                while not errors:
+                    try:
+                        chain = work.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        for (i, pkg, dstdir) in chain:
+                            logger.debug("Extracting %s into %s..." % (pkg, dstdir))
+                            rv[i] = self.r.extract(pkg, dstdir, False, force, remove_ts, sudo)
+                    except Exception, e:
+                        errors.append(e)
+
+            threads = [ threading.Thread(target=worker)
+                        for _ in range(min(jobs or onlu.multiprocessing.cpu_count(), len(chains))) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            if errors:
+                raise errors[0]
+
+            return rv
+
 class OnlPackageManager(object):
 
     def __init__(self):
         # Stores all loaded package groups.
         self.package_groups = []
         self.opr = None
+        self.artifacts = None
 
     def set_repo(self, repodir, packagedir='packages'):
         self.opr = OnlPackageRepo(repodir, packagedir=packagedir)
 
+    def set_artifact_cache(self, root=None, shared=None, lookup=True):
+        self.artifacts = OnlPackageArtifactCache(root, shared, lookup)
+
 
     def filter(self, subdir=None, arches=None, substr=None):
 
@@ -963,13 +1781,36 @@ class OnlPackageManager(object):
             if not pg.archcheck(arches):
                 pg.filtered = True
 
+    # Bumped whenever the cache layout changes.
+    CACHE_VERSION = 3
+
+    # Package files per load process task.
+    LOAD_CHUNK = 8
+
     def __cache_name(self, basedir):
         return os.path.join(basedir, '.PKGs.cache.%s' % g_dist_codename)
 
     def __write_cache(self, basedir):
         cache = self.__cache_name(basedir)
         logger.debug("Writing the package cache %s..." % cache)
-        pickle.dump(self.package_groups, open(cache, "wb"))
+        # Entries are keyed by their package file.
+        entries = [ (pg._pkgs['__source'], pg) for pg in self.package_groups ]
+        # Write and rename so readers never see a partial cache.
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(cache), delete=False) as f:
+            pickle.dump(dict(version=self.CACHE_VERSION, entries=entries), f, pickle.HIGHEST_PROTOCOL)
+        # NamedTemporaryFile is 0600; give the cache the usual mode.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(f.name, 0666 & ~umask)
+        os.rename(f.name, cache)
+
+    def cache_stamp(self, basedir):
+        """The (mtime, size) of the package cache of the given directory, or None."""
+        try:
+            st = os.stat(self.__cache_name(basedir))
+            return (st.st_mtime, st.st_size)
+        except OSError:
+            return None
 
     def __load_cache(self, basedir, ro):
         cache=self.__cache_name(basedir)
@@ -980,57 +1821,102 @@ class OnlPackageManager(object):
                 logger.debug("Loading from package cache %s" % cache)
 
                 try:
-                    self.package_groups = pickle.load(open(cache, "rb"))
+                    data = pickle.load(open(cache, "rb"))
+                    if data.get('version', None) != self.CACHE_VERSION:
+                        raise ValueError("version mismatch")
+                    entries = data['entries']
                 except Exception, e:
                     logger.warn("The existing package cache is corrupted. It will be rebuilt.")
                     return False
 
+                self.package_groups = [ pg for (source, pg) in entries ]
+
                 if ro:
                     return True
 
-                # Validate and update the cache
-                for pg in self.package_groups:
-                    pg.reload()
-
-                self.__write_cache(basedir)
+                # Validate and update only the entries whose inputs changed.
+                dirty = False
+                for (source, pg) in entries:
+                    if not os.path.exists(source):
+                        logger.debug("Package file %s has been removed." % source)
+                        self.package_groups.remove(pg)
+                        dirty = True
+                    elif pg.reload():
+                        dirty = True
+
+                if dirty:
+                    self.__write_cache(basedir)
                 return True
 
         return False
 
 
     def __builder_arches(self):
-        arches = [ 'all', 'amd64' ]
-        arches = arches + subprocess.check_output(['dpkg', '--print-foreign-architectures']).split()
-        return arches
+        # Ask dpkg once; child onlpm processes inherit the answer.
+        if 'ONLPM_BUILDER_ARCHES' not in os.environ:
+            arches = [ 'all', 'amd64' ]
+            arches = arches + subprocess.check_output(['dpkg', '--print-foreign-architectures']).split()
+            os.environ['ONLPM_BUILDER_ARCHES'] = " ".join(arches)
+        return os.environ['ONLPM_BUILDER_ARCHES'].split()
+
+    def __discover(self, basedir):
+        """Return the package files below basedir, in sorted order."""
+        try:
+            # The scandir backport avoids a stat() per directory entry.
+            from scandir import walk
+        except ImportError:
+            walk = os.walk
 
-    def __build_cache(self, basedir):
         pkgspec = [ 'PKG.yml', 'pkg.yml' ]
-
-        builder_arches = self.__builder_arches()
-
-        for root, dirs, files in os.walk(basedir):
+        rv = []
+        for root, dirs, files in walk(basedir):
             for f in files:
                 if f in pkgspec:
                     if "%s.disabled" % f in files:
                         logger.warn("Skipping %s due to .disabled file)." % os.path.join(root, f))
                     else:
-                        pg = OnlPackageGroup()
-                        try:
-                            logger.debug('Loading package file %s...' % os.path.join(root, f))
-                            pg.load(os.path.join(root, f))
-                            logger.debug('  Loaded package file %s' % os.path.join(root, f))
-                            if pg.distcheck() and pg.buildercheck(builder_arches):
-                                self.package_groups.append(pg)
-                        except OnlPackageError, e:
-                            logger.error("%s: " % e)
-                            logger.warn("Skipping %s due to errors." % os.path.join(root, f))
-
-    def load(self, basedir, usecache=True, rebuildcache=False, roCache=False):
+                        rv.append(os.path.join(root, f))
+        return sorted(rv)
+
+    def __build_cache(self, basedir, jobs=None):
+        builder_arches = self.__builder_arches()
+
+        pkgfiles = self.__discover(basedir)
+
+        jobs = min(jobs or onlu.multiprocessing.cpu_count(), len(pkgfiles) / self.LOAD_CHUNK + 1)
+        if jobs > 1:
+            logger.debug("Loading %d package files with %d processes..." % (len(pkgfiles), jobs))
+            pool = onlu.multiprocessing.Pool(jobs)
+            try:
+                # Results are merged in discovery order, as a serial load would be.
+                results = pool.map(_load_package_group, pkgfiles, self.LOAD_CHUNK)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [ _load_package_group(f) for f in pkgfiles ]
+
+        for (f, pg, error) in results:
+            if pg is None and error is None:
+                # Not an OnlPackageError. Load it here to raise it.
+                pg = OnlPackageGroup()
+                pg.load(f)
+            if error is not None:
+                logger.error("%s: " % error)
+                logger.warn("Skipping %s due to errors." % f)
+            elif pg.distcheck() and pg.buildercheck(builder_arches):
+                self.package_groups.append(pg)
+
+    def load(self, basedir, usecache=True, rebuildcache=False, roCache=False, jobs=None):
+        """Load the package groups below basedir.
+
+        jobs : The number of processes loading package files when the
+               package cache is (re)built (default: the number of cpus)."""
         if usecache is True and rebuildcache is False:
             if self.__load_cache(basedir, roCache):
                 return
 
-        self.__build_cache(basedir)
+        self.__build_cache(basedir, jobs)
 
         if usecache:
             # Write the package cache
@@ -1059,23 +1945,7 @@ class OnlPackageManager(object):
                     # Only due this if we are building the actual package,
                     # not processing the package dependencies.
                     #
-                    for sub in pg.prerequisite_submodules():
-                        root = sub.get('root', None)
-                        path = sub.get('path', None)
-                        depth = sub.get('depth', None)
-                        recursive = sub.get('recursive', None)
-
-                        if not root:
-                            raise OnlPackageError("Submodule prerequisite in package %s does not have a root key." % pkg)
-
-                        if not path:
-                            raise OnlPackageError("Submodule prerequisite in package %s does not have a path key." % pkg)
-
-                        try:
-                            manager = submodules.OnlSubmoduleManager(root)
-                            manager.require(path, depth=depth, recursive=recursive)
-                        except submodules.OnlSubmoduleError, e:
-                            raise OnlPackageError(e.value)
+                    self.__require_submodules(pg, pkg)
 
                 # Process prerequisite packages
                 for pr in pg.prerequisite_packages():
@@ -1084,7 +1954,7 @@ class OnlPackageManager(object):
 
                 if not prereqs_only:
                     # Build package
-                    products = pg.build(dir_=dir_)
+                    products = self.__build_group(pg, dir_)
                     if self.opr:
                         # Add results to our repo
                         self.opr.add_packages(products)
@@ -1094,6 +1964,248 @@ class OnlPackageManager(object):
         if not built:
             raise OnlPackageMissingError(pkg)
 
+    def __build_group(self, pg, dir_=None):
+        prerequisites = None
+        if self.artifacts and self.opr:
+            prerequisites = []
+            for pr in pg.prerequisite_packages():
+                path = self.opr.lookup(pr)
+                prerequisites.append((pr, onlu.file_hash(path) if path else None))
+        return pg.build(dir_=dir_, artifacts=self.artifacts, prerequisites=prerequisites)
+
+    def __require_submodules(self, pg, pkg):
+        for sub in pg.prerequisite_submodules():
+            root = sub.get('root', None)
+            path = sub.get('path', None)
+            depth = sub.get('depth', None)
+            recursive = sub.get('recursive', None)
+
+            if not root:
+                raise OnlPackageError("Submodule prerequisite in package %s does not have a root key." % pkg)
+
+            if not path:
+                raise OnlPackageError("Submodule prerequisite in package %s does not have a path key." % pkg)
+
+            try:
+                manager = submodules.OnlSubmoduleManager(root)
+                manager.require(path, depth=depth, recursive=recursive)
+            except submodules.OnlSubmoduleError, e:
+                raise OnlPackageError(e.value)
+
+    def __prerequisite_groups(self, pg):
+        """Return the package groups providing the prerequisites of the given group."""
+        rv = []
+        for pr in pg.prerequisite_packages():
+            groups = [ g for g in self.package_groups if pr in g ]
+            if not groups:
+                raise OnlPackageMissingError(pr)
+            for g in groups:
+                if g not in rv:
+                    rv.append(g)
+        return rv
+
+    def build_graph(self, pkgs, filtered=True):
+        """Compute the prerequisite graph for the given packages.
+
+        Returns a tuple (graph, targets). 'graph' maps every package
+        group reachable from the requested packages to the list of
+        package groups it depends on. 'targets' is the list of package
+        groups which were requested directly.
+
+        A cycle in the prerequisite graph raises an OnlPackageError."""
+
+        targets = []
+        for pkg in pkgs:
+            found = False
+            for pg in self.package_groups:
+                if pkg in pg:
+                    if filtered and pg.filtered:
+                        continue
+                    found = True
+                    if pg not in targets:
+                        targets.append(pg)
+            if not found:
+                raise OnlPackageMissingError(pkg)
+
+        graph = {}
+        # Depth-first walk. 'path' holds the groups on the current branch.
+        def visit(pg, path):
+            if pg in path:
+                cycle = path[path.index(pg):] + [ pg ]
+                raise OnlPackageError("Prerequisite cycle: %s" %
+                                      " -> ".join([ g._pkgs['__source'] for g in cycle ]))
+            if pg in graph:
+                return
+            deps = self.__prerequisite_groups(pg)
+            for d in deps:
+                visit(d, path + [ pg ])
+            graph[pg] = deps
+
+        for pg in targets:
+            visit(pg, [])
+
+        return (graph, targets)
+
+    def build_parallel(self, pkgs, jobs, dir_=None, force=False, filtered=True):
+        """Build the given packages and their prerequisites in parallel.
+
+        The full prerequisite graph is computed up front. Each package
+        group is scheduled on one of 'jobs' workers as soon as all of the
+        groups it depends on have finished. The requested groups are always
+        built; prerequisite groups are only built when one of their
+        required packages is missing from the repository (or 'force' is set).
+
+        Each group build still holds the per-directory package lock, and
+        each repository update takes its own exclusive repository lock."""
+
+        (graph, targets) = self.build_graph(pkgs, filtered=filtered)
+
+        # Determine which groups actually require building.
+        required = {}
+        for (pg, deps) in graph.iteritems():
+            for pr in pg.prerequisite_packages():
+                for d in deps:
+                    if pr in d:
+                        required.setdefault(d, []).append(pr)
+
+        work = set(targets)
+        for (pg, prs) in required.iteritems():
+            if pg in work:
+                continue
+            if force or [ pr for pr in prs if pr not in self.opr ]:
+                work.add(pg)
+
+        # Submodules are shared between groups and are not safe to update concurrently.
+        for pg in graph:
+            if pg in work:
+                self.__require_submodules(pg, pg._pkgs['__source'])
+
+        pending = dict((pg, set(d for d in deps if d in work))
+                       for (pg, deps) in graph.iteritems() if pg in work)
+        running = set()
+        results = Queue.Queue()
+        errors = []
+
+        def worker(pg):
+            try:
+                products = self.__build_group(pg, dir_)
+                if self.opr:
+                    self.opr.add_packages(products)
+                results.put((pg, None))
+            except Exception, e:
+                results.put((pg, e))
+
+        logger.info("Building %d package groups with %d jobs..." % (len(pending), jobs))
+
+        while pending or running:
+            if not errors:
+                ready = sorted([ pg for (pg, deps) in pending.iteritems() if not deps ],
+                               key=lambda g: g._pkgs['__source'])
+                for pg in ready[:max(jobs - len(running), 0)]:
+                    logger.info("Building %s..." % pg._pkgs['__source'])
+                    del pending[pg]
+                    running.add(pg)
+                    t = threading.Thread(target=worker, args=(pg,))
+                    t.daemon = True
+                    t.start()
+
+            if not running:
+                # Nothing in flight and nothing can be started.
+                break
+
+            (pg, e) = results.get()
+            running.remove(pg)
+            if e is not None:
+                logger.error("Build of %s failed: %s" % (pg._pkgs['__source'], e))
+                errors.append(e)
+                continue
+
+            for deps in pending.itervalues():
+                deps.discard(pg)
+
+        if errors:
+            raise errors[0]
+
+        for (pg, prs) in required.iteritems():
+            for pr in prs:
+                if self.opr and pr not in self.opr:
+                    raise OnlPackageError("Package %s is required but has not been built." % pr)
+
+    def build_report(self, events):
+        """Summarize build timing records (see onlu.Profiler.record).
+
+        Returns a dict containing per package group timings, the critical
+        path through the prerequisite graph of the groups which were built,
+        and the achieved build parallelism."""
+
+        groups = {}
+        def entry(source):
+            return groups.setdefault(source, dict(packages=[], build=0.0, make=0.0, deb=0.0,
+                                                  fpm=0.0, extract=0.0, cached=False,
+                                                  start=None, end=None))
+
+        byid = {}
+        for pg in self.package_groups:
+            for p in pg.packages:
+                byid[p.id()] = pg._pkgs['__source']
+
+        intervals = []
+        for e in events:
+            kind = e.get('kind')
+            if kind in [ 'build', 'make' ]:
+                g = entry(e['group'])
+            elif kind in [ 'deb', 'fpm', 'extract' ] and e.get('package') in byid:
+                g = entry(byid[e['package']])
+            else:
+                continue
+
+            g[kind] += e['duration']
+            if kind == 'build':
+                g['packages'] = e.get('packages', [])
+                g['cached'] = g['cached'] or e.get('cached', False)
+                g['start'] = e['start'] if g['start'] is None else min(g['start'], e['start'])
+                g['end'] = e['end'] if g['end'] is None else max(g['end'], e['end'])
+                intervals.append((e['start'], e['end']))
+
+        rv = dict(groups=groups)
+        if not intervals:
+            return rv
+
+        # Parallelism: busy time over wall time, and the peak concurrency.
+        wall = max([ i[1] for i in intervals ]) - min([ i[0] for i in intervals ])
+        busy = sum([ i[1] - i[0] for i in intervals ])
+        (peak, current) = (0, 0)
+        for (t, d) in sorted([ (i[0], 1) for i in intervals ] + [ (i[1], -1) for i in intervals ],
+                             key=lambda x: (x[0], x[1])):
+            current += d
+            peak = max(peak, current)
+        rv['wall'] = wall
+        rv['busy'] = busy
+        rv['parallelism'] = busy / wall if wall else 1.0
+        rv['peak'] = peak
+        rv['utilization'] = rv['parallelism'] / peak if peak else 0.0
+
+        # Critical path: the longest chain of dependent builds.
+        pgs = [ pg for pg in self.package_groups if pg._pkgs['__source'] in groups ]
+        try:
+            (graph, targets) = self.build_graph([ pg.packages[0].id() for pg in pgs if pg.packages ],
+                                                filtered=False)
+        except OnlPackageError, e:
+            logger.warn("No critical path: %s" % e)
+            return rv
+
+        longest = {}
+        def path(pg):
+            if pg not in longest:
+                weight = groups.get(pg._pkgs['__source'], {}).get('build', 0.0)
+                best = max([ path(d) for d in graph[pg] ] or [ (0.0, []) ], key=lambda x: x[0])
+                longest[pg] = (best[0] + weight, best[1] + [ pg._pkgs['__source'] ])
+            return longest[pg]
+
+        critical = max([ path(pg) for pg in graph ] or [ (0.0, []) ], key=lambda x: x[0])
+        rv['critical_path'] = dict(duration=critical[0], groups=critical[1])
+        return rv
+
     def clean(self, pkg=None, dir_=None):
         for pg in self.package_groups:
             if pkg is None or pkg in pg:
@@ -1128,6 +2240,50 @@ class OnlPackageManager(object):
         if pkg not in self.opr:
             raise OnlPackageError("Package %s is required but has not been built." % pkg)
 
+    def require_all(self, pkgs, force=False, build_missing=False, skip_missing=False,
+                    try_arches=None, jobs=1, seen=None):
+        """Require all of the given packages, as by require().
+
+        The repository is queried once for the whole list. Missing (or,
+        with 'force', all) packages are built together with build_parallel()
+        using 'jobs' workers, and the prerequisites of the packages which
+        are already present are required in turn."""
+
+        seen = set() if seen is None else seen
+
+        resolved = []
+        for pkg in pkgs:
+            if pkg not in self and try_arches:
+                for a in try_arches:
+                    p = "%s:%s" % (pkg, a)
+                    if p in self:
+                        pkg = p
+                        break
+            if pkg not in self:
+                if skip_missing:
+                    continue
+                raise OnlPackageMissingError(pkg)
+            if pkg not in seen and pkg not in resolved:
+                resolved.append(pkg)
+        seen.update(resolved)
+
+        present = self.opr.contains_all(resolved)
+        rebuild = [ p for p in resolved if force or (p not in present and build_missing) ]
+        if rebuild:
+            logger.info("Rebuilding %s... " % " ".join(rebuild))
+            self.build_parallel(rebuild, jobs, filtered=False)
+
+        prereqs = []
+        for pg in self.package_groups:
+            if [ p for p in resolved if p in pg and p not in rebuild ]:
+                prereqs += [ pr for pr in pg.prerequisite_packages() if pr not in prereqs ]
+        if prereqs:
+            self.require_all(prereqs, build_missing=True, jobs=jobs, seen=seen)
+
+        missing = [ p for p in resolved if p not in self.opr.contains_all(resolved) ]
+        if missing:
+            raise OnlPackageError("Package %s is required but has not been built." % missing[0])
+
 
     def __str__(self):
         return "\n".join(self.list())
@@ -1142,7 +2298,23 @@ class OnlPackageManager(object):
                 rv[p] = d
         return rv
 
-    def pmake(self, handle=sys.stdout):
+    def pmake(self, handle=sys.stdout, events=None):
+        """Generate a Makefile which builds all packages.
+
+        Each package target depends only on the targets of its own
+        prerequisites, so make -j can start a package as soon as its
+        prerequisites are finished rather than waiting for a whole stage.
+        The exception are packages with an explicit 'stage', which are
+        built after every package of the same arch in a lower stage
+        (packages without prerequisites are in stage 0, others in 1).
+
+        events : Optional build timing records (see build_report()).
+                 The historical build time of each package weights its
+                 priority; targets are listed longest remaining build
+                 chain first, which is the order make starts them in.
+
+        Missing prerequisites and prerequisite cycles raise OnlPackageError."""
+
         packages = self.list()
 
         # Collect some dependency data
@@ -1152,24 +2324,74 @@ class OnlPackageManager(object):
         for (p,d) in packages.iteritems():
             (name,arch) = p.split(':')
             target = p.replace(':', '_')
-            depends = " ".join(d.get('packages', [])).replace(':', '_')
+            depends = []
+            for e in onlu.sflatten(d.get('packages', [])):
+                depends += [ x.strip() for x in e.split(',') if x.strip() ]
+
+            for dep in depends:
+                if dep not in packages:
+                    raise OnlPackageError("Package %s requires %s, which does not exist." % (p, dep))
 
             TARGETS[target] = TARGETS.get(target, {})
             TARGETS[target][arch] = arch
             TARGETS[target]['name'] = target
-            TARGETS[target]['depends'] = depends
+            TARGETS[target]['depends'] = [ x.replace(':', '_') for x in depends ]
             TARGETS[target]['package'] = p
+            TARGETS[target]['broken'] = d.get('broken', False)
+            TARGETS[target]['stage'] = d.get('stage', None) or (1 if depends else 0)
+            TARGETS[target]['barrier'] = bool(d.get('stage', None))
             ARCHS[arch] = ARCHS.get(arch, [])
             ARCHS[arch].append(TARGETS[target])
 
-            if d.get('broken', False):
-                TARGETS[target]['stage'] = 20
-            elif d.get('stage', False):
-                TARGETS[target]['stage'] = d.get('stage')
-            elif len(depends) == 0:
-                TARGETS[target]['stage'] = 0
-            else:
-                TARGETS[target]['stage'] = 1
+        # Explicit stages are barriers for packages which use the outputs
+        # of others without declaring them (e.g. all platform packages).
+        for targets in ARCHS.values():
+            for t in targets:
+                if t['barrier'] and not t['broken']:
+                    t['depends'] += sorted([ o['name'] for o in targets
+                                             if not o['broken'] and o['stage'] < t['stage'] and
+                                             o['name'] not in t['depends'] ])
+
+        # Mean historical (uncached) build time of each package.
+        weights = {}
+        if events:
+            times = {}
+            for e in events:
+                if e.get('kind') == 'build' and not e.get('cached', False):
+                    for p in e.get('packages', []):
+                        times.setdefault(p.replace(':', '_'), []).append(e['duration'])
+            for (t, v) in times.iteritems():
+                weights[t] = sum(v) / len(v)
+
+        # Topological depth, which also detects cycles.
+        def depth(t, path):
+            if t in path:
+                cycle = path[path.index(t):] + [ t ]
+                raise OnlPackageError("Prerequisite cycle: %s" % " -> ".join(cycle))
+            if 'depth' not in TARGETS[t]:
+                TARGETS[t]['depth'] = max([ depth(x, path + [ t ]) + 1
+                                            for x in TARGETS[t]['depends'] ] or [ 0 ])
+            return TARGETS[t]['depth']
+
+        for t in TARGETS:
+            depth(t, [])
+
+        # Priority is the longest weighted chain of builds starting at a target.
+        dependents = {}
+        for (t, d) in TARGETS.iteritems():
+            for x in d['depends']:
+                dependents.setdefault(x, []).append(t)
+
+        def priority(t):
+            if 'priority' not in TARGETS[t]:
+                TARGETS[t]['priority'] = weights.get(t, 1.0) + max([ priority(x) for x in dependents.get(t, []) ] or [ 0 ])
+            return TARGETS[t]['priority']
+
+        for t in TARGETS:
+            priority(t)
+
+        def ordered(targets):
+            return sorted(targets, key=lambda t: (-TARGETS[t]['priority'], t))
 
         handle.write("# -*- GNUMakefile -*-\n\n")
         handle.write("THIS_DIR := $(dir $(lastword $(MAKEFILE_LIST)))\n")
@@ -1185,8 +2407,10 @@ class OnlPackageManager(object):
         handle.write("#\n")
         handle.write("############################################################\n")
 
-        for (t, d) in TARGETS.iteritems():
-            handle.write("%s : %s\n" % (t, d['depends']))
+        for t in ordered(TARGETS.keys()):
+            d = TARGETS[t]
+            handle.write("# depth=%d weight=%.1f priority=%.1f\n" % (d['depth'], weights.get(t, 0.0), d['priority']))
+            handle.write("%s : %s\n" % (t, " ".join(ordered(d['depends']))))
             handle.write("\tset -o pipefail && onlpm.py --ro-cache --require %s |& tee $(BUILDING)/$@\n" % (d['package']))
             handle.write("\tmv $(BUILDING)/$@ $(FINISHED)/\n")
 
@@ -1194,21 +2418,21 @@ class OnlPackageManager(object):
             handle.write("############################################################\n")
             handle.write("#\n")
             handle.write("# These rules represent the build stages for arch='%s'\n" % arch)
+            handle.write("# A stage is the topological depth of its packages.\n")
+            handle.write("# Stages are not barriers (apart from explicit package stages);\n")
+            handle.write("# arch_%s builds everything at once.\n" % arch)
             handle.write("#\n")
             handle.write("############################################################\n")
             STAGES = {}
             for t in targets:
-                STAGES[t['stage']] = STAGES.get(t['stage'], [])
-                STAGES[t['stage']].append(t['name'])
+                if not t['broken']:
+                    STAGES[t['depth']] = STAGES.get(t['depth'], [])
+                    STAGES[t['depth']].append(t['name'])
 
-            for stage in range(0, 10):
-                handle.write("arch_%s_stage%s: %s\n\n" % (arch, stage, " ".join(STAGES.get(stage, []))))
+            for stage in range(0, max(STAGES.keys() + [ 9 ]) + 1):
+                handle.write("arch_%s_stage%s: %s\n\n" % (arch, stage, " ".join(ordered(STAGES.get(stage, [])))))
 
-        for arch in ARCHS.keys():
-            handle.write("arch_%s:\n" % arch)
-            for stage in range(0, 10):
-                handle.write("\t$(MAKE) arch_%s_stage%s\n" % (arch, stage))
-            handle.write("\n")
+            handle.write("arch_%s: %s\n\n" % (arch, " ".join(ordered([ t['name'] for t in targets if not t['broken'] ]))))
 
 
 
@@ -1226,6 +2450,139 @@ class OnlPackageManager(object):
                         platforms.append(m.groups('platform')[0])
         return platforms
 
+class OnlPackageServer(object):
+    """Serve onlpm requests from a unix socket.
+
+    The package manager is loaded once and kept in memory. Each request
+    is run by a forked child with the client's arguments, environment
+    and working directory, so requests can run concurrently and do not
+    reload the package groups. The loaded state is revalidated before
+    each request, as the package cache would be.
+
+    When ONLPM_OPTION_SERVER is set, onlpm.py forwards its requests to
+    the server on that socket and runs them itself if there is none
+    (see onlpmd.py)."""
+
+    # The client's environment must agree on these.
+    ENVIRONMENT = [ 'ONL', 'ONL_DEBIAN_SUITE' ]
+
+    def __init__(self, ops):
+        self.key = self.__key(ops)
+        self.ops = ops
+        self.pm = None
+        self.stamps = None
+
+    @staticmethod
+    def __key(ops):
+        return (os.path.abspath(ops.repo), ops.repo_package_dir,
+                [ os.path.abspath(d) for d in ops.packagedirs ], g_dist_codename)
+
+    def matches(self, ops):
+        """Whether a request can use the loaded package manager."""
+        return (self.__key(ops) == self.key and
+                not ops.no_pkg_cache and not ops.rebuild_pkg_cache)
+
+    def refresh(self):
+        """Revalidate the loaded package groups.
+
+        Everything is reloaded if the package cache has been rebuilt."""
+        # Script results are only reused within a request.
+        onlyaml.script_invalidate(persistent=False)
+        if self.pm is not None:
+            if self.stamps == [ self.pm.cache_stamp(d) for d in self.ops.packagedirs ]:
+                # Validate the loaded groups as the package cache would.
+                for pg in list(self.pm.package_groups):
+                    if not os.path.exists(pg._pkgs['__source']):
+                        logger.debug("Package file %s has been removed." % pg._pkgs['__source'])
+                        self.pm.package_groups.remove(pg)
+                    else:
+                        pg.reload()
+                return
+            logger.info("The package cache has been rebuilt.")
+
+        logger.info("Loading package groups...")
+        pm = OnlPackageManager()
+        pm.set_repo(self.ops.repo, packagedir=self.ops.repo_package_dir)
+        for pdir in self.ops.packagedirs:
+            pm.load(pdir, usecache=True, rebuildcache=False)
+        self.pm = pm
+        self.stamps = [ pm.cache_stamp(d) for d in self.ops.packagedirs ]
+
+    def __request(self, argv):
+        # Runs in the forked child, in the client's environment.
+        onlu.Profiler.EVENTFILE = os.environ.get('ONL_TRACE', None)
+        onlu.Profiler.local.stack = []
+        onlyaml.SCRIPT_CACHE = os.environ.get('ONLYAML_SCRIPT_CACHE', None)
+        onlyaml.SCRIPT_TTL = int(os.environ.get('ONLYAML_SCRIPT_TTL', 3600))
+        with onlu.Profiler(os.path.basename(sys.argv[0]), command=argv):
+            main(argv, served=self)
+
+    def serve(self, path):
+        import socket
+        import signal
+        import onlpmd
+
+        if path is None:
+            raise OnlPackageError("No server socket specified. Please use --serve SOCKET or set ONLPM_OPTION_SERVER in the environment.")
+
+        self.refresh()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(64)
+
+        # Children are not waited for.
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        logger.info("Serving requests on %s" % path)
+        try:
+            while True:
+                try:
+                    (conn, _) = sock.accept()
+                except socket.error, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                try:
+                    request = onlpmd.receive(conn)
+                    env = request['env']
+                    if [ k for k in self.ENVIRONMENT if env.get(k) != os.environ.get(k) ]:
+                        # Different tree or suite; the client must run the request itself.
+                        onlpmd.send(conn, fallback=True)
+                        continue
+                    self.refresh()
+                    if os.fork() == 0:
+                        sock.close()
+                        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                        onlpmd.run(conn, request, self.__request)
+                finally:
+                    conn.close()
+        finally:
+            sock.close()
+            os.unlink(path)
+
+
+def _load_package_group(pkgfile):
+    """Load a package file. Runs in the package cache worker processes.
+
+    Returns (pkgfile, group, error). OnlPackageErrors are returned as
+    error; on any other failure both group and error are None."""
+    try:
+        logger.debug('Loading package file %s...' % pkgfile)
+        pg = OnlPackageGroup()
+        pg.load(pkgfile)
+        logger.debug('  Loaded package file %s' % pkgfile)
+        return (pkgfile, pg, None)
+    except OnlPackageError, e:
+        return (pkgfile, None, str(e))
+    except Exception:
+        return (pkgfile, None, None)
+
 def defaultPm():
     repo = os.environ.get('ONLPM_OPTION_REPO', None)
     envJson = os.environ.get('ONLPM_OPTION_INCLUDE_ENV_JSON', None)
@@ -1252,7 +2609,10 @@ def defaultPm():
 
     return pm
 
-if __name__ == '__main__':
+def main(argv=None, served=None):
+    """Command line entry point.
+
+    served : The OnlPackageServer running this request, if any."""
 
     ap = argparse.ArgumentParser("onlpm")
     ap.add_argument("--repo", default=os.environ.get('ONLPM_OPTION_REPO', None))
@@ -1272,12 +2632,19 @@ if __name__ == '__main__':
     ap.add_argument("--pmake", action='store_true')
     ap.add_argument("--prereq-packages", action='store_true')
     ap.add_argument("--lookup", metavar='PACKAGE')
+    ap.add_argument("--lookup-batch", nargs='+', metavar='PACKAGE', help="Print the package files of all of the given packages as JSON.")
     ap.add_argument("--find-file", nargs=2, metavar=('PACKAGE', 'FILE'))
     ap.add_argument("--find-dir", nargs=2, metavar=('PACKAGE', 'DIR'))
     ap.add_argument("--link-file", nargs=3, metavar=('PACKAGE', 'FILE', 'DST'), action='append')
     ap.add_argument("--link-dir",  nargs=3, metavar=('PACKAGE', 'FILE', 'DST'), action='append')
     ap.add_argument("--copy-file", nargs=3, metavar=('PACKAGE', 'FILE', 'DST'), action='append')
+    ap.add_argument("--extract-dir-batch", metavar='MANIFEST', help="Extract packages into directories as listed in MANIFEST ('-' for stdin), one 'PACKAGE DIR' per line.")
     ap.add_argument("--build", nargs='+', metavar='PACKAGE')
+    ap.add_argument("--artifact-cache", metavar='DIR', default=os.environ.get('ONLPM_OPTION_ARTIFACT_CACHE', None), help="Reuse and store package build products in this content-addressed directory.")
+    ap.add_argument("--artifact-cache-shared", nargs='+', metavar='DIR', default=[ d for d in os.environ.get('ONLPM_OPTION_ARTIFACT_CACHE_SHARED', '').split(':') if d ], help="Additional read-only artifact caches.")
+    ap.add_argument("--build-log", metavar='FILE', default=os.environ.get('ONLPM_OPTION_BUILD_LOG', os.environ.get('ONL_TRACE', None)), help="Append structured build timing records to FILE. Inherited by child processes.")
+    ap.add_argument("--build-report", metavar='FILE', help="Report build timings and the critical path from the given build log.")
+    ap.add_argument("--build-parallel", type=int, metavar='JOBS', help="Build the given packages and their prerequisites with JOBS concurrent package group builds.")
     ap.add_argument("--clean", nargs='+', metavar='PACKAGE')
     ap.add_argument("--require", nargs='+', metavar='PACKAGE')
     ap.add_argument("--no-build-missing", action='store_true')
@@ -1288,6 +2655,7 @@ if __name__ == '__main__':
     ap.add_argument("--quiet", action='store_true')
     ap.add_argument("--rebuild-pkg-cache", action='store_true', default=os.environ.get('ONLPM_OPTION_REBUILD_PKG_CACHE', False))
     ap.add_argument("--no-pkg-cache", action='store_true', default=os.environ.get('ONLPM_OPTION_NO_PKG_CACHE', False))
+    ap.add_argument("--load-jobs", type=int, metavar='JOBS', default=os.environ.get('ONLPM_OPTION_LOAD_JOBS', None), help="Load package files with JOBS processes when building the package cache (default: the number of cpus).")
     ap.add_argument("--ro-cache", action='store_true', help="Assume existing package cache is up-to-date and read-only. Should be specified for parallel builds.")
     ap.add_argument("--pkg-info", action='store_true')
     ap.add_argument("--skip-missing", action='store_true')
@@ -1295,8 +2663,9 @@ if __name__ == '__main__':
     ap.add_argument("--in-repo", nargs='+', metavar='PACKAGE')
     ap.add_argument("--include-env-json", default=os.environ.get('ONLPM_OPTION_INCLUDE_ENV_JSON', None))
     ap.add_argument("--platform-manifest", metavar=('PACKAGE'))
+    ap.add_argument("--serve", metavar='SOCKET', nargs='?', const=os.environ.get('ONLPM_OPTION_SERVER', None), help="Serve requests from other onlpm invocations on this unix socket (default: $ONLPM_OPTION_SERVER).")
 
-    ops = ap.parse_args()
+    ops = ap.parse_args(argv)
 
     archlist = []
     for a in ops.arches:
@@ -1338,21 +2707,58 @@ if __name__ == '__main__':
     if ops.verbose or os.environ.get('ONLPM_VERBOSE', None):
         logger.setLevel(logging.DEBUG)
 
+    if ops.build_log:
+        # Make sure builds invoked through make(1) record as well.
+        os.environ['ONLPM_OPTION_BUILD_LOG'] = os.path.abspath(ops.build_log)
+        onlu.Profiler.enable(ops.build_log)
+    if not served:
+        onlu.trace_process()
+
     try:
 
-        pm = OnlPackageManager()
-        if ops.repo:
-            logger.debug("Setting repo as '%s'..." % ops.repo)
-            pm.set_repo(ops.repo, packagedir=ops.repo_package_dir)
+        if ops.serve:
+            OnlPackageServer(ops).serve(ops.serve)
+            return
+
+        if served and served.matches(ops):
+            pm = served.pm
+        else:
+            served = None
+            pm = OnlPackageManager()
+            if ops.repo:
+                logger.debug("Setting repo as '%s'..." % ops.repo)
+                pm.set_repo(ops.repo, packagedir=ops.repo_package_dir)
+
+        if ops.artifact_cache or ops.artifact_cache_shared:
+            pm.set_artifact_cache(ops.artifact_cache, ops.artifact_cache_shared, lookup=not ops.force)
 
         if ops.in_repo:
             for p in ops.in_repo:
                 print "%s: %s" % (p, p in pm.opr)
             sys.exit(0)
 
-        for pdir in ops.packagedirs:
+        #
+        # Queries for packages which are already in the repo
+        # are answered without loading the package groups.
+        #
+        FULL = [ 'list', 'list_all', 'list_tagged', 'list_platforms', 'pmake', 'build_report',
+                 'pkg_info', 'clean', 'build', 'require', 'link_file', 'link_dir', 'copy_file',
+                 'extract_dir', 'extract_dir_batch', 'contents', 'delete', 'force', 'rebuild_pkg_cache' ]
+        queried = [ q[0] for q in [ ops.find_file, ops.find_dir ] if q ]
+        if ops.platform_manifest:
+            queried.append(ops.platform_manifest)
+        repo_only = ((queried or ops.lookup or ops.lookup_batch) and
+                     not [ o for o in FULL if getattr(ops, o) ] and
+                     not [ p for p in queried if p not in pm.opr ])
+
+        if ops.rebuild_pkg_cache:
+            # Scripts may generate package declarations.
+            onlyaml.script_invalidate()
+
+        for pdir in ops.packagedirs if not (repo_only or served) else []:
             logger.debug("Loading package dir %s..." % pdir)
-            pm.load(pdir, usecache=not ops.no_pkg_cache, rebuildcache=ops.rebuild_pkg_cache, roCache=ops.ro_cache)
+            pm.load(pdir, usecache=not ops.no_pkg_cache, rebuildcache=ops.rebuild_pkg_cache, roCache=ops.ro_cache,
+                    jobs=ops.load_jobs)
             logger.debug("  Loaded package dir %s" % pdir)
 
         if ops.list_tagged:
@@ -1381,7 +2787,13 @@ if __name__ == '__main__':
             print pm
 
         if ops.pmake:
-            pm.pmake()
+            events = None
+            if ops.build_log and os.path.exists(ops.build_log):
+                events = onlu.Profiler.events(ops.build_log)
+            pm.pmake(events=events)
+
+        if ops.build_report:
+            print json.dumps(pm.build_report(onlu.Profiler.events(ops.build_report)), indent=2, sort_keys=True)
 
 
         pm.filter(subdir = ops.subdir, arches=ops.arches)
@@ -1407,26 +2819,35 @@ if __name__ == '__main__':
                     raise OnlPackageMissingError(p)
 
         if ops.build:
-            for p in ops.build:
-                if p in pm:
-                    pm.build(p)
-                else:
-                    raise OnlPackageMissingError(p)
+            if ops.build_parallel:
+                pm.build_parallel(ops.build, ops.build_parallel, force=ops.force)
+            else:
+                for p in ops.build:
+                    if p in pm:
+                        pm.build(p)
+                    else:
+                        raise OnlPackageMissingError(p)
 
-        if ops.require:
+        if ops.require and ops.build_parallel:
+            pm.require_all(ops.require, force=ops.force, build_missing=not ops.no_build_missing,
+                           skip_missing=ops.skip_missing, try_arches=ops.try_arches,
+                           jobs=ops.build_parallel)
+        elif ops.require:
             for p in ops.require:
                 pm.require(p, force=ops.force, build_missing=not ops.no_build_missing,
                            skip_missing=ops.skip_missing, try_arches=ops.try_arches)
 
         if ops.find_file:
             (p, f) = ops.find_file
-            pm.require(p, force=ops.force, build_missing=not ops.no_build_missing)
+            if not repo_only:
+                pm.require(p, force=ops.force, build_missing=not ops.no_build_missing)
             path = pm.opr.get_file(p, f)
             print path
 
         if ops.find_dir:
             (p, d) = ops.find_dir
-            pm.require(p, force=ops.force, build_missing=not ops.no_build_missing)
+            if not repo_only:
+                pm.require(p, force=ops.force, build_missing=not ops.no_build_missing)
             path = pm.opr.get_dir(p, d)
             print path
 
@@ -1465,6 +2886,21 @@ if __name__ == '__main__':
                 pm.require(p, force=ops.force, build_missing=not ops.no_build_missing)
                 pm.opr.extract(p, dstdir=d, prefix=False, force=True, remove_ts=True, sudo=ops.sudo)
 
+        if ops.extract_dir_batch:
+            entries = []
+            with (sys.stdin if ops.extract_dir_batch == '-' else open(ops.extract_dir_batch)) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        try:
+                            (p, d) = line.split(None, 1)
+                        except ValueError:
+                            raise OnlPackageError("Invalid extract manifest entry '%s'." % line)
+                        entries.append((p, d))
+            pm.require_all([ p for (p, d) in entries ], force=ops.force,
+                           build_missing=not ops.no_build_missing, jobs=ops.build_parallel or 1)
+            pm.opr.extract_batch(entries, force=True, remove_ts=True, sudo=ops.sudo)
+
         ############################################################
         #
         # Show the contents of the given packages.
@@ -1477,7 +2913,8 @@ if __name__ == '__main__':
 
 
         if ops.platform_manifest:
-            pm.require(ops.platform_manifest, force=ops.force, build_missing=not ops.no_build_missing)
+            if not repo_only:
+                pm.require(ops.platform_manifest, force=ops.force, build_missing=not ops.no_build_missing)
             path = pm.opr.get_file(ops.platform_manifest, 'manifest.json')
             if path:
                 m = json.load(open(path))
@@ -1497,6 +2934,13 @@ if __name__ == '__main__':
             for p in pm.opr.lookup_all(ops.lookup):
                 print p
 
+        if ops.lookup_batch:
+            print json.dumps(pm.opr.lookup_batch(ops.lookup_batch), indent=2, sort_keys=True)
+
     except (OnlPackageError, onlyaml.OnlYamlError), e:
         logger.error(e)
         sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/python2
+############################################################
+#
+# ONL Package Management Server Protocol
+#
+# Requests are forwarded to a running 'onlpm.py --serve'
+# over a unix socket as lines of JSON:
+#
+#   client: { "argv" : [...], "cwd" : ..., "env" : {...} }
+#   server: { "o" : data } | { "e" : data }   (stdout/stderr)
+#           { "x" : code }                    (exit status)
+#           { "fallback" : true }             (run it yourself)
+#
+# This module is imported before anything else in onlpm.py
+# and must stay cheap to load.
+#
+############################################################
+import os
+import sys
+import json
+import socket
+import threading
+
+# Strings are carried as latin-1 so any byte value survives.
+ENCODING = 'latin-1'
+
+def send(conn, **frame):
+    conn.sendall(json.dumps(frame, encoding=ENCODING) + "\n")
+
+def receive(conn):
+    """Read a single request from the connection."""
+    data = conn.makefile('r').readline()
+    request = json.loads(data)
+    encode = lambda s: s.encode(ENCODING)
+    return dict(argv=[ encode(a) for a in request['argv'] ],
+                cwd=encode(request['cwd']),
+                env=dict((encode(k), encode(v)) for (k, v) in request['env'].iteritems()))
+
+def forward(path, argv):
+    """Run the request on the server listening on path.
+
+    Exits with the request's exit status. Returns if there is no
+    server or the server declines the request, in which case the
+    caller should run it itself."""
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        send(conn, argv=argv, cwd=os.getcwd(), env=dict(os.environ))
+    except socket.error:
+        conn.close()
+        return
+
+    replied = False
+    for line in conn.makefile('r'):
+        frame = json.loads(line)
+        replied = True
+        if 'o' in frame:
+            sys.stdout.write(frame['o'].encode(ENCODING))
+            sys.stdout.flush()
+        elif 'e' in frame:
+            sys.stderr.write(frame['e'].encode(ENCODING))
+            sys.stderr.flush()
+        elif 'x' in frame:
+            sys.exit(frame['x'])
+        elif frame.get('fallback', False):
+            break
+
+    conn.close()
+    if replied and 'fallback' not in frame:
+        sys.stderr.write("The onlpm server at %s went away.\n" % path)
+        sys.exit(1)
+
+def run(conn, request, entry):
+    """Run a request in this (forked) process and exit.
+
+    Standard output and error are relayed to the client, followed by
+    the exit status of entry(argv)."""
+
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+
+    lock = threading.Lock()
+    def relay(fd, key):
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            with lock:
+                send(conn, **{ key : data.decode(ENCODING) })
+        os.close(fd)
+
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.close(null)
+
+    threads = []
+    for (fd, key) in [ (1, 'o'), (2, 'e') ]:
+        (r, w) = os.pipe()
+        os.dup2(w, fd)
+        os.close(w)
+        t = threading.Thread(target=relay, args=(r, key))
+        t.start()
+        threads.append(t)
+
+    code = 0
+    try:
+        try:
+            entry(request['argv'])
+        except SystemExit, e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                sys.stderr.write("%s\n" % e.code)
+                code = 1
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            code = 1
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.close(1)
+        os.close(2)
+        for t in threads:
+            t.join()
+        with lock:
+            send(conn, x=code)
+    finally:
+        os._exit(code)
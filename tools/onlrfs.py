@@ -20,12 +20,17 @@ import StringIO
 from collections import Iterable
 import onlyaml
 import onlu
-import fileinput
 import crypt
 import string
 import random
 import re
 import json
+import hashlib
+import time
+import stat
+import itertools
+import pipes
+import shlex
 
 logger = onlu.init_logging('onlrfs')
 
@@ -40,10 +45,191 @@ class OnlRfsError(Exception):
 
 
 
+class OnlRfsAccounts(object):
+    """The account databases (passwd, group, shadow and gshadow) of a root filesystem.
+
+    The databases are read once, edited in memory and written back by
+    save(), so accounts are managed without running useradd and friends
+    inside the (possibly foreign) root filesystem. New ids and entries
+    follow the Debian useradd and groupadd defaults."""
+
+    DATABASES = [ 'passwd', 'group', 'shadow', 'gshadow' ]
+
+    UID_MIN = 1000
+    UID_MAX = 60000
+    SYS_GID_MIN = 100
+    SYS_GID_MAX = 999
+
+    def __init__(self, dir_):
+        self.dir = dir_
+        self.db = dict((name, self.__read(name)) for name in self.DATABASES)
+        self.modified = set()
+
+    def __path(self, name):
+        return os.path.join(self.dir, 'etc', name)
+
+    def __read(self, name):
+        fname = self.__path(name)
+        if not os.path.exists(fname):
+            return []
+        if os.access(fname, os.R_OK):
+            data = open(fname).read()
+        else:
+            # The shadow databases are only readable by root.
+            data = subprocess.check_output(('sudo', 'cat', fname))
+        return [ line.split(':') for line in data.splitlines() if line ]
+
+    def __get(self, name, key):
+        for entry in self.db[name]:
+            if entry[0] == key:
+                return entry
+        return None
+
+    def __set(self, name, entry):
+        self.db[name] = [ e if e[0] != entry[0] else entry for e in self.db[name] ]
+        if self.__get(name, entry[0]) is not entry:
+            self.db[name].append(entry)
+        self.modified.add(name)
+
+    def __delete(self, name, key):
+        entries = [ e for e in self.db[name] if e[0] != key ]
+        if len(entries) != len(self.db[name]):
+            self.db[name] = entries
+            self.modified.add(name)
+
+    def __ids(self, name):
+        return set(int(e[2]) for e in self.db[name] if len(e) > 2 and e[2].isdigit())
+
+    @staticmethod
+    def __free(used, lo, hi, prefer=None, descending=False):
+        if prefer is not None and prefer not in used:
+            return prefer
+        for id_ in (range(hi, lo - 1, -1) if descending else range(lo, hi + 1)):
+            if id_ not in used:
+                return id_
+        raise OnlRfsError("No free ids between %d and %d." % (lo, hi))
+
+    @staticmethod
+    def __today():
+        return str(int(time.time()) / 86400)
+
+    def gid(self, group):
+        """The gid of a group given by name or number."""
+        if str(group).isdigit():
+            return int(group)
+        entry = self.__get('group', group)
+        if entry is None:
+            raise OnlRfsError("Group '%s' does not exist." % group)
+        return int(entry[2])
+
+    def user(self, username):
+        """The passwd entry of a user, as a list of fields, or None."""
+        return self.__get('passwd', username)
+
+    def groupadd(self, group, gid=None, unique=True, system=False, force=False, password=None):
+        if self.__get('group', group):
+            if force:
+                return
+            raise OnlRfsError("Group '%s' already exists." % group)
+
+        used = self.__ids('group')
+        if gid is not None and unique and int(gid) in used:
+            if not force:
+                raise OnlRfsError("Group id %s of group '%s' is not unique." % (gid, group))
+            gid = None
+        if gid is None:
+            if system:
+                gid = self.__free(used, self.SYS_GID_MIN, self.SYS_GID_MAX, descending=True)
+            else:
+                gid = self.__free(used, self.UID_MIN, self.UID_MAX)
+
+        self.__set('group', [ group, 'x', str(gid), '' ])
+        self.__set('gshadow', [ group, password or '!', '', '' ])
+
+    def useradd(self, username, uid=None, gid=None, epassword=None, shell=None, home=None, groups=None):
+        """Add a user. Returns its passwd entry.
+
+        Like useradd, a group named after the user is created unless
+        gid is given. epassword is the encrypted password, or '!' for a
+        locked account. The user has no password if it is None."""
+
+        if self.user(username):
+            raise OnlRfsError("User '%s' already exists." % username)
+
+        if uid is None:
+            uid = self.__free(self.__ids('passwd'), self.UID_MIN, self.UID_MAX)
+
+        if gid is not None:
+            gid = self.gid(gid)
+        elif self.__get('group', username):
+            gid = self.gid(username)
+        else:
+            gid = self.__free(self.__ids('group'), self.UID_MIN, self.UID_MAX, prefer=int(uid))
+            self.groupadd(username, gid)
+
+        for group in groups or []:
+            for name in [ 'group', 'gshadow' ]:
+                entry = self.__get(name, group)
+                if entry is None:
+                    raise OnlRfsError("Group '%s' does not exist." % group)
+                members = [ m for m in entry[3].split(',') if m ]
+                if username not in members:
+                    self.__set(name, entry[:3] + [ ','.join(members + [ username ]) ] + entry[4:])
+
+        entry = [ username, 'x', str(uid), str(gid), '', home or os.path.join('/home', username), shell or '/bin/sh' ]
+        self.__set('passwd', entry)
+        self.__set('shadow', [ username, epassword or '', self.__today(), '0', '99999', '7', '', '', '' ])
+        return entry
+
+    def userdel(self, username):
+        # Only the passwd and shadow entries are removed.
+        self.__delete('passwd', username)
+        self.__delete('shadow', username)
+
+    def password_set(self, username, epassword):
+        entry = self.__get('shadow', username)
+        if entry is None:
+            raise OnlRfsError("User '%s' does not exist." % username)
+        self.__set('shadow', [ username, epassword, self.__today() ] + entry[3:])
+
+    def shell_set(self, username, shell):
+        entry = self.user(username)
+        if entry is None:
+            raise OnlRfsError("User '%s' does not exist." % username)
+        self.__set('passwd', entry[:6] + [ shell ])
+
+    def save(self, plan):
+        """Add the modified databases to the given OnlRfsEditPlan.
+
+        Existing databases keep their permissions and ownership."""
+        for name in sorted(self.modified):
+            fname = self.__path(name)
+            if os.path.exists(fname):
+                st = os.stat(fname)
+                (mode, owner) = ('%o' % stat.S_IMODE(st.st_mode), '%d:%d' % (st.st_uid, st.st_gid))
+            else:
+                (mode, owner) = ('640' if name.endswith('shadow') else '644', '0:0')
+            plan.write(os.path.join('etc', name), "".join([ ":".join(e) + "\n" for e in self.db[name] ]),
+                       mode=mode, owner=owner)
+        self.modified = set()
+
+
 class OnlRfsSystemAdmin(object):
 
-    def __init__(self, chroot):
+    def __init__(self, chroot, plan=None):
+        """Administer the root filesystem at chroot.
+
+        If plan is given (an OnlRfsEditPlan) changes are added to the
+        plan rather than applied immediately."""
         self.chroot = chroot
+        self.plan = plan
+
+    def __edit(self, f):
+        """Call f with the plan, applying it unless it is ours."""
+        plan = self.plan or OnlRfsEditPlan(self.chroot)
+        f(plan)
+        if plan is not self.plan:
+            plan.apply()
 
     @staticmethod
     def gen_salt():
@@ -58,116 +244,167 @@ class OnlRfsSystemAdmin(object):
 
     @staticmethod
     def chmod(mode, file_):
-        onlu.execute("sudo chmod %s %s" % (mode, file_),
-                     ex=OnlRfsError("Could not change permissions (%s) on file %s" % (mode, file_)))
+        onlu.fileops().chmod(mode, file_,
+                             ex=OnlRfsError("Could not change permissions (%s) on file %s" % (mode, file_)))
 
     @staticmethod
     def chown(file_, ownspec):
-        onlu.execute("sudo chown %s %s" % (ownspec, file_),
-                     ex=OnlRfsError("Could not change ownership (%s) on file %s" % (ownspec, file_)))
+        onlu.fileops().chown(file_, ownspec,
+                             ex=OnlRfsError("Could not change ownership (%s) on file %s" % (ownspec, file_)))
 
     def userdel(self, username):
-        pf = os.path.join(self.chroot, 'etc/passwd')
-        sf = os.path.join(self.chroot, 'etc/shadow')
-
-        self.chmod("a+rwx", os.path.dirname(pf))
-        self.chmod("a+rw", pf);
-        self.chmod("a+rw", sf);
-
         # Can't use the userdel command because of potential uid 0 in-user problems while running ourselves
-        for line in fileinput.input(pf, inplace=True):
-            if not line.startswith('%s:' % username):
-                print line,
-        for line in fileinput.input(sf, inplace=True):
-            if not line.startswith('%s:' % username):
-                print line,
-
-        self.chmod("go-wx", pf);
-        self.chmod("go-wx", sf);
+        self.__edit(lambda plan: plan.accounts().userdel(username))
 
     def groupadd(self, group, gid=None, unique=True, system=False, force=False, password=None):
-        args = [ 'groupadd' ]
-        if force:
-            args.append("--force")
-        if system:
-            args.append("--system")
-        if not unique:
-            args.append("--non-unique")
-        if password:
-            args = args + [ '--password', password ]
-        if gid:
-            args = args + [ '--gid', str(gid) ]
-
-        args.append(group)
-
-        onlu.execute(args,
-                     chroot=self.chroot,
-                     ex=OnlRfsError("Adding group  '%s' failed." % group))
-
+        self.__edit(lambda plan: plan.accounts().groupadd(group, gid=gid, unique=unique, system=system,
+                                                          force=force, password=password))
         logger.info("added group %s", group)
 
     def useradd(self, username, uid=None, gid=None, password=None, shell='/bin/bash', home=None, groups=None, sudo=False, deleteFirst=True):
-        args = [ 'useradd', '--create-home' ]
-
-        if uid is not None:
-            args = args + [ '--non-unique', '--uid', str(uid) ]
-
-        if gid is not None:
-            args = args + [ '--gid', str(gid) ]
-
+        # As useradd, an empty password locks the account. Only None
+        # means no password (passwd -d).
+        epassword = None if password is None else '!'
         if password:
             epassword=crypt.crypt(password, '$1$%s$' % self.gen_salt());
-            args = args + ['-p', epassword ]
-
-        if shell:
-            args = args + [ '--shell', shell ]
-
-        if home:
-            args = args + [ '--home', home ]
-
-        if groups:
-            args = args + [ '--groups', ','.join(groups) ]
 
-        if deleteFirst:
-            self.userdel(username)
+        def add(plan):
+            accounts = plan.accounts()
+            if deleteFirst:
+                accounts.userdel(username)
+            entry = accounts.useradd(username, uid=uid, gid=gid, epassword=epassword,
+                                     shell=shell, home=home, groups=groups)
+            self.__create_home(plan, entry[5], "%s:%s" % (entry[2], entry[3]))
 
-        args.append(username)
-
-        onlu.execute(args,
-                     chroot=self.chroot,
-                     ex=OnlRfsError("Adding user '%s' failed." % username))
-
-        if password is None:
-            onlu.execute("passwd -d %s" % username,
-                         chroot=self.chroot,
-                         ex=OnlRfsError("Error deleting password for user '%s'" % username))
+            if sudo:
+                plan.write(os.path.join('etc/sudoers.d', username),
+                           "%s ALL=(ALL:ALL) NOPASSWD:ALL\n" % username,
+                           mode='0440', owner='root:root')
 
+        self.__edit(add)
         logger.info("user %s password %s", username, password)
 
-        if sudo:
-            sudoer = os.path.join(self.chroot, 'etc/sudoers.d', username)
-            self.chmod("777", os.path.dirname(sudoer))
-            with open(sudoer, "w") as f:
-                f.write("%s ALL=(ALL:ALL) NOPASSWD:ALL\n" % username);
-            self.chmod("0440", sudoer)
-            self.chown(sudoer, "root:root")
-            self.chmod("755", os.path.dirname(sudoer))
+    @staticmethod
+    def __create_home(plan, home, owner):
+        """Create a home directory from /etc/skel, as useradd --create-home."""
+        if os.path.exists(plan.path(home)):
+            return
+        plan.mkdir(home, '0755')
+        plan.chown(home, owner)
+        skel = plan.path('etc/skel')
+        for (root, dirs, files) in os.walk(skel):
+            dst = os.path.normpath(os.path.join(home, os.path.relpath(root, skel)))
+            for d in sorted(dirs):
+                plan.mkdir(os.path.join(dst, d))
+                plan.chown(os.path.join(dst, d), owner)
+            for f in sorted(files):
+                plan.copy(os.path.join(root, f), os.path.join(dst, f))
+                plan.chown(os.path.join(dst, f), owner)
 
     def user_password_set(self, username, password):
         logger.info("user %s password now %s", username, password)
         epassword=crypt.crypt(password, '$1$%s$' % self.gen_salt());
-        onlu.execute(['usermod', '-p', epassword, username],
-                     chroot=self.chroot,
-                     ex=OnlRfsError("Error setting password for user '%s'" % username))
+        self.__edit(lambda plan: plan.accounts().password_set(username, epassword))
 
     def user_shell_set(self, username, shell):
-        onlu.execute('chsh --shell %s %s' % (shell, username), chroot=self.chroot,
-                     ex=OnlRfsError("Error setting shell %s for user %s" % (shell, username)))
+        self.__edit(lambda plan: plan.accounts().shell_set(username, shell))
 
     def user_disable(self, username):
         self.user_shell_set(username, '/bin/false')
 
 
+class OnlRfsEditPlan(object):
+    """A batch of edits to a root filesystem.
+
+    File writes, copies, removals, permission changes and the commands
+    to run inside the root filesystem are collected in order, then
+    applied together by apply(). Consecutive file operations are sent
+    as one FileOps batch and consecutive commands run in a single
+    chroot invocation. Account changes are made through accounts() and
+    written last. Paths are relative to the root filesystem."""
+
+    def __init__(self, dir_):
+        self.dir = dir_
+        self.edits = []
+        self.__accounts = None
+
+    def accounts(self):
+        """The root filesystem's OnlRfsAccounts, saved by apply()."""
+        if self.__accounts is None:
+            self.__accounts = OnlRfsAccounts(self.dir)
+        return self.__accounts
+
+    def path(self, fname):
+        return os.path.join(self.dir, fname.lstrip('/'))
+
+    def __fileop(self, *op):
+        self.edits.append(('file', list(op)))
+
+    def mkdir(self, fname, mode=None):
+        self.__fileop('mkdir', self.path(fname), mode)
+
+    def write(self, fname, data, mode=None, owner=None):
+        dst = self.path(fname)
+        self.__fileop('mkdir', os.path.dirname(dst), None)
+        self.__fileop('write', dst, data, mode, False)
+        if owner:
+            self.__fileop('chown', dst, owner)
+
+    def copy(self, src, fname):
+        dst = self.path(fname)
+        self.__fileop('mkdir', os.path.dirname(dst), None)
+        self.__fileop('copy', os.path.abspath(src), dst)
+
+    def remove(self, fname):
+        self.__fileop('remove', self.path(fname))
+
+    def chmod(self, mode, fname):
+        self.__fileop('chmod', mode, self.path(fname))
+
+    def chown(self, fname, ownspec):
+        self.__fileop('chown', self.path(fname), ownspec)
+
+    def command(self, args, error):
+        """Run args inside the root filesystem. error describes a failure."""
+        self.edits.append(('command', (list(args), error)))
+
+    def describe(self):
+        """Return the planned edits, one per line."""
+        lines = []
+        for (kind, edit) in self.edits:
+            if kind == 'file':
+                lines.append(" ".join([ edit[0] ] + [ a if len(a) < 64 and '\n' not in a else '<%d bytes>' % len(a)
+                                                        for a in edit[1:] if type(a) is str ]))
+            else:
+                lines.append("chroot %s" % " ".join(edit[0]))
+        return "\n".join(lines)
+
+    def apply(self):
+        """Apply the planned edits and clear the plan."""
+        if self.__accounts:
+            self.__accounts.save(self)
+            self.__accounts = None
+
+        if not self.edits:
+            return
+
+        for line in self.describe().splitlines():
+            logger.debug("edit: %s" % line)
+
+        with onlu.Profiler('edits', dir=self.dir, count=len(self.edits)):
+            for (kind, edits) in itertools.groupby(self.edits, key=lambda e: e[0]):
+                edits = [ e[1] for e in edits ]
+                if kind == 'file':
+                    onlu.fileops().batch(edits,
+                                         ex=OnlRfsError("File operations in %s failed." % self.dir))
+                else:
+                    script = "\n".join([ "%s || { echo %s >&2; exit 1; }" % (" ".join([ pipes.quote(a) for a in args ]),
+                                                                           pipes.quote(error))
+                                         for (args, error) in edits ])
+                    onlu.execute([ '/bin/sh', '-c', script ], chroot=self.dir,
+                                 ex=OnlRfsError("Commands in %s failed." % self.dir))
+        self.edits = []
+
 
 class OnlMultistrapConfig(object):
     def __init__(self, config):
@@ -275,11 +512,11 @@ class OnlRfsContext(object):
 
             if self.rc:
                 if self.exists(self.resolvconf):
-                    onlu.execute("sudo mv %s %s" % (self.resolvconf, self.resolvconfb),
-                                 ex=OnlRfsError("Could not backup resolv.conf"))
+                    onlu.fileops().rename(self.resolvconf, self.resolvconfb,
+                                          ex=OnlRfsError("Could not backup resolv.conf"))
 
-                onlu.execute("sudo cp --remove-destination /etc/resolv.conf %s" % (self.resolvconf),
-                             ex=OnlRfsError("Could install new resolv.conf"))
+                onlu.fileops().copy("/etc/resolv.conf", self.resolvconf,
+                                    ex=OnlRfsError("Could install new resolv.conf"))
             return self
 
         except Exception, e:
@@ -292,11 +529,382 @@ class OnlRfsContext(object):
                      ex=OnlRfsError("Could not unmount dev and proc"))
 
         if self.rc:
-            onlu.execute("sudo rm %s" % (self.resolvconf),
-                         ex=OnlRfsError("Could not remove new resolv.conf"))
+            onlu.fileops().remove(self.resolvconf,
+                                  ex=OnlRfsError("Could not remove new resolv.conf"))
             if self.exists(self.resolvconfb):
-                onlu.execute("sudo mv %s %s" % (self.resolvconfb, self.resolvconf),
-                             ex=OnlRfsError("Could not restore resolv.conf"))
+                onlu.fileops().rename(self.resolvconfb, self.resolvconf,
+                                      ex=OnlRfsError("Could not restore resolv.conf"))
+
+def overlay_mount(lowerdir, upperdir, workdir, dir_):
+    """Mount an overlay filesystem on dir_."""
+    onlu.execute([ 'mount', '-t', 'overlay', 'overlay',
+                   '-o', 'lowerdir=%s,upperdir=%s,workdir=%s' % (lowerdir, upperdir, workdir),
+                   dir_ ], sudo=True,
+                 ex=OnlRfsError("Could not mount the overlay on %s." % dir_))
+
+
+class OnlRfsSnapshotCache(object):
+    """Configured base root filesystem snapshots.
+
+    A snapshot is the root filesystem as it is after multistrap and the
+    dpkg configuration of the packages from remote sources, stored under
+    the key computed by OnlRfsBuilder.snapshot_key(). Restoring a
+    snapshot replaces both steps; only the packages from the local
+    repositories are then installed before the ONL configuration runs.
+
+    Snapshots are restored with one of the following methods:
+
+      reflink  : A copy sharing its data blocks with the snapshot
+                 (btrfs, xfs). Falls back to 'copy' where unsupported.
+      copy     : A full copy.
+      overlay  : An overlayfs mount with the snapshot as the lower layer.
+                 The root filesystem stays mounted until it is rebuilt."""
+
+    METHODS = [ 'reflink', 'copy', 'overlay' ]
+
+    def __init__(self, root, method='reflink', keep=4):
+        if method not in self.METHODS:
+            raise OnlRfsError("Unknown snapshot method '%s'." % method)
+        self.root = os.path.abspath(root)
+        self.method = method
+        self.keep = keep
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def __path(self, key):
+        return os.path.join(self.root, key)
+
+    def __contains__(self, key):
+        return os.path.isdir(self.__path(key)) and os.path.exists(self.__path(key) + '.json')
+
+    @staticmethod
+    def __clone(src, dst, method):
+        # cp does not create missing parents (e.g. after make clean).
+        onlu.execute([ 'mkdir', '-p', os.path.dirname(os.path.abspath(dst)) ], sudo=True)
+        if method == 'reflink':
+            if onlu.execute([ 'cp', '-a', '--reflink=always', src, dst ], sudo=True) == 0:
+                return
+            logger.info("Reflinks are not supported here. Copying instead.")
+            onlu.execute([ 'rm', '-rf', dst ], sudo=True)
+            method = 'copy'
+        onlu.execute([ 'cp', '-a', src, dst ], sudo=True,
+                     ex=OnlRfsError("Could not copy %s to %s." % (src, dst)))
+
+    @staticmethod
+    def release(dir_):
+        """Remove a root filesystem, including any overlay mount."""
+        if os.path.ismount(dir_):
+            onlu.execute([ 'umount', dir_ ], sudo=True,
+                         ex=OnlRfsError("Could not unmount %s." % dir_))
+        for d in [ dir_, dir_ + '.upper', dir_ + '.work' ]:
+            if os.path.exists(d):
+                onlu.execute([ 'rm', '-rf', d ], sudo=True,
+                             ex=OnlRfsError("Could not remove %s." % d))
+
+    def restore(self, key, dir_):
+        """Restore the given snapshot into dir_. Returns False if there is none."""
+        if key is None or key not in self:
+            return False
+
+        logger.info("Restoring base root filesystem snapshot %s (%s)..." % (key, self.method))
+        snapshot = self.__path(key)
+        self.release(dir_)
+        if self.method == 'overlay':
+            for d in [ dir_, dir_ + '.upper', dir_ + '.work' ]:
+                onlu.execute([ 'mkdir', '-p', d ], sudo=True)
+            overlay_mount(snapshot, dir_ + '.upper', dir_ + '.work', dir_)
+        else:
+            self.__clone(snapshot, dir_, self.method)
+
+        # Most recently used snapshots are kept.
+        os.utime(snapshot + '.json', None)
+        return True
+
+    def store(self, key, dir_, meta):
+        """Store dir_ as the snapshot for the given key."""
+        if key is None:
+            return
+
+        logger.info("Storing base root filesystem snapshot %s..." % key)
+        tmp = self.__path('.tmp-%s-%d' % (key, os.getpid()))
+        self.__clone(dir_, tmp, 'reflink' if self.method in [ 'reflink', 'overlay' ] else 'copy')
+
+        if os.path.exists(self.__path(key)):
+            onlu.execute([ 'rm', '-rf', self.__path(key) ], sudo=True)
+        onlu.execute([ 'mv', tmp, self.__path(key) ], sudo=True,
+                     ex=OnlRfsError("Could not store snapshot %s." % key))
+        with open(self.__path(key) + '.json', "w") as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+
+        self.prune()
+
+    def prune(self):
+        """Remove all but the most recently used snapshots."""
+        keys = [ f[:-5] for f in os.listdir(self.root)
+                 if f.endswith('.json') and f[:-5] in self ]
+        keys.sort(key=lambda k: os.path.getmtime(self.__path(k) + '.json'), reverse=True)
+        for key in keys[self.keep:]:
+            logger.info("Removing snapshot %s..." % key)
+            os.unlink(self.__path(key) + '.json')
+            onlu.execute([ 'rm', '-rf', self.__path(key) ], sudo=True)
+
+
+class OnlRfsLayers(object):
+    """Content-keyed root filesystem layers.
+
+    Each build stage writes into its own overlayfs upper directory, on
+    top of the layers of the stages before it. The result is kept as a
+    layer under a key covering the stage's inputs and the keys of all
+    layers below it, so a change in one stage rebuilds only that stage
+    and the ones after it.
+
+    The first layer is built as a plain directory. mount() mounts the
+    final layer stack on the root filesystem directory with a writable
+    upper directory, where it can be archived or squashed as usual."""
+
+    def __init__(self, root, dir_, keep=64):
+        self.root = os.path.abspath(root)
+        self.dir = dir_
+        self.keep = keep
+        # Keys of the layers of this build, bottom first.
+        self.stack = []
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def __path(self, key):
+        return os.path.join(self.root, key)
+
+    def __lowerdir(self):
+        return ":".join([ self.__path(k) for k in reversed(self.stack) ])
+
+    def __key(self, name, inputs):
+        h = hashlib.sha1(self.stack[-1] if self.stack else '')
+        h.update(json.dumps([ name, inputs ], sort_keys=True, default=str))
+        return h.hexdigest()
+
+    def stage(self, name, inputs, build):
+        """Add the layer of a build stage.
+
+        inputs : Everything the stage depends on apart from the layers
+                 below it. If None, the stage is always built. This is
+                 only allowed for the first stage, since every layer
+                 above it would be rebuilt as well.
+        build  : Builds the stage. It is passed the directory to build in.
+
+        Returns True if the layer was built, False if it was reused."""
+
+        if inputs is None and self.stack:
+            raise OnlRfsError("The %s layer has no inputs." % name)
+
+        key = self.__key(name, inputs if inputs is not None else os.urandom(16).encode('hex'))
+        layer = self.__path(key)
+
+        if os.path.isdir(layer) and os.path.exists(layer + '.json'):
+            logger.info("Using cached %s layer %s." % (name, key))
+            os.utime(layer + '.json', None)
+            self.stack.append(key)
+            return False
+
+        logger.info("Building %s layer %s..." % (name, key))
+        tmp = self.__path('.tmp-%s-%d' % (key, os.getpid()))
+        onlu.execute([ 'rm', '-rf', tmp ], sudo=True)
+        try:
+            if not self.stack:
+                build(tmp)
+                onlu.execute([ 'mv', tmp, layer ], sudo=True,
+                             ex=OnlRfsError("Could not store the %s layer." % name))
+            else:
+                OnlRfsSnapshotCache.release(self.dir)
+                onlu.execute([ 'mkdir', '-p', self.dir, os.path.join(tmp, 'upper'), os.path.join(tmp, 'work') ], sudo=True)
+                overlay_mount(self.__lowerdir(), os.path.join(tmp, 'upper'), os.path.join(tmp, 'work'), self.dir)
+                try:
+                    build(self.dir)
+                finally:
+                    onlu.execute([ 'umount', self.dir ], sudo=True,
+                                 ex=OnlRfsError("Could not unmount %s." % self.dir))
+                onlu.execute([ 'mv', os.path.join(tmp, 'upper'), layer ], sudo=True,
+                             ex=OnlRfsError("Could not store the %s layer." % name))
+        finally:
+            onlu.execute([ 'rm', '-rf', tmp ], sudo=True)
+
+        with open(layer + '.json', "w") as f:
+            json.dump(dict(name=name, inputs=inputs, parent=self.stack[-1] if self.stack else None,
+                           time=time.time()), f, indent=2, sort_keys=True, default=str)
+        self.stack.append(key)
+        self.prune()
+        return True
+
+    def mount(self):
+        """Mount the layer stack on the root filesystem directory.
+
+        The directory stays mounted. It is released by the next build or
+        by OnlRfsSnapshotCache.release() (make clean)."""
+        OnlRfsSnapshotCache.release(self.dir)
+        onlu.execute([ 'mkdir', '-p', self.dir, self.dir + '.upper', self.dir + '.work' ], sudo=True)
+        overlay_mount(self.__lowerdir(), self.dir + '.upper', self.dir + '.work', self.dir)
+
+    def prune(self):
+        """Remove all but the most recently used layers."""
+        keys = [ f[:-5] for f in os.listdir(self.root)
+                 if f.endswith('.json') and os.path.isdir(self.__path(f[:-5])) ]
+        keys.sort(key=lambda k: os.path.getmtime(self.__path(k) + '.json'), reverse=True)
+        for key in keys[self.keep:]:
+            if key not in self.stack:
+                logger.info("Removing layer %s..." % key)
+                os.unlink(self.__path(key) + '.json')
+                onlu.execute([ 'rm', '-rf', self.__path(key) ], sudo=True)
+
+
+class OnlRfsImages(object):
+    """Root filesystem images (squashfs and cpio).
+
+    Options come from the Image section of the root filesystem
+    configuration and can be overridden on the command line:
+
+    Image:
+      squash:
+        compression: xz         # gzip, lzo, lz4, xz or zstd
+        block-size: 1M
+        processors: 4
+        level: 15               # -Xcompression-level (gzip, lzo and zstd)
+        options: -Xbcj x86      # Additional mksquashfs options
+      cpio:
+        compression: xz         # gzip, xz, zstd, lz4 or none
+        processors: 4
+        level: 9"""
+
+    SQUASH_COMPRESSORS = [ 'gzip', 'lzo', 'lz4', 'xz', 'zstd' ]
+    CPIO_COMPRESSORS = [ 'gzip', 'xz', 'zstd', 'lz4', 'none' ]
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.squash = dict(compression='gzip')
+        self.squash.update(config.get('squash', None) or {})
+        self.cpio = dict(compression='gzip')
+        self.cpio.update(config.get('cpio', None) or {})
+
+        for (options, compressors) in [ (self.squash, self.SQUASH_COMPRESSORS),
+                                        (self.cpio, self.CPIO_COMPRESSORS) ]:
+            if options['compression'] not in compressors:
+                raise OnlRfsError("Unsupported compression '%s'." % options['compression'])
+
+    def override(self, squash=None, cpio=None):
+        """Override options with those given (and not None)."""
+        for (options, overrides) in [ (self.squash, squash), (self.cpio, cpio) ]:
+            for (k, v) in (overrides or {}).iteritems():
+                if v is not None:
+                    options[k] = v
+
+    def squash_command(self, dir_, fname, options=None):
+        options = options or self.squash
+        cmd = [ 'mksquashfs', dir_, fname, '-no-progress', '-noappend',
+                '-comp', options['compression'] ]
+        if options.get('block-size'):
+            cmd += [ '-b', str(options['block-size']) ]
+        if options.get('processors'):
+            cmd += [ '-processors', str(options['processors']) ]
+        if options.get('level') is not None and options['compression'] in [ 'gzip', 'lzo', 'zstd' ]:
+            cmd += [ '-Xcompression-level', str(options['level']) ]
+        if options.get('options'):
+            cmd += str(options['options']).split()
+        return cmd
+
+    @staticmethod
+    def __which(name):
+        return any(os.access(os.path.join(p, name), os.X_OK)
+                   for p in os.getenv('PATH', '').split(os.pathsep))
+
+    def cpio_compressor(self, options=None):
+        """The command compressing the cpio archive from stdin to stdout."""
+        options = options or self.cpio
+        comp = options['compression']
+        processors = options.get('processors')
+        level = options.get('level')
+
+        if comp == 'none':
+            return 'cat'
+        if comp == 'gzip':
+            cmd = [ 'gzip', '-f' ]
+            if processors and processors != 1 and self.__which('pigz'):
+                cmd = [ 'pigz', '-f', '-p', str(processors) ]
+        elif comp == 'xz':
+            # The kernel only verifies crc32 checksums.
+            cmd = [ 'xz', '-c', '--check=crc32', '-T', str(processors or 0) ]
+        elif comp == 'zstd':
+            cmd = [ 'zstd', '-c', '-q', '-T%d' % (processors or 0) ]
+        elif comp == 'lz4':
+            # The kernel requires the legacy frame format.
+            cmd = [ 'lz4', '-c', '-l' ]
+        if level is not None:
+            cmd.append('-%s' % level)
+        return " ".join(cmd)
+
+    def cpio_command(self, dir_, fname, options=None):
+        return [ "%s/tools/scripts/make-cpio.sh" % os.getenv('ONL'), dir_, fname,
+                 self.cpio_compressor(options) ]
+
+    def build(self, dir_, squash=None, cpio=None):
+        """Build the requested images, concurrently."""
+        commands = []
+        if cpio:
+            commands.append(dict(args=self.cpio_command(dir_, cpio)))
+        if squash:
+            if os.path.exists(squash):
+                os.unlink(squash)
+            commands.append(dict(args=self.squash_command(dir_, squash), sudo=True))
+
+        with onlu.Profiler('images', cpio=cpio, squash=squash):
+            rv = onlu.execute_parallel(commands, jobs=len(commands)) if commands else []
+
+        if cpio and rv[0] != 0:
+            raise OnlRfsError("cpio creation failed.")
+        if squash and rv[-1] != 0:
+            if os.path.exists(squash):
+                os.unlink(squash)
+            raise OnlRfsError("Squash creation failed.")
+
+    def benchmark(self, dir_, compressors=None):
+        """Compare squashfs compressors on the given root filesystem.
+
+        Returns a list of dicts with the image size and the image build,
+        mount and full read times of each compressor. Images are read
+        with unsquashfs where they cannot be loop mounted."""
+
+        rv = []
+        for comp in compressors or self.SQUASH_COMPRESSORS:
+            options = dict(self.squash, compression=comp)
+            tmpdir = tempfile.mkdtemp(prefix='onlrfs-benchmark-')
+            image = os.path.join(tmpdir, 'rootfs.sqsh')
+            mnt = os.path.join(tmpdir, 'mnt')
+            os.mkdir(mnt)
+            result = dict(compression=comp, size=None, build=None, mount=None, read=None)
+            rv.append(result)
+            try:
+                logger.info("Benchmarking %s squashfs compression..." % comp)
+                start = time.time()
+                if onlu.execute(self.squash_command(dir_, image, options), sudo=True, passthrough=False) != 0:
+                    logger.warn("%s compression failed." % comp)
+                    continue
+                result['build'] = time.time() - start
+                result['size'] = os.path.getsize(image)
+
+                start = time.time()
+                if onlu.execute([ 'mount', '-t', 'squashfs', '-o', 'loop,ro', image, mnt ],
+                                sudo=True, passthrough=False) == 0:
+                    result['mount'] = time.time() - start
+                    start = time.time()
+                    onlu.execute("sudo sh -c 'tar -C %s -cf - . | cat >/dev/null'" % mnt)
+                    result['read'] = time.time() - start
+                    onlu.execute([ 'umount', mnt ], sudo=True)
+                else:
+                    start = time.time()
+                    onlu.execute([ 'unsquashfs', '-n', '-d', os.path.join(tmpdir, 'x'), image ],
+                                 sudo=True, passthrough=False)
+                    result['read'] = time.time() - start
+            finally:
+                onlu.execute([ 'rm', '-rf', tmpdir ], sudo=True)
+        return rv
+
 
 class OnlRfsBuilder(object):
 
@@ -312,6 +920,30 @@ class OnlRfsBuilder(object):
     QEMU_ARM64='/usr/bin/qemu-aarch64-static'
     BINFMT_PPC='/proc/sys/fs/binfmt_misc/qemu-ppc'
 
+    # Run in the root filesystem by dpkg_configure()
+    CONFIGURE_SCRIPT="""#!/bin/bash -ex
+/bin/echo -e "#!/bin/sh\\nexit 101" >/usr/sbin/policy-rc.d
+chmod +x /usr/sbin/policy-rc.d
+export DEBIAN_FRONTEND=noninteractive
+export DEBCONF_NONINTERACTIVE_SEEN=true
+echo "127.0.0.1 localhost" >/etc/hosts
+touch /etc/fstab
+echo "localhost" >/etc/hostname
+if [ -f /var/lib/dpkg/info/dash.preinst ]; then
+    /var/lib/dpkg/info/dash.preinst install
+fi
+if [ -f /usr/sbin/locale-gen ]; then
+    echo "en_US.UTF-8 UTF-8" >/etc/locale.gen
+    /usr/sbin/locale-gen
+    update-locale LANG=en_US.UTF-8
+fi
+
+dpkg --configure -a || true
+dpkg --configure -a # configure any packages that failed the first time and abort on failure.
+
+rm -f /usr/sbin/policy-rc.d
+    """
+
     def __init__(self, config, arch, **kwargs):
         self.kwargs = kwargs
         self.arch = arch
@@ -326,6 +958,9 @@ class OnlRfsBuilder(object):
         self.__load(config)
         self.__validate()
 
+        # Set when the root filesystem was already dpkg-configured.
+        self.configured = False
+
     def __load(self, config):
         if not os.path.exists(config):
             raise OnlRfsError("Configuration file '%s' does not exist." % config)
@@ -360,9 +995,165 @@ class OnlRfsBuilder(object):
     def msconfig(self, fname):
         return self.ms.generate_file(fname)
 
-    def multistrap(self, dir_):
-        msconfig = self.ms.generate_file()
+    @staticmethod
+    def __release_indexes(release, arch):
+        """The checksums of the binary package indexes listed in a Release file."""
+        rv = []
+        section = None
+        for line in release.splitlines():
+            if not line.startswith(' '):
+                section = line.rstrip(':')
+            elif section == 'SHA256':
+                fields = line.split()
+                if len(fields) == 3 and re.search(r'(^|/)binary-(%s|all)/Packages' % arch, fields[2]):
+                    rv.append(line.strip())
+        return "\n".join(sorted(rv))
+
+    def snapshot_key(self, ms=None):
+        """Return the snapshot key of the configured base root filesystem.
+
+        ms : The multistrap configuration (default: the full configuration).
+             Snapshots are made from the one returned by local_split().
+
+        The key covers the multistrap configuration, the dpkg configuration
+        and the packages available from every debootstrap source: the
+        binary package index checksums of remote sources and the package
+        files of local ones. Returns None if a remote source cannot be
+        checked."""
+
+        import urllib2
+
+        ms = ms or self.ms
+
+        h = hashlib.sha1()
+        h.update(str(ms))
+        h.update(self.arch)
+        h.update(self.CONFIGURE_SCRIPT)
+        h.update(onlu.file_hash(os.path.join(os.getenv('ONL'), 'tools', 'scripts', 'base-files.postinst')))
+
+        for name in ms.config['General']['debootstrap'].split():
+            section = ms.config[name]
+            source = section.get('source', '')
+            h.update("[%s]\n" % name)
+            if os.path.isdir(source):
+                for f in sorted(os.listdir(source)):
+                    st = os.stat(os.path.join(source, f))
+                    h.update("%s %d %d\n" % (f, st.st_size, st.st_mtime))
+            else:
+                url = "%s/dists/%s/Release" % (source.rstrip('/'), section.get('suite', ''))
+                try:
+                    release = urllib2.urlopen(url, timeout=60).read()
+                except (urllib2.URLError, IOError), e:
+                    logger.warn("Could not fetch %s (%s). The snapshot cache will not be used." % (url, e))
+                    return None
+                h.update(self.__release_indexes(release, self.arch))
+
+        return h.hexdigest()
+
+    @staticmethod
+    def __package_versions(dir_):
+        try:
+            return subprocess.check_output([ 'dpkg-query', '--admindir=%s' % os.path.join(dir_, 'var/lib/dpkg'),
+                                             '-W', '-f', '${Package} ${Version} ${Architecture}\n' ]).splitlines()
+        except (OSError, subprocess.CalledProcessError):
+            return None
 
+    @staticmethod
+    def __deb_depends(deb):
+        """The names of the packages a package file depends on (first alternatives)."""
+        try:
+            fields = subprocess.check_output([ 'dpkg-deb', '-f', deb, 'Pre-Depends', 'Depends' ])
+        except (OSError, subprocess.CalledProcessError):
+            raise OnlRfsError("Could not read the dependencies of %s." % deb)
+        rv = []
+        for line in fields.splitlines():
+            (_, _, value) = line.partition(':')
+            for dep in value.split(','):
+                name = dep.split('|')[0].split('(')[0].strip().split(':')[0]
+                if name:
+                    rv.append(name)
+        return rv
+
+    def local_split(self):
+        """Split the root filesystem packages by source.
+
+        Returns a multistrap configuration for the packages from remote
+        sources only, and the package files from the local repositories
+        (the debootstrap sources which are directories) which are needed
+        instead. The remote dependencies of the local packages are added
+        to the remote configuration, so multistrap resolves them as it
+        would for the full configuration."""
+
+        import copy
+
+        config = copy.deepcopy(self.ms.config)
+        general = config['General']
+
+        local = {}
+        sections = general['debootstrap'].split()
+        for name in sections:
+            source = config[name].get('source', '')
+            if os.path.isdir(source):
+                for f in sorted(os.listdir(source)):
+                    if f.endswith('.deb'):
+                        local[f.split('_')[0]] = os.path.join(source, f)
+                del config[name]
+        for entry in [ 'debootstrap', 'aptsources' ]:
+            general[entry] = " ".join([ name for name in general[entry].split() if name in config ])
+
+        requested = self.get_packages()
+        debs = {}
+        remote = []
+        pending = [ p for p in requested if p in local ]
+        while pending:
+            p = pending.pop()
+            if p not in debs:
+                debs[p] = local[p]
+                for dep in self.__deb_depends(local[p]):
+                    if dep in local:
+                        pending.append(dep)
+                    elif dep not in remote:
+                        remote.append(dep)
+
+        for name in config:
+            if 'packages' in config[name]:
+                v = config[name]['packages']
+                v = list(onlu.sflatten(v)) if type(v) is list else v.split()
+                v = [ p for p in v if p not in local ]
+                config[name]['packages'] = " ".join(v + [ d for d in remote if d not in v ])
+
+        return (OnlMultistrapConfig(config), [ debs[p] for p in sorted(debs) ])
+
+    LOCAL_INSTALL_SCRIPT="""#!/bin/bash -ex
+/bin/echo -e "#!/bin/sh\\nexit 101" >/usr/sbin/policy-rc.d
+chmod +x /usr/sbin/policy-rc.d
+export DEBIAN_FRONTEND=noninteractive
+export DEBCONF_NONINTERACTIVE_SEEN=true
+dpkg -i /tmp/onlrfs-local/*.deb
+rm -f /usr/sbin/policy-rc.d
+    """
+
+    def install_local(self, dir_, debs):
+        """Install and configure local package files in a configured root filesystem."""
+        if not debs:
+            return
+
+        logger.info("Installing %d local packages..." % len(debs))
+        tmp = os.path.join(dir_, 'tmp', 'onlrfs-local')
+        fileops = onlu.fileops()
+        fileops.remove(tmp)
+        fileops.mkdir(tmp)
+        fileops.batch([ [ 'copy', deb, tmp ] for deb in debs ] +
+                      [ [ 'write', os.path.join(tmp, 'install.sh'), self.LOCAL_INSTALL_SCRIPT, '0700', False ] ],
+                      ex=OnlRfsError("Could not copy the local packages."))
+        try:
+            with OnlRfsContext(dir_, resolvconf=False):
+                onlu.execute("sudo chroot %s /tmp/onlrfs-local/install.sh" % dir_,
+                             ex=OnlRfsError("Local package installation failed."))
+        finally:
+            fileops.remove(tmp)
+
+    def __scan_local_repos(self):
         # Optional local package updates
         if os.getenv("ONLRFS_NO_PACKAGE_SCAN") is None:
             for r in self.ms.localrepos:
@@ -370,9 +1161,10 @@ class OnlRfsBuilder(object):
                 if os.path.exists(os.path.join(r, 'Makefile')):
                     onlu.execute("make -C %s" % r)
 
-        if os.path.exists(dir_):
-            onlu.execute("sudo rm -rf %s" % dir_,
-                         ex=OnlRfsError("Could not remove target directory."))
+    def __multistrap(self, dir_, ms):
+        msconfig = ms.generate_file()
+
+        OnlRfsSnapshotCache.release(dir_)
 
         if onlu.execute("sudo %s -d %s -f %s" % (self.MULTISTRAP, dir_, msconfig)) == 100:
             raise OnlRfsError("Multistrap APT failure.")
@@ -380,43 +1172,52 @@ class OnlRfsBuilder(object):
         if os.getenv("MULTISTRAP_DEBUG"):
             raise OnlRfsError("Multistrap debug.")
 
+    def multistrap(self, dir_, snapshots=None):
+        """Create the base root filesystem with multistrap.
+
+        snapshots : An OnlRfsSnapshotCache. The packages from remote
+                    sources are then installed from a snapshot if it
+                    holds one for them, or else installed, dpkg-configured
+                    and stored in it. The packages from the local
+                    repositories are installed on top (see local_split())."""
+
+        # Populates the local repository list.
+        self.ms.generate_file()
+        self.__scan_local_repos()
+
+        if not snapshots:
+            self.__multistrap(dir_, self.ms)
+            return
+
+        (base, debs) = self.local_split()
+        key = self.snapshot_key(base)
+        if not snapshots.restore(key, dir_):
+            self.__multistrap(dir_, base)
+            with OnlRfsContext(dir_, resolvconf=False):
+                self.dpkg_configure(dir_)
+            snapshots.store(key, dir_, dict(arch=self.arch, time=time.time(),
+                                            multistrap=str(base),
+                                            packages=self.__package_versions(dir_)))
+        self.install_local(dir_, debs)
+        self.configured = True
+
 
     def dpkg_configure(self, dir_):
+        fileops = onlu.fileops()
         if self.arch == 'powerpc':
-            onlu.execute('sudo cp %s %s' % (self.QEMU_PPC, os.path.join(dir_, 'usr/bin')))
+            fileops.copy(self.QEMU_PPC, os.path.join(dir_, 'usr/bin'))
         if self.arch in [ 'armel', 'armhf' ]:
-            onlu.execute('sudo cp %s %s' % (self.QEMU_ARM, os.path.join(dir_, 'usr/bin')))
+            fileops.copy(self.QEMU_ARM, os.path.join(dir_, 'usr/bin'))
         if self.arch == 'arm64':
-            onlu.execute('sudo cp %s %s' % (self.QEMU_ARM64, os.path.join(dir_, 'usr/bin')))
+            fileops.copy(self.QEMU_ARM64, os.path.join(dir_, 'usr/bin'))
 
-        onlu.execute('sudo cp %s %s' % (os.path.join(os.getenv('ONL'), 'tools', 'scripts', 'base-files.postinst'),
-                                        os.path.join(dir_, 'var', 'lib', 'dpkg', 'info', 'base-files.postinst')));
+        fileops.copy(os.path.join(os.getenv('ONL'), 'tools', 'scripts', 'base-files.postinst'),
+                     os.path.join(dir_, 'var', 'lib', 'dpkg', 'info', 'base-files.postinst'))
 
         script = os.path.join(dir_, "tmp/configure.sh")
         with open(script, "w") as f:
             os.chmod(script, 0700)
-            f.write("""#!/bin/bash -ex
-/bin/echo -e "#!/bin/sh\\nexit 101" >/usr/sbin/policy-rc.d
-chmod +x /usr/sbin/policy-rc.d
-export DEBIAN_FRONTEND=noninteractive
-export DEBCONF_NONINTERACTIVE_SEEN=true
-echo "127.0.0.1 localhost" >/etc/hosts
-touch /etc/fstab
-echo "localhost" >/etc/hostname
-if [ -f /var/lib/dpkg/info/dash.preinst ]; then
-    /var/lib/dpkg/info/dash.preinst install
-fi
-if [ -f /usr/sbin/locale-gen ]; then
-    echo "en_US.UTF-8 UTF-8" >/etc/locale.gen
-    /usr/sbin/locale-gen
-    update-locale LANG=en_US.UTF-8
-fi
-
-dpkg --configure -a || true
-dpkg --configure -a # configure any packages that failed the first time and abort on failure.
-
-rm -f /usr/sbin/policy-rc.d
-    """)
+            f.write(self.CONFIGURE_SCRIPT)
 
         logger.info("dpkg-configure filesystem...")
 
@@ -426,245 +1227,359 @@ rm -f /usr/sbin/policy-rc.d
 
 
 
+    def __os_release(self, dir_):
+        os_release = os.path.join(dir_, 'etc', 'os-release')
+        if os.path.exists(os_release):
+            import shlex
+            contents = open(os_release).read()
+            return dict(token.split('=') for token in shlex.split(contents))
+        return {}
+
+    @staticmethod
+    def __input_hash(path):
+        """Hash a file or directory used by a configuration step, if it exists."""
+        if os.path.exists(path):
+            return onlu.path_hash(path)
+        return None
+
+    def configure_steps(self):
+        """Return the configuration steps as a list of (name, inputs) tuples.
+
+        Steps are run in order by configure_step(). The inputs of a step
+        identify everything it depends on apart from the root filesystem
+        itself: its configuration and the contents of the files it uses.
+
+        The run, update-rc.d, commands and options steps are identified
+        by their configuration only. Files their commands read outside
+        the root filesystem are not tracked, so a cached layer of such a
+        step is not rebuilt when only those files change."""
+
+        # os-release depends on nothing but the root filesystem.
+        steps = [ ('os-release', []) ]
+
+        Configure = self.config.get('Configure', None)
+        if not Configure:
+            return steps
+
+        options = Configure.get('options', {})
+        files = Configure.get('files', {})
+
+        for (name, inputs) in [
+            ('run', Configure.get('run', [])),
+            ('overlays', [ (o, self.__input_hash(o)) for o in Configure.get('overlays', []) ]),
+            ('update-rc.d', Configure.get('update-rc.d', [])),
+            ('scripts', [ (s, self.__input_hash(s.split()[0])) for s in Configure.get('scripts', []) ]),
+            ('commands', Configure.get('commands', [])),
+            ('users', [ Configure.get('groups', {}), Configure.get('users', {}) ]
+                      if Configure.get('groups') or Configure.get('users') else None),
+            ('options', options),
+            ('manifests', [ (mf, fields,
+                             self.__input_hash(fields['version']),
+                             self.__input_hash(fields['platforms']))
+                            for (mf, fields) in sorted(Configure.get('manifests', {}).iteritems()) ]),
+            ('files', [ [ (f, v, self.__input_hash(v)) for (f, v) in sorted(files.get('add', {}).iteritems()) ],
+                        files.get('remove', []) ]
+                      if files.get('add') or files.get('remove') else None),
+            ('issue', Configure.get('issue')),
+            ]:
+            # The options step has defaults which apply even without options.
+            if inputs or name == 'options':
+                steps.append((name, inputs))
+
+        return steps
+
+    def configure_step(self, dir_, name):
+        """Run a single configuration step (see configure_steps()).
+
+        File and account changes and chroot commands are collected in an
+        OnlRfsEditPlan and applied together at the end of the step."""
+
+        plan = OnlRfsEditPlan(dir_)
+        self.__configure_step(dir_, name, plan)
+        plan.apply()
+
+    def __configure_step(self, dir_, name, plan):
+
+        Configure = self.config.get('Configure', None) or {}
+        options = Configure.get('options', {})
+        ua = OnlRfsSystemAdmin(dir_, plan)
+
+        if name == 'os-release':
+            if os.path.exists(os.path.join(dir_, 'etc', 'os-release')):
+                # Convert /etc/os-release to /etc/os-release.json
+                plan.write('etc/os-release.json', json.dumps(self.__os_release(dir_)))
+
+        elif name == 'run':
+            for cmd in Configure.get('run', []):
+                plan.command(shlex.split(cmd), "run command '%s' failed" % cmd)
+
+        elif name == 'overlays':
+            for overlay in Configure.get('overlays', []):
+                logger.info("Overlay %s..." % overlay)
+                onlu.execute('tar -C %s -c --exclude "*~" . | sudo tar -C %s -x -v --no-same-owner' % (overlay, dir_),
+                             ex=OnlRfsError("Overlay '%s' failed." % overlay))
+
+        elif name == 'update-rc.d':
+            for update in Configure.get('update-rc.d', []):
+                plan.command([ '/usr/sbin/update-rc.d' ] + shlex.split(update),
+                             "update-rc.d %s failed." % update)
+
+        elif name == 'scripts':
+            for script in Configure.get('scripts', []):
+                logger.info("Configuration script %s..." % script)
+                onlu.execute("sudo %s %s" % (script, dir_),
+                             ex=OnlRfsError("script '%s' failed." % script))
+
+        elif name == 'commands':
+            for command in Configure.get('commands', []):
+                if '__rfs__' in command:
+                    command = command % dict(__rfs__=dir_)
+                logger.info("Configuration command '%s'..." % command)
+                onlu.execute(command,
+                             ex=OnlRfsError("Command '%s' failed." % command))
+
+        elif name == 'users':
+            for (group, values) in Configure.get('groups', {}).iteritems():
+                ua.groupadd(group=group, **values if values else {})
+
+            for (user, values) in Configure.get('users', {}).iteritems():
+                if user == 'root':
+                    if 'password' in values:
+                        ua.user_password_set(user, values['password'])
+                else:
+                    ua.useradd(username=user, **values)
+
+        elif name == 'options':
+            if options.get('clean', False):
+                logger.info("Cleaning Filesystem...")
+                onlu.execute('sudo chroot %s /usr/bin/apt-get clean' % dir_)
+                onlu.execute('sudo chroot %s /usr/sbin/localepurge' % dir_ )
+                onlu.execute('sudo chroot %s find /usr/share/doc -type f -not -name asr.json -delete' % dir_)
+                onlu.execute('sudo chroot %s find /usr/share/man -type f -delete' % dir_)
+
+            if 'PermitRootLogin' in options:
+                config = 'etc/ssh/sshd_config'
+                lines = []
+                for line in open(plan.path(config)).readlines():
+                    if line.startswith('PermitRootLogin'):
+                        v = options['PermitRootLogin']
+                        logger.info("Setting PermitRootLogin to %s" % v)
+                        line = 'PermitRootLogin %s\n' % v
+                    lines.append(line)
+                plan.write(config, "".join(lines), mode='644')
+
+            if not options.get('securetty', True):
+                if os.path.exists(plan.path('etc/securetty')):
+                    logger.info("Removing %s" % plan.path('etc/securetty'))
+                    plan.remove('etc/securetty')
+
+            if os.path.exists(plan.path('etc/inittab')):
+                f = 'etc/inittab'
+                original = open(plan.path(f)).readlines()
+                lines = list(original)
+
+                if not options.get('ttys', False):
+                    logger.info("Clearing %s ttys..." % plan.path(f))
+                    lines = [ "#" + line if re.match("^[123456]:.*", line) else line for line in lines ]
+
+                if options.get('console', True):
+                    logger.info('Configuring Console Access in %s' % plan.path(f))
+                    lines.append("T0:23:respawn:/sbin/pgetty\n")
+
+                if lines != original:
+                    plan.write(f, "".join(lines))
+
+            if options.get('asr', None):
+                asropts = options.get('asr')
+                logger.info("Gathering ASR documentation...")
+                sys.path.append("%s/sm/infra/tools" % os.getenv('ONL'))
+                import asr
+                asro = asr.AimSyslogReference()
+                asro.merge(dir_)
+                asrf = os.path.join(dir_, asropts['file'])
+                OnlRfsSystemAdmin.chmod('777', os.path.dirname(asrf))
+                asro.format(os.path.join(dir_, asropts['file']), fmt=asropts['format'])
+
+        elif name == 'manifests':
+            for (mf, fields) in Configure.get('manifests', {}).iteritems():
+                logger.info("Configuring manifest %s..." % mf)
+                md = {}
+                md['version'] = json.load(open(fields['version']))
+                md['arch'] = self.arch
+                md['os-release'] = {}
+                if os.path.exists(os.path.join(dir_, 'etc', 'os-release.json')):
+                    md['os-release'] = json.load(open(os.path.join(dir_, 'etc', 'os-release.json')))
+
+                if os.path.exists(fields['platforms']):
+                    md['platforms'] = yaml.load(open(fields['platforms']))
+                else:
+                    md['platforms'] = fields['platforms'].split(',')
+
+                for (k, v) in fields.get('keys', {}).iteritems():
+                    if k in md:
+                        md[k].update(v)
+                    else:
+                        md[k] = v
+
+                plan.write(mf, json.dumps(md, indent=2), mode='a-w')
+
+        elif name == 'files':
+            for (fname, v) in Configure.get('files', {}).get('add', {}).iteritems():
+                if os.path.exists(v):
+                    plan.copy(v, fname)
+                else:
+                    plan.write(fname, "%s\n" % v)
+
+            for fname in Configure.get('files', {}).get('remove', []):
+                if os.path.exists(plan.path(fname)):
+                    plan.remove(fname)
+
+        elif name == 'issue':
+            if Configure.get('issue'):
+                issue = Configure.get('issue')
+                plan.write("etc/issue", "%s\n\n" % issue, mode='a-w')
+                plan.write("etc/issue.net", "%s\n" % issue, mode='a-w')
+
+        else:
+            raise OnlRfsError("Unknown configuration step '%s'." % name)
+
     def configure(self, dir_):
 
-        if not os.getenv('NO_DPKG_CONFIGURE'):
+        if not os.getenv('NO_DPKG_CONFIGURE') and not self.configured:
             with OnlRfsContext(dir_, resolvconf=False):
                 self.dpkg_configure(dir_)
 
         with OnlRfsContext(dir_):
-            os_release = os.path.join(dir_, 'etc', 'os-release')
-            os_release_dict = {}
-            if os.path.exists(os_release):
-                # Convert /etc/os-release to /etc/os-release.json
-                import shlex
-                contents = open(os_release).read()
-                os_release_dict = dict(token.split('=') for token in shlex.split(contents))
-                ua = OnlRfsSystemAdmin(dir_)
-                ua.chmod('a+rwx', os.path.dirname(os_release))
-                with open(os.path.join(os.path.dirname(os_release), 'os-release.json'), "w") as f:
-                    f.write(json.dumps(os_release_dict))
-                ua.chmod('0755', os.path.dirname(os_release))
-
-            Configure = self.config.get('Configure', None)
-            if Configure:
-
-                for cmd in Configure.get('run', []):
-                    onlu.execute("sudo chroot %s %s" % (dir_, cmd),
-                                 ex=OnlRfsError("run command '%s' failed" % cmd))
-
-                for overlay in Configure.get('overlays', []):
-                    logger.info("Overlay %s..." % overlay)
-                    onlu.execute('tar -C %s -c --exclude "*~" . | sudo tar -C %s -x -v --no-same-owner' % (overlay, dir_),
-                                 ex=OnlRfsError("Overlay '%s' failed." % overlay))
-
-                for update in Configure.get('update-rc.d', []):
-                    onlu.execute("sudo chroot %s /usr/sbin/update-rc.d %s" % (dir_, update),
-                                 ex=OnlRfsError("update-rc.d %s failed." % (update)))
-
-                for script in Configure.get('scripts', []):
-                    logger.info("Configuration script %s..." % script)
-                    onlu.execute("sudo %s %s" % (script, dir_),
-                                 ex=OnlRfsError("script '%s' failed." % script))
-
-
-                for command in Configure.get('commands', []):
-                    if '__rfs__' in command:
-                        command = command % dict(__rfs__=dir_)
-                    logger.info("Configuration command '%s'..." % command)
-                    onlu.execute(command,
-                                 ex=OnlRfsError("Command '%s' failed." % command))
-
-
-                ua = OnlRfsSystemAdmin(dir_)
-                for (group, values) in Configure.get('groups', {}).iteritems():
-                    ua.groupadd(group=group, **values if values else {})
-
-                for (user, values) in Configure.get('users', {}).iteritems():
-                    if user == 'root':
-                        if 'password' in values:
-                            ua.user_password_set(user, values['password'])
-                    else:
-                        ua.useradd(username=user, **values)
-
-
-                options = Configure.get('options', {})
-                if options.get('clean', False):
-                    logger.info("Cleaning Filesystem...")
-                    onlu.execute('sudo chroot %s /usr/bin/apt-get clean' % dir_)
-                    onlu.execute('sudo chroot %s /usr/sbin/localepurge' % dir_ )
-                    onlu.execute('sudo chroot %s find /usr/share/doc -type f -not -name asr.json -delete' % dir_)
-                    onlu.execute('sudo chroot %s find /usr/share/man -type f -delete' % dir_)
-
-                if 'PermitRootLogin' in options:
-                    config = os.path.join(dir_, 'etc/ssh/sshd_config')
-                    ua.chmod('a+rw', config)
-                    lines = open(config).readlines()
-                    with open(config, "w") as f:
-                        for line in lines:
-                            if line.startswith('PermitRootLogin'):
-                                v = options['PermitRootLogin']
-                                logger.info("Setting PermitRootLogin to %s" % v)
-                                f.write('PermitRootLogin %s\n' % v)
-                            else:
-                                f.write(line)
-                    ua.chmod('644', config)
-
-                if not options.get('securetty', True):
-                    f = os.path.join(dir_, 'etc/securetty')
-                    if os.path.exists(f):
-                        logger.info("Removing %s" % f)
-                        onlu.execute('sudo rm %s' % f,
-                                     ex=OnlRfsError('Could not remove file %s' % f))
-
-                if os.path.exists(os.path.join(dir_, 'etc/inittab')):
-                    if not options.get('ttys', False):
-                        f = os.path.join(dir_, 'etc/inittab')
-                        ua.chmod('a+w', f)
-                        ua.chmod('a+w', os.path.dirname(f))
-
-                        logger.info("Clearing %s ttys..." % f)
-                        for line in fileinput.input(f, inplace=True):
-                            if re.match("^[123456]:.*", line):
-                               line = "#" + line
-                            print line,
-
-                        ua.chmod('go-w', f)
-                        ua.chmod('go-w', os.path.dirname(f))
-
-                    if options.get('console', True):
-                        logger.info('Configuring Console Access in %s' % f)
-                        f = os.path.join(dir_, 'etc/inittab')
-                        ua.chmod('a+w', f)
-                        ua.chmod('a+w', os.path.dirname(f))
-                        with open(f, 'a') as h:
-                            h.write("T0:23:respawn:/sbin/pgetty\n")
-                        ua.chmod('go-w', f)
-                        ua.chmod('go-w', os.path.dirname(f))
-
-                if options.get('asr', None):
-                    asropts = options.get('asr')
-                    logger.info("Gathering ASR documentation...")
-                    sys.path.append("%s/sm/infra/tools" % os.getenv('ONL'))
-                    import asr
-                    asro = asr.AimSyslogReference()
-                    asro.merge(dir_)
-                    asrf = os.path.join(dir_, asropts['file'])
-                    OnlRfsSystemAdmin.chmod('777', os.path.dirname(asrf))
-                    asro.format(os.path.join(dir_, asropts['file']), fmt=asropts['format'])
-
-                for (mf, fields) in Configure.get('manifests', {}).iteritems():
-                    logger.info("Configuring manifest %s..." % mf)
-                    if mf.startswith('/'):
-                        mf = mf[1:]
-                    mname = os.path.join(dir_, mf)
-                    onlu.execute("sudo mkdir -p %s" % os.path.dirname(mname))
-                    onlu.execute("sudo touch %s" % mname)
-                    onlu.execute("sudo chmod a+w %s" % mname)
-                    md = {}
-                    md['version'] = json.load(open(fields['version']))
-                    md['arch'] = self.arch
-                    md['os-release'] = os_release_dict
-
-                    if os.path.exists(fields['platforms']):
-                        md['platforms'] = yaml.load(open(fields['platforms']))
-                    else:
-                        md['platforms'] = fields['platforms'].split(',')
-
-                    for (k, v) in fields.get('keys', {}).iteritems():
-                        if k in md:
-                            md[k].update(v)
-                        else:
-                            md[k] = v
-
-                    with open(mname, "w") as f:
-                        json.dump(md, f, indent=2)
-                    onlu.execute("sudo chmod a-w %s" % mname)
-
-                for (fname, v) in Configure.get('files', {}).get('add', {}).iteritems():
-                    if fname.startswith('/'):
-                        fname = fname[1:]
-                    dst = os.path.join(dir_, fname)
-                    onlu.execute("sudo mkdir -p %s" % os.path.dirname(dst))
-                    onlu.execute("sudo touch %s" % dst)
-                    onlu.execute("sudo chmod a+w %s" % dst)
-                    if os.path.exists(v):
-                        shutil.copy(v, dst)
-                    else:
-                        with open(dst, "w") as f:
-                            f.write("%s\n" % v)
-
-                for fname in Configure.get('files', {}).get('remove', []):
-                    if fname.startswith('/'):
-                        fname = fname[1:]
-                    f = os.path.join(dir_, fname)
-                    if os.path.exists(f):
-                        onlu.execute("sudo rm -rf %s" % f)
-
-                if Configure.get('issue'):
-                    issue = Configure.get('issue')
-                    fn = os.path.join(dir_, "etc/issue")
-                    onlu.execute("sudo chmod a+w %s" % fn)
-                    with open(fn, "w") as f:
-                        f.write("%s\n\n" % issue)
-                    onlu.execute("sudo chmod a-w %s" % fn)
-
-                    fn = os.path.join(dir_, "etc/issue.net")
-                    onlu.execute("sudo chmod a+w %s" % fn)
-                    with open(fn, "w") as f:
-                        f.write("%s\n" % issue)
-                    onlu.execute("sudo chmod a-w %s" % fn)
+            for (name, inputs) in self.configure_steps():
+                self.configure_step(dir_, name)
+
+
+    def package_inputs(self, packages):
+        """Return the package files of the given packages, building them if necessary."""
 
+        ONLPM = "%s/tools/onlpm.py" % os.getenv('ONL')
+
+        pkgs = [ pkg for pspec in packages for pkg in pspec.split(',') ]
+        onlu.execute((ONLPM, '--require',) + tuple(pkgs),
+                     ex=OnlRfsError("Failed to build %s." % " ".join(pkgs)))
+        found = json.loads(subprocess.check_output((ONLPM, '--lookup-batch',) + tuple(pkgs)))
+        return [ (pkg, [ (f, os.path.getsize(f), os.path.getmtime(f)) for f in found.get(pkg, []) ])
+                 for pkg in pkgs ]
+
+    def build_layers(self, dir_, layers, multistrap=True, configure=True, update=None, install=None):
+        """Build the root filesystem as a stack of layers (see OnlRfsLayers).
+
+        The base system (multistrap and dpkg configuration), each
+        configuration step, the updates and the installs are separate
+        layers. Without multistrap the existing contents of dir_ are
+        the base system, and it is always rebuilt."""
+
+        # With dpkg configuration the packages from the local repositories
+        # are a separate layer, so rebuilding them keeps the base layer.
+        (ms, debs) = (self.ms, [])
+        if multistrap:
+            self.ms.generate_file()
+            self.__scan_local_repos()
+            if configure:
+                (ms, debs) = self.local_split()
+
+        def base(d):
+            if multistrap:
+                self.__multistrap(d, ms)
+            else:
+                onlu.execute([ 'mkdir', '-p', d ], sudo=True)
+                onlu.execute([ 'cp', '-a', os.path.join(dir_, '.'), d ], sudo=True,
+                             ex=OnlRfsError("Could not copy %s." % dir_))
+            if configure:
+                with OnlRfsContext(d, resolvconf=False):
+                    self.dpkg_configure(d)
+
+        with onlu.Profiler('multistrap'):
+            key = self.snapshot_key(ms) if multistrap else None
+            layers.stage('base', [ key, configure ] if key else None, base)
+            if debs:
+                layers.stage('local', [ (os.path.basename(f), onlu.file_hash(f)) for f in debs ],
+                             lambda d: self.install_local(d, debs))
+
+        if configure:
+            for (name, inputs) in self.configure_steps():
+                def step(d, name=name):
+                    with OnlRfsContext(d):
+                        self.configure_step(d, name)
+                with onlu.Profiler('configure', step=name):
+                    layers.stage('configure %s' % name, inputs, step)
+
+        if update:
+            with onlu.Profiler('update'):
+                layers.stage('update', self.package_inputs(update), lambda d: self.update(d, update))
+
+        if install:
+            with onlu.Profiler('install'):
+                layers.stage('install', self.package_inputs(install), lambda d: self.install(d, install))
+
+        layers.mount()
 
     def update(self, dir_, packages):
 
         ONLPM = "%s/tools/onlpm.py" % os.getenv('ONL')
 
+        pkgs = [ pkg for pspec in packages for pkg in pspec.split(',') ]
+
+        if not pkgs:
+            return
+
         with OnlRfsContext(dir_):
-            for pspec in packages:
-                for pkg in pspec.split(','):
+            # Extract all packages with a single onlpm invocation.
+            with tempfile.NamedTemporaryFile(prefix="update-", suffix=".manifest") as manifest:
+                for pkg in pkgs:
                     logger.info("updating %s into %s", pkg, dir_)
-                    cmd = (ONLPM, '--verbose',
-                           '--sudo',
-                           '--extract-dir', pkg, dir_,)
-                    onlu.execute(cmd,
-                                 ex=OnlRfsError("update of %s failed" % pkg))
+                    manifest.write("%s %s\n" % (pkg, dir_))
+                manifest.flush()
+                cmd = (ONLPM, '--verbose',
+                       '--sudo',
+                       '--extract-dir-batch', manifest.name,)
+                onlu.execute(cmd,
+                             ex=OnlRfsError("update of %s failed" % " ".join(pkgs)))
 
     def install(self, dir_, packages):
 
         ONLPM = "%s/tools/onlpm.py" % os.getenv('ONL')
 
+        pkgs = [ pkg for pspec in packages for pkg in pspec.split(',') ]
+
+        if not pkgs:
+            return
+
         with OnlRfsContext(dir_):
-            for pspec in packages:
-                for pkg in pspec.split(','):
-
-                    cmd = (ONLPM, '--lookup', pkg,)
-                    try:
-                        buf = subprocess.check_output(cmd)
-                    except subprocess.CalledProcessError as ex:
-                        logger.error("cannot find %s", pkg)
-                        raise ValueError("update failed")
-
-                    if not buf.strip():
-                        raise ValueError("cannot find %s" % pkg)
-                    src = buf.splitlines(False)[0]
-                    d, b = os.path.split(src)
-                    dst = os.path.join(dir_, "tmp", b)
-                    shutil.copy2(src, dst)
-                    src2 = os.path.join("/tmp", b)
-
-                    logger.info("installing %s into %s", pkg, dir_)
-                    cmd = ('/usr/bin/rfs-dpkg', '-i', src2,)
-                    onlu.execute(cmd,
-                                 chroot=dir_,
-                                 ex=OnlRfsError("install of %s failed" % pkg))
-
-                    name, _, _ = pkg.partition(':')
-                    logger.info("updating dependencies for %s", pkg)
-                    cmd = ('/usr/bin/rfs-apt-get', '-f', 'install', name,)
-                    onlu.execute(cmd,
-                                 chroot=dir_,
-                                 ex=OnlRfsError("install of %s failed" % pkg))
+            # Look up all packages with a single onlpm invocation.
+            cmd = (ONLPM, '--lookup-batch',) + tuple(pkgs)
+            try:
+                found = json.loads(subprocess.check_output(cmd))
+            except subprocess.CalledProcessError as ex:
+                logger.error("cannot find %s", " ".join(pkgs))
+                raise ValueError("update failed")
+
+            for pkg in pkgs:
+                if not found.get(pkg):
+                    raise ValueError("cannot find %s" % pkg)
+                src = str(found[pkg][0])
+                d, b = os.path.split(src)
+                dst = os.path.join(dir_, "tmp", b)
+                shutil.copy2(src, dst)
+                src2 = os.path.join("/tmp", b)
+
+                logger.info("installing %s into %s", pkg, dir_)
+                cmd = ('/usr/bin/rfs-dpkg', '-i', src2,)
+                onlu.execute(cmd,
+                             chroot=dir_,
+                             ex=OnlRfsError("install of %s failed" % pkg))
+
+                name, _, _ = pkg.partition(':')
+                logger.info("updating dependencies for %s", pkg)
+                cmd = ('/usr/bin/rfs-apt-get', '-f', 'install', name,)
+                onlu.execute(cmd,
+                             chroot=dir_,
+                             ex=OnlRfsError("install of %s failed" % pkg))
 
 
 if __name__ == '__main__':
@@ -679,9 +1594,23 @@ if __name__ == '__main__':
     ap.add_argument("--msconfig")
     ap.add_argument("--multistrap-only", action='store_true')
     ap.add_argument("--no-multistrap", action='store_true')
+    ap.add_argument("--snapshot-cache", metavar='DIR', default=os.getenv('ONLRFS_SNAPSHOT_CACHE'),
+                    help="Reuse configured base root filesystems from this directory.")
+    ap.add_argument("--layer-cache", metavar='DIR', default=os.getenv('ONLRFS_LAYER_CACHE'),
+                    help="Build the root filesystem as a stack of cached overlay layers kept in this directory.")
+    ap.add_argument("--snapshot-method", choices=OnlRfsSnapshotCache.METHODS,
+                    default=os.getenv('ONLRFS_SNAPSHOT_METHOD', 'reflink'),
+                    help="How snapshots are restored (default: reflink).")
     ap.add_argument("--cpio")
     ap.add_argument("--squash")
     ap.add_argument("--enable-root")
+    ap.add_argument("--squash-compression", choices=OnlRfsImages.SQUASH_COMPRESSORS)
+    ap.add_argument("--squash-block-size", metavar='SIZE')
+    ap.add_argument("--squash-processors", type=int, metavar='N')
+    ap.add_argument("--cpio-compression", choices=OnlRfsImages.CPIO_COMPRESSORS)
+    ap.add_argument("--cpio-processors", type=int, metavar='N')
+    ap.add_argument("--image-benchmark", nargs='*', metavar='COMPRESSION',
+                    help="Report the squashfs image size and mount and read times of each compression (default: all).")
 
     ap.add_argument("--no-configure", action='store_true')
     ap.add_argument("--update", action='append')
@@ -689,6 +1618,8 @@ if __name__ == '__main__':
 
     ops = ap.parse_args()
 
+    onlu.trace_process()
+
     if ops.enable_root:
         #
         # Fixme -- this should all be rearranged to naturally support
@@ -724,11 +1655,19 @@ if __name__ == '__main__':
         if ops.dir is None:
             raise OnlRfsError("argument --dir is required")
 
+        images = OnlRfsImages(x.config.get('Image', None))
+        images.override(squash={ 'compression' : ops.squash_compression,
+                                 'block-size' : ops.squash_block_size,
+                                 'processors' : ops.squash_processors },
+                        cpio={ 'compression' : ops.cpio_compression,
+                               'processors' : ops.cpio_processors })
+
         if not ops.no_build_packages:
             pkgs = x.get_packages()
             # Invoke onlpm to build all required (local) packages.
-            onlu.execute("%s/tools/onlpm.py --try-arches %s all --skip-missing --require %s" % (os.getenv('ONL'), ops.arch, " ".join(pkgs)),
-                         ex=OnlRfsError("Failed to build all required packages."))
+            with onlu.Profiler('packages'):
+                onlu.execute("%s/tools/onlpm.py --try-arches %s all --skip-missing --require %s" % (os.getenv('ONL'), ops.arch, " ".join(pkgs)),
+                             ex=OnlRfsError("Failed to build all required packages."))
             if ops.only_build_packages:
                 sys.exit(0)
 
@@ -736,29 +1675,41 @@ if __name__ == '__main__':
             x.multistrap(ops.dir)
             sys.exit(0)
 
-        if not ops.no_multistrap and not os.getenv('NO_MULTISTRAP'):
-            x.multistrap(ops.dir)
-
-        if not ops.no_configure and not os.getenv('NO_DPKG_CONFIGURE'):
-            x.configure(ops.dir)
-
-        if ops.update:
-            x.update(ops.dir, ops.update)
-
-        if ops.install:
-            x.install(ops.dir, ops.install)
-
-        if ops.cpio:
-            if onlu.execute("%s/tools/scripts/make-cpio.sh %s %s" % (os.getenv('ONL'), ops.dir, ops.cpio)) != 0:
-                raise OnlRfsError("cpio creation failed.")
-
-        if ops.squash:
-            if os.path.exists(ops.squash):
-                os.unlink(ops.squash)
-            if onlu.execute("sudo mksquashfs %s %s -no-progress -noappend -comp gzip" % (ops.dir, ops.squash)) != 0:
-                if os.path.exists(ops.squash):
-                    os.unlink(ops.squash)
-                raise OnlRfsError("Squash creation failed.")
+        if ops.layer_cache:
+            x.build_layers(ops.dir, OnlRfsLayers(ops.layer_cache, ops.dir),
+                           multistrap=not ops.no_multistrap and not os.getenv('NO_MULTISTRAP'),
+                           configure=not ops.no_configure and not os.getenv('NO_DPKG_CONFIGURE'),
+                           update=ops.update, install=ops.install)
+        else:
+            snapshots = None
+            if ops.snapshot_cache and not ops.no_configure and not os.getenv('NO_DPKG_CONFIGURE'):
+                snapshots = OnlRfsSnapshotCache(ops.snapshot_cache, ops.snapshot_method)
+
+            if not ops.no_multistrap and not os.getenv('NO_MULTISTRAP'):
+                with onlu.Profiler('multistrap'):
+                    x.multistrap(ops.dir, snapshots)
+
+            if not ops.no_configure and not os.getenv('NO_DPKG_CONFIGURE'):
+                with onlu.Profiler('configure'):
+                    x.configure(ops.dir)
+
+            if ops.update:
+                with onlu.Profiler('update'):
+                    x.update(ops.dir, ops.update)
+
+            if ops.install:
+                with onlu.Profiler('install'):
+                    x.install(ops.dir, ops.install)
+
+        if ops.image_benchmark is not None:
+            print "%-6s %12s %8s %8s %8s" % ('comp', 'size', 'build', 'mount', 'read')
+            for r in images.benchmark(ops.dir, ops.image_benchmark):
+                fmt = lambda v: "%8.2f" % v if v is not None else "%8s" % '-'
+                print "%-6s %12s %s %s %s" % (r['compression'], r['size'] if r['size'] is not None else '-',
+                                              fmt(r['build']), fmt(r['mount']), fmt(r['read']))
+
+        if ops.cpio or ops.squash:
+            images.build(ops.dir, squash=ops.squash, cpio=ops.cpio)
 
     except (OnlRfsError, onlyaml.OnlYamlError), e:
         logger.error(e.value)
@@ -10,12 +10,40 @@ from collections import Iterable
 import sys
 import os
 import fcntl
+import threading
 import glob
 from string import Template
 import time
+import hashlib
+import json
+import stat
+import re
+import shutil
+import pwd
+import grp
+import errno
+import collections
+import Queue
+import atexit
+import importlib
 
 logger = None
 
+
+class LazyModule(object):
+    """A module which is imported when it is first used.
+
+    For modules which are expensive to import and not needed on every
+    code path, e.g. 'yaml = onlu.LazyModule("yaml")'."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+multiprocessing = LazyModule('multiprocessing')
+
 class colors(object):
 
     RED=31
@@ -65,17 +93,144 @@ def init_logging(name, lvl=logging.DEBUG):
 
 
 class Profiler(object):
+    """Timing spans.
+
+    Each Profiler block is a span. Spans nest: the parent of a span is
+    the innermost enclosing span of the same thread. The outermost spans
+    of a thread are children of the main thread's current span, and the
+    outermost spans of a process are children of the span which started
+    the process (ONL_TRACE_PARENT). Child processes inherit the trace
+    through the environment, so the spans of a whole image build form
+    a single tree.
+
+    Span records are appended to EVENTFILE (ONL_TRACE), one JSON object
+    per line. Use chrome_trace() (or 'onlu.py --chrome-trace') to view
+    them as a flame chart."""
 
     ENABLED=True
     LOGFILE=None
 
+    # Structured timing records are appended here, one JSON object per line.
+    EVENTFILE=os.environ.get('ONL_TRACE', None)
+
+    local = threading.local()
+
+    def __init__(self, name=None, **fields):
+        """name : If given, the span is recorded under this name on exit.
+        fields : Additional fields of the record."""
+        self.name = name
+        self.fields = fields
+
+    @classmethod
+    def enable(klass, fname):
+        """Record spans to the given file, in this process and its children."""
+        klass.EVENTFILE = os.environ['ONL_TRACE'] = os.path.abspath(fname)
+
+    @classmethod
+    def current(klass):
+        """The id of the innermost active span."""
+        stack = getattr(klass.local, 'stack', None)
+        if stack:
+            return stack[-1]
+        return os.environ.get('ONL_TRACE_PARENT', None)
+
+    @classmethod
+    def environ(klass):
+        """Environment for a child process spawned from this thread."""
+        if isinstance(threading.current_thread(), threading._MainThread):
+            return None
+        env = os.environ.copy()
+        if klass.current():
+            env['ONL_TRACE_PARENT'] = klass.current()
+        return env
+
     def __enter__(self):
+        self.id = os.urandom(8).encode('hex')
+        self.parent = self.current()
+        self.local.stack = getattr(self.local, 'stack', []) + [ self.id ]
+        if isinstance(threading.current_thread(), threading._MainThread):
+            os.environ['ONL_TRACE_PARENT'] = self.id
         self.start = time.time()
         return self
 
     def __exit__(self, *exc):
         self.end = time.time()
         self.duration = self.end - self.start
+        self.local.stack = self.local.stack[:-1]
+        if isinstance(threading.current_thread(), threading._MainThread):
+            if self.parent:
+                os.environ['ONL_TRACE_PARENT'] = self.parent
+            else:
+                os.environ.pop('ONL_TRACE_PARENT', None)
+        if self.name:
+            self.record(self.name, **self.fields)
+
+    def record(self, kind, **fields):
+        """Append a structured timing record for this block to EVENTFILE."""
+        if self.EVENTFILE:
+            fields.update(kind=kind, start=self.start, end=self.end,
+                          duration=self.duration, pid=os.getpid(),
+                          tid=threading.current_thread().ident,
+                          id=self.id, parent=self.parent,
+                          tool=os.path.basename(sys.argv[0]) if sys.argv else None)
+            with open(self.EVENTFILE, "a") as f:
+                f.write(json.dumps(fields) + "\n")
+
+    @staticmethod
+    def events(fname):
+        """Load the records written to an EVENTFILE."""
+        rv = []
+        with open(fname) as f:
+            for line in f:
+                try:
+                    rv.append(json.loads(line))
+                except ValueError:
+                    # Partial line from an interrupted writer.
+                    pass
+        return rv
+
+    @staticmethod
+    def chrome_trace(events):
+        """Convert span records to the Chrome trace event format.
+
+        The result can be loaded by chrome://tracing or Perfetto. Spans
+        whose parent is in another process are linked to it by a flow
+        arrow."""
+
+        COMMON = [ 'kind', 'start', 'end', 'duration', 'pid', 'tid', 'id', 'parent', 'tool' ]
+        LABELS = [ 'package', 'group', 'target', 'command', 'op', 'label' ]
+
+        spans = dict([ (e['id'], e) for e in events if 'id' in e ])
+        processes = {}
+        rv = []
+
+        for e in events:
+            args = dict([ (k, v) for (k, v) in e.iteritems() if k not in COMMON ])
+            name = e['kind']
+            for l in LABELS:
+                if e.get(l):
+                    v = e[l] if isinstance(e[l], basestring) else " ".join(map(str, e[l]))
+                    name = "%s %s" % (name, v[:80])
+                    break
+            tid = e.get('tid') or 0
+            rv.append(dict(name=name, cat=e['kind'], ph='X', pid=e['pid'], tid=tid,
+                           ts=int(e['start'] * 1e6), dur=int(e['duration'] * 1e6),
+                           args=args))
+            processes[e['pid']] = e.get('tool') or processes.get(e['pid'])
+
+            parent = spans.get(e.get('parent'))
+            if parent and parent['pid'] != e['pid']:
+                rv.append(dict(name='spawn', cat='spawn', ph='s', id=e['id'],
+                               pid=parent['pid'], tid=parent.get('tid') or 0,
+                               ts=int(e['start'] * 1e6)))
+                rv.append(dict(name='spawn', cat='spawn', ph='f', bp='e', id=e['id'],
+                               pid=e['pid'], tid=tid, ts=int(e['start'] * 1e6)))
+
+        for (pid, tool) in processes.iteritems():
+            rv.append(dict(name='process_name', ph='M', pid=pid,
+                           args=dict(name="%s (%d)" % (tool, pid))))
+
+        return dict(traceEvents=rv, displayTimeUnit='ms')
 
     def log(self, operation, prefix=''):
         msg = "[profiler] %s%s : %s seconds (%s minutes)" % (prefix, operation, self.duration, self.duration / 60.0)
@@ -89,14 +244,15 @@ class Profiler(object):
 #
 # Log and execute system commands
 #
-def execute(args, sudo=False, chroot=None, ex=None):
+# When Profiler.EVENTFILE is set every command is traced:
+# its exit code and the tail of its stdout and stderr are
+# recorded along with its timing.
+#
 
-    if type(args) is str:
-        # Must be executed through the shell
-        shell=True
-    else:
-        shell = False
+# Bytes of each output stream kept in the trace
+TRACE_OUTPUT_MAX=16*1024
 
+def _command(args, sudo, chroot):
     if chroot and os.geteuid() != 0:
         # Must be executed under sudo
         sudo = True
@@ -113,22 +269,202 @@ def execute(args, sudo=False, chroot=None, ex=None):
         elif type(args) in (list, tuple):
             args = [ 'sudo' ] + list(args)
 
+    return args
+
+
+def _drain(src, dst, keep, limit):
+    """Copy a pipe to dst (if given), keeping at most limit trailing bytes."""
+    size = 0
+    while True:
+        data = os.read(src.fileno(), 65536)
+        if not data:
+            break
+        if dst:
+            dst.write(data)
+            dst.flush()
+        keep.append(data)
+        size += len(data)
+        while limit and size - len(keep[0]) >= limit:
+            size -= len(keep.popleft())
+    src.close()
+
+
+def _run(args, shell, passthrough=True, limit=TRACE_OUTPUT_MAX):
+    """Run a command, collecting its output. Returns (rc, stdout, stderr).
+
+    passthrough : Also copy the output to our stdout and stderr as it
+                  is produced. Otherwise all of the output is kept."""
+
+    p = subprocess.Popen(args, shell=shell, close_fds=True, env=Profiler.environ(),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = collections.deque()
+    err = collections.deque()
+    threads = [ threading.Thread(target=_drain, args=(p.stdout, sys.stdout if passthrough else None, out, limit if passthrough else 0)),
+                threading.Thread(target=_drain, args=(p.stderr, sys.stderr if passthrough else None, err, limit if passthrough else 0)) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (p.wait(), "".join(out), "".join(err))
+
+
+def execute(args, sudo=False, chroot=None, ex=None, passthrough=True):
+
+    if type(args) is str:
+        # Must be executed through the shell
+        shell=True
+    else:
+        shell = False
+
+    args = _command(args, sudo, chroot)
 
     logger.debug("Executing:%s", args)
 
-    rv = 0
+    out = err = None
     with Profiler() as profiler:
-        try:
-            subprocess.check_call(args, shell=shell)
-            rv = 0
-        except subprocess.CalledProcessError, e:
-            if ex:
-                raise ex
-            rv = e.returncode
+        if Profiler.EVENTFILE or not passthrough:
+            (rv, out, err) = _run(args, shell, passthrough)
+        else:
+            rv = subprocess.call(args, shell=shell, env=Profiler.environ())
     profiler.log(args)
+    profiler.record('exec', command=args, rc=rv,
+                    stdout=out[-TRACE_OUTPUT_MAX:] if out else out,
+                    stderr=err[-TRACE_OUTPUT_MAX:] if err else err)
+
+    if not passthrough:
+        with _output_lock:
+            sys.stdout.write(out)
+            sys.stdout.flush()
+            sys.stderr.write(err)
+            sys.stderr.flush()
+
+    if rv != 0 and ex:
+        raise ex
+    return rv
+
+_output_lock = threading.Lock()
+
+
+def execute_parallel(commands, jobs=None, ex=None):
+    """Execute independent commands concurrently.
+
+    commands : A list of execute() argument dicts, or of plain args.
+    jobs     : The maximum number of concurrent commands
+               (default: the number of cpus).
+    ex       : Raised if any command fails.
+
+    The output of each command is written when it completes, so
+    outputs are not interleaved. All commands are run to completion
+    before any exception is raised. Returns the list of return codes."""
+
+    work = Queue.Queue()
+    for (i, c) in enumerate(commands):
+        if type(c) is not dict:
+            c = dict(args=c)
+        work.put((i, c))
+
+    rv = [ None ] * len(commands)
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                (i, c) = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                rv[i] = execute(passthrough=False, **c)
+            except Exception, e:
+                errors.append(e)
+
+    threads = [ threading.Thread(target=worker)
+                for _ in range(min(jobs or multiprocessing.cpu_count(), len(commands))) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    if ex and [ r for r in rv if r != 0 ]:
+        raise ex
     return rv
 
 
+def trace_process(name=None):
+    """Record the run of this process, until it exits, as one span."""
+    span = Profiler(name or os.path.basename(sys.argv[0]), command=sys.argv[1:])
+    span.__enter__()
+    atexit.register(span.__exit__)
+    return span
+
+
+############################################################
+#
+# File content hashing
+#
+def file_hash(path, blocksize=1024*1024):
+    """Return the SHA1 hex digest of the given file's contents."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def file_fingerprint(path):
+    """Return an (mtime, size, sha1) tuple for the given file."""
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size, file_hash(path))
+
+def path_hash(path, h=None):
+    """Return the SHA1 hex digest of a file or of an entire directory tree.
+
+    Directory hashes cover the relative names, modes, symlink targets
+    and contents of every entry in sorted order."""
+    if h is None:
+        h = hashlib.sha1()
+
+    def entry(p, rel):
+        st = os.lstat(p)
+        h.update("%s\0%o\0" % (rel, st.st_mode))
+        if os.path.islink(p):
+            h.update(os.readlink(p))
+        elif os.path.isfile(p):
+            h.update(file_hash(p))
+        h.update("\0")
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files + [ d for d in dirs if os.path.islink(os.path.join(root, d)) ]):
+                p = os.path.join(root, f)
+                entry(p, os.path.relpath(p, path))
+    else:
+        entry(path, os.path.basename(path))
+
+    return h.hexdigest()
+
+def fingerprint_refresh(path, fingerprint):
+    """Revalidate a fingerprint returned by file_fingerprint().
+
+    The file is only hashed when its mtime or size differ from the
+    recorded values. Returns the up-to-date fingerprint if the contents
+    are unchanged, or None if they changed or the file is gone."""
+    (mtime, size, digest) = fingerprint
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if st.st_mtime == mtime and st.st_size == size:
+        return fingerprint
+    if st.st_size != size or file_hash(path) != digest:
+        return None
+    return (st.st_mtime, size, digest)
+
+
 # Flatten lists if string lists
 def sflatten(coll):
     for i in coll:
@@ -192,19 +528,32 @@ def useradd(username, uid, password, shell, deleteFirst=True):
 
 
 class Lock(object):
-    """File Locking class."""
+    """File Locking class.
+
+    shared : If True the lock is taken shared (for readers) rather
+             than exclusive (for writers). Shared and exclusive Lock
+             objects may refer to the same file.
+
+    Every acquisition uses its own file handle, so the lock also
+    excludes other threads of the same process. Acquisitions of an
+    exclusive lock must not be nested."""
 
-    def __init__(self, filename):
+    def __init__(self, filename, shared=False):
         self.filename = filename
-        self.handle = open(filename, 'w')
+        self.shared = shared
+        self.local = threading.local()
 
     def take(self):
-        logger.debug("taking lock %s" % self.filename)
-        fcntl.flock(self.handle, fcntl.LOCK_EX)
+        logger.debug("taking %s lock %s" % ("shared" if self.shared else "exclusive", self.filename))
+        handle = open(self.filename, 'a')
+        fcntl.flock(handle, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        self.local.handles = getattr(self.local, 'handles', []) + [ handle ]
         logger.debug("took lock %s" % self.filename)
 
     def give(self):
-        fcntl.flock(self.handle, fcntl.LOCK_UN)
+        handle = self.local.handles.pop()
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
         logger.debug("released lock %s" % self.filename)
 
     def __enter__(self):
@@ -213,8 +562,14 @@ class Lock(object):
     def __exit__(self ,type, value, traceback):
         self.give()
 
-    def __del__(self):
-        self.handle.close()
+
+class NoLock(object):
+    """Placeholder for an optional Lock."""
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        pass
 
 
 def filepath(absdir, relpath, eklass, required=True):
@@ -269,3 +624,255 @@ def validate_src_dst_file_tuples(absdir, data, dstsubs, eklass, required=True):
         elif required:
             raise eklass("Source file or directory '%s' does not exist." % src)
     return flist
+
+
+############################################################
+#
+# Privileged file operations
+#
+# Changing files in a root filesystem needs root privileges.
+# Rather than spawning a sudo process for each chmod, mkdir or
+# touch, FileOps sends each operation to a single helper process
+# running under sudo. The helper is this module run as a script.
+#
+
+def chmod_mode(spec, mode):
+    """Apply a chmod(1) mode specification to a file mode.
+
+    Supports octal modes and comma separated [ugoa]*[-+=][rwxXst]*
+    clauses. Raises ValueError for anything else."""
+
+    if re.match(r'^[0-7]+$', spec):
+        return int(spec, 8)
+
+    BITS = { 'u' : dict(r=0400, w=0200, x=0100, s=04000, t=0),
+             'g' : dict(r=040, w=020, x=010, s=02000, t=0),
+             'o' : dict(r=04, w=02, x=01, s=0, t=01000) }
+
+    rv = stat.S_IMODE(mode)
+    for clause in spec.split(','):
+        m = re.match(r'^([ugoa]*)([-+=])([rwxXst]*)$', clause)
+        if not m:
+            raise ValueError("Unsupported mode '%s'" % spec)
+        (who, op, perms) = m.groups()
+
+        umask = 0
+        if not who:
+            umask = os.umask(0)
+            os.umask(umask)
+            who = 'a'
+        if 'a' in who:
+            who = 'ugo'
+
+        bits = 0
+        for w in who:
+            for p in perms:
+                if p == 'X':
+                    if stat.S_ISDIR(mode) or (rv & 0111):
+                        bits |= BITS[w]['x']
+                else:
+                    bits |= BITS[w][p]
+        bits &= ~umask
+
+        if op == '+':
+            rv |= bits
+        elif op == '-':
+            rv &= ~bits
+        else:
+            clear = 0
+            for w in who:
+                clear |= reduce(lambda a, b: a | b, BITS[w].values())
+            rv = (rv & ~clear) | bits
+
+    return rv
+
+
+class FileOps(object):
+    """Privileged file operations through one helper process.
+
+    The helper process runs under sudo and is started on first use, so
+    a sequence of operations costs a single sudo invocation. When we
+    are already root the operations are applied in-process.
+
+    Each operation returns 0 on success. On failure it raises 'ex' if
+    given, otherwise the error is logged and 1 is returned, as with
+    execute()."""
+
+    def __init__(self, sudo=None):
+        if sudo is None:
+            sudo = os.geteuid() != 0
+        self.sudo = sudo
+        self.helper = None
+        self.lock = threading.Lock()
+
+    def close(self):
+        if self.helper:
+            self.helper.stdin.close()
+            self.helper.wait()
+            self.helper = None
+
+    #
+    # Operations. All paths are host paths.
+    #
+    def mkdir(self, path, mode=None, ex=None):
+        """mkdir -p"""
+        return self.__op(ex, 'mkdir', path, mode)
+
+    def touch(self, path, ex=None):
+        return self.__op(ex, 'touch', path)
+
+    def chmod(self, mode, path, ex=None):
+        return self.__op(ex, 'chmod', mode, path)
+
+    def chown(self, path, ownspec, ex=None):
+        return self.__op(ex, 'chown', path, ownspec)
+
+    def remove(self, path, ex=None):
+        """rm -rf"""
+        return self.__op(ex, 'remove', path)
+
+    def write(self, path, data, mode=None, append=False, ex=None):
+        return self.__op(ex, 'write', path, data, mode, append)
+
+    def copy(self, src, dst, ex=None):
+        """cp --remove-destination"""
+        return self.__op(ex, 'copy', src, dst)
+
+    def rename(self, src, dst, ex=None):
+        return self.__op(ex, 'rename', src, dst)
+
+    def batch(self, ops, ex=None):
+        """Apply a list of operations, in order, as a single request.
+
+        Each operation is a list of the operation name and its arguments,
+        e.g. [ 'chmod', 'a-w', path ]. Stops at the first failure."""
+        return self.__op(ex, 'batch', [ list(op) for op in ops ])
+
+    def __op(self, ex, *op):
+        with Profiler() as profiler:
+            with self.lock:
+                if self.sudo:
+                    error = self.__send(op)
+                else:
+                    error = self.apply(op)
+        profiler.record('fileop', op=op[0], args=[ a for a in op[1:] if type(a) is not str or len(a) < 256 ], error=error)
+
+        if error:
+            if ex:
+                raise ex
+            logger.error("%s: %s" % (" ".join([ str(a) for a in op[:3] if type(a) is not list ]), error))
+            return 1
+        return 0
+
+    def __send(self, op):
+        if self.helper is None:
+            logger.debug("Starting file operation helper")
+            self.helper = subprocess.Popen([ 'sudo', sys.executable, os.path.abspath(__file__).replace('.pyc', '.py'), '--fileops' ],
+                                           stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        self.helper.stdin.write(json.dumps(op) + "\n")
+        self.helper.stdin.flush()
+        reply = self.helper.stdout.readline()
+        if not reply:
+            self.helper.wait()
+            self.helper = None
+            return "file operation helper exited"
+        return json.loads(reply)
+
+    @staticmethod
+    def apply(op):
+        """Apply one operation in this process. Returns None or an error message."""
+        (name, args) = (op[0], op[1:])
+        try:
+            if name == 'mkdir':
+                (path, mode) = args
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                if mode is not None:
+                    os.chmod(path, chmod_mode(mode, os.stat(path).st_mode))
+            elif name == 'touch':
+                (path,) = args
+                with open(path, 'a'):
+                    os.utime(path, None)
+            elif name == 'chmod':
+                (mode, path) = args
+                try:
+                    os.chmod(path, chmod_mode(mode, os.stat(path).st_mode))
+                except ValueError:
+                    subprocess.check_call([ 'chmod', mode, path ])
+            elif name == 'chown':
+                (path, ownspec) = args
+                # As chown(1), '.' separates the group only without a ':'.
+                (user, _, group) = ownspec.partition(':' if ':' in ownspec else '.')
+                uid = -1 if not user else int(user) if user.isdigit() else pwd.getpwnam(user).pw_uid
+                gid = -1 if not group else int(group) if group.isdigit() else grp.getgrnam(group).gr_gid
+                os.chown(path, uid, gid)
+            elif name == 'remove':
+                (path,) = args
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                elif os.path.lexists(path):
+                    os.unlink(path)
+            elif name == 'write':
+                (path, data, mode, append) = args
+                with open(path, 'a' if append else 'w') as f:
+                    f.write(data.encode('utf-8') if type(data) is unicode else data)
+                if mode is not None:
+                    os.chmod(path, chmod_mode(mode, os.stat(path).st_mode))
+            elif name == 'copy':
+                (src, dst) = args
+                if os.path.isdir(dst):
+                    dst = os.path.join(dst, os.path.basename(src))
+                if os.path.lexists(dst):
+                    os.unlink(dst)
+                shutil.copy(src, dst)
+            elif name == 'rename':
+                (src, dst) = args
+                os.rename(src, dst)
+            elif name == 'batch':
+                (ops,) = args
+                for o in ops:
+                    error = FileOps.apply(o)
+                    if error:
+                        return "%s %s: %s" % (o[0], o[1] if len(o) > 1 else '', error)
+            else:
+                return "unknown operation '%s'" % name
+        except (OSError, IOError, KeyError, ValueError, subprocess.CalledProcessError), e:
+            return str(e)
+        return None
+
+    @staticmethod
+    def serve(input_, output):
+        """Helper process main loop."""
+        def decode(a):
+            if type(a) is unicode:
+                return a.encode('utf-8')
+            if type(a) is list:
+                return [ decode(e) for e in a ]
+            return a
+        for line in iter(input_.readline, ''):
+            op = decode(json.loads(line))
+            output.write(json.dumps(FileOps.apply(op)) + "\n")
+            output.flush()
+
+
+_fileops = None
+
+def fileops():
+    """Return the shared FileOps instance."""
+    global _fileops
+    if _fileops is None:
+        _fileops = FileOps()
+    return _fileops
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == [ '--fileops' ]:
+        FileOps.serve(sys.stdin, sys.stdout)
+    elif sys.argv[1:2] == [ '--chrome-trace' ] and len(sys.argv) in [ 3, 4 ]:
+        trace = Profiler.chrome_trace(Profiler.events(sys.argv[2]))
+        with (open(sys.argv[3], "w") if len(sys.argv) == 4 else sys.stdout) as f:
+            json.dump(trace, f)
+    else:
+        sys.stderr.write("usage: %s --fileops\n" % sys.argv[0])
+        sys.stderr.write("       %s --chrome-trace EVENTFILE [OUTPUT]\n" % sys.argv[0])
+        sys.exit(1)
@@ -8,8 +8,13 @@
 ############################################################
 import yaml
 import os
+import copy
 import pprint
 import tempfile
+import subprocess
+import hashlib
+import json
+import time
 from string import Template
 
 class OnlYamlError(Exception):
@@ -33,105 +38,432 @@ def dflatten(rv, in_):
         raise OnlYamlError("Element type '%s' cannot be added to the given dictionary." % (type(in_)))
 
 
-def loadf(fname, vard={}):
+# Use the C parser when it is available.
+_Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_resolver = yaml.resolver.Resolver()
 
-    # Apply variable interpolation:
-    def interpolate(s, d):
+# Parsed files, by path: (stamp, node, include options)
+_nodes = {}
 
-        error_string = "Yaml variable substitution error: '%s' could not be resolved."
+# Loaded include files, by (path, stamp, variables): (data, deps)
+_includes = {}
 
-        try:
-            template = Template(s)
-            s = template.substitute(d)
-        except KeyError as e:
-            raise OnlYamlError(error_string % (e.args[0]))
-        except:
-            raise
+# !script results, by (cwd, command line, environment): dict(stamps, time, output)
+_scripts = {}
 
-        return s
+# If set, !script results are also kept in this directory across runs.
+SCRIPT_CACHE = os.environ.get('ONLYAML_SCRIPT_CACHE', None)
 
-    variables = {}
+# !script results are reused for at most this many seconds.
+SCRIPT_TTL = int(os.environ.get('ONLYAML_SCRIPT_TTL', 3600))
 
-    # Files can reference environment variables
-    variables.update(os.environ)
+# Environment variables which do not change the output of a !script.
+SCRIPT_ENV_IGNORE = [ '_', 'PWD', 'OLDPWD', 'SHLVL', 'TERM', 'COLUMNS', 'LINES',
+                      'MAKEFLAGS', 'MFLAGS', 'MAKELEVEL', 'MAKEOVERRIDES',
+                      'MAKE_TERMOUT', 'MAKE_TERMERR', 'ONL_TRACE', 'ONL_TRACE_PARENT' ]
 
-    # Files can reference their own directory.
-    variables['__DIR__'] = os.path.dirname(os.path.abspath(fname))
 
-    # Files can reference invokation parameters.
-    variables.update(vard)
+class _Variables(dict):
+    """Interpolation variables.
 
-    # Yaml Include constructor. Allows variables.
-    def onlyaml_include(loader, node):
-        # Get the path out of the yaml file
-        directive = node.value
-        fields = directive.split()
-        fname = fields[0]
-        options = fields[1:]
-
-        for opt in options:
-            try:
-                (k,v) = opt.split('=')
-            except ValueError:
-                raise OnlYamlError("Bad include directive: %s" % opt)
-            variables[k] = v;
-
-        fname = interpolate(fname, variables)
-
-        if not os.path.isabs(fname):
-            fname = os.path.join(os.path.dirname(loader.name), fname)
-
-        if not os.path.exists(fname):
-            raise OnlYamlError("Include file '%s' (from %s) does not exist." % (fname, loader.name))
-
-        return loadf(fname, variables)
-
-    # Yaml dynamic constructor. Allow dynamically generated yaml.
-    def onlyaml_script(loader, node):
-        directive = interpolate(node.value, variables)
-        tf = tempfile.NamedTemporaryFile()
-        tf.close()
-        if os.system("%s > %s" % (directive, tf.name)) != 0:
-            raise OnlYamlError("Script execution '%s' failed." % directive)
-        return loadf(tf.name, variables)
+    Files can reference environment variables, which are looked up
+    only when they are not defined by the file or its invokation."""
+    def __missing__(self, key):
+        return os.environ[key]
+
+
+def interpolate(s, d):
+    """Apply variable interpolation."""
 
+    error_string = "Yaml variable substitution error: '%s' could not be resolved."
+
+    try:
+        template = Template(s)
+        s = template.substitute(d)
+    except KeyError as e:
+        raise OnlYamlError(error_string % (e.args[0]))
+    except:
+        raise
+
+    return s
+
+
+def _stamp(fname):
+    st = os.stat(fname)
+    return (st.st_mtime, st.st_size)
 
-    yaml.add_constructor("!include", onlyaml_include)
-    yaml.add_constructor("!script", onlyaml_script)
 
-    # First load: grab the variables dict
-    string = open(fname).read()
+def _compose(stream, fname):
     try:
-        data = yaml.load(string)
+        return yaml.compose(stream, Loader=_Loader)
     except Exception, e:
         raise OnlYamlError("%s\n(filename: %s)" % (e, fname))
 
-    if type(data) is dict:
-        _v = dflatten({}, data.get('variables', {}))
-        variables.update(_v)
 
-        for (k,v) in _v.iteritems():
-            k = interpolate(k, variables)
-            v = interpolate(v, variables)
-            variables[k] = v
+def _include_options(node, rv, seen):
+    """Collect the variable assignments of all !include directives in a node tree."""
+    if id(node) in seen:
+        return rv
+    seen.add(id(node))
+    if isinstance(node, yaml.ScalarNode):
+        if node.tag == '!include':
+            for opt in node.value.split()[1:]:
+                try:
+                    (k,v) = opt.split('=')
+                except ValueError:
+                    raise OnlYamlError("Bad include directive: %s" % opt)
+                rv.append((k,v))
+    elif isinstance(node, yaml.SequenceNode):
+        for n in node.value:
+            _include_options(n, rv, seen)
+    elif isinstance(node, yaml.MappingNode):
+        for (k,v) in node.value:
+            _include_options(k, rv, seen)
+            _include_options(v, rv, seen)
+    return rv
+
+
+def _parse(fname):
+    """Parse a file into a node tree, reusing the last parse if the file is unchanged."""
+    stamp = _stamp(fname)
+    entry = _nodes.get(fname)
+    if entry is None or entry[0] != stamp:
+        with open(fname) as f:
+            node = _compose(f, fname)
+        entry = (stamp, node, _include_options(node, [], set()))
+        _nodes[fname] = entry
+    return entry[1:]
+
+
+def _reparse(node, value, flow):
+    """Substitute the value of a plain scalar.
+
+    Substitution used to be applied to the raw file text, so a
+    variable may expand to quoted strings, flow collections or several
+    comma separated flow items. Values which may do so are parsed
+    again as YAML. Returns a list of nodes."""
+
+    value = value.strip()
+    if flow and ',' in value:
+        return _compose("[ %s ]" % value, value).value
+
+    if (value[:1] in '\'"[{!&*|>%@`#' or value[:2] in ('- ', '? ') or
+        ': ' in value or ' #' in value or '\n' in value or value.endswith(':')):
+        n = _compose(value, value)
+        return [ n if n is not None else yaml.ScalarNode(u'tag:yaml.org,2002:null', u'') ]
+
+    tag = _resolver.resolve(yaml.ScalarNode, value, (True, False))
+    return [ yaml.ScalarNode(tag, value, node.start_mark, node.end_mark, node.style) ]
+
+
+def _substitute(node, variables, memo, flow=False):
+    """Interpolate all scalars in a node tree. Returns a list of nodes.
+
+    The given tree is not modified; changed nodes are copied."""
+
+    if id(node) in memo:
+        return [ memo[id(node)] ]
+
+    if isinstance(node, yaml.ScalarNode):
+        value = interpolate(node.value, variables)
+        if value == node.value:
+            return [ node ]
+        if not node.style and node.tag.startswith('tag:yaml.org,2002:'):
+            return _reparse(node, value, flow)
+        return [ yaml.ScalarNode(node.tag, value, node.start_mark, node.end_mark, node.style) ]
+
+    if isinstance(node, yaml.SequenceNode):
+        rv = yaml.SequenceNode(node.tag, [], node.start_mark, node.end_mark, node.flow_style)
+        memo[id(node)] = rv
+        for n in node.value:
+            rv.value.extend(_substitute(n, variables, memo, node.flow_style))
+        return [ rv ]
+
+    if isinstance(node, yaml.MappingNode):
+        rv = yaml.MappingNode(node.tag, [], node.start_mark, node.end_mark, node.flow_style)
+        memo[id(node)] = rv
+        for (k,v) in node.value:
+            k = _substitute(k, variables, memo)
+            v = _substitute(v, variables, memo)
+            if len(k) != 1 or len(v) != 1:
+                raise OnlYamlError("Interpolation produced invalid results:\n%s\n" % node.start_mark)
+            rv.value.append((k[0], v[0]))
+        return [ rv ]
+
+    return [ node ]
+
+
+class OnlYamlLoader(_Loader):
+    """Node constructor for onlyaml files.
+
+    Each file is constructed with its own instance, which carries the
+    interpolation variables and dependency list for that file."""
+
+    def __init__(self, fname, variables, deps):
+        _Loader.__init__(self, "")
+        self.name = fname
+        self.variables = variables
+        self.deps = deps
+
+
+# Yaml Include constructor. Allows variables.
+def onlyaml_include(loader, node):
+    # Get the path out of the yaml file
+    directive = node.value
+    fields = directive.split()
+    fname = fields[0]
+    options = fields[1:]
+
+    variables = loader.variables
+    for opt in options:
+        try:
+            (k,v) = opt.split('=')
+        except ValueError:
+            raise OnlYamlError("Bad include directive: %s" % opt)
+        variables[k] = v;
+
+    fname = interpolate(fname, variables)
+
+    if not os.path.isabs(fname):
+        fname = os.path.join(os.path.dirname(loader.name), fname)
+
+    if not os.path.exists(fname):
+        raise OnlYamlError("Include file '%s' (from %s) does not exist." % (fname, loader.name))
+
+    try:
+        key = (os.path.abspath(fname), _stamp(fname), frozenset(variables.iteritems()))
+        hash(key)
+    except TypeError:
+        key = None
+
+    if key not in _includes:
+        deps = []
+        data = loadf(fname, variables, deps)
+        if key is None:
+            return data
+        _includes[key] = (data, deps)
+
+    (data, deps) = _includes[key]
+    if loader.deps is not None:
+        loader.deps.extend(deps)
+    return copy.deepcopy(data)
+
+
+def _script_stamps(directive, cwd):
+    """Stamp every existing file named on a command line."""
+    rv = []
+    for f in directive.split():
+        f = os.path.join(cwd, f)
+        if os.path.exists(f):
+            f = os.path.abspath(f)
+            rv.append([ f ] + list(_stamp(f)))
+    return rv
+
+
+def _script_key(cwd, directive):
+    env = sorted((k, v) for (k, v) in os.environ.iteritems() if k not in SCRIPT_ENV_IGNORE)
+    return (cwd, directive, hashlib.sha1(repr(env)).hexdigest())
+
+
+def _script_cachefile(key):
+    return os.path.join(SCRIPT_CACHE, hashlib.sha1(json.dumps(key)).hexdigest())
+
+
+def script_invalidate(directive=None, persistent=True):
+    """Discard cached !script results.
+
+    'directive'  : The interpolated command line to discard, as run
+                   from the current directory. All results are
+                   discarded if it is not given.
+    'persistent' : Also discard results kept across runs."""
+
+    if directive is None:
+        _scripts.clear()
+        if persistent and SCRIPT_CACHE and os.path.isdir(SCRIPT_CACHE):
+            for f in os.listdir(SCRIPT_CACHE):
+                os.unlink(os.path.join(SCRIPT_CACHE, f))
+    else:
+        key = _script_key(os.getcwd(), directive)
+        _scripts.pop(key, None)
+        if persistent and SCRIPT_CACHE and os.path.exists(_script_cachefile(key)):
+            os.unlink(_script_cachefile(key))
+
+
+def _script_cached(key, stamps):
+    entry = _scripts.get(key)
+    if entry is None and SCRIPT_CACHE:
+        try:
+            with open(_script_cachefile(key)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            entry = None
+        if entry is not None and entry.get('key') != list(key):
+            entry = None
+    if entry is None or entry['stamps'] != stamps or time.time() - entry['time'] > SCRIPT_TTL:
+        return None
+    _scripts[key] = entry
+    return entry['output']
+
+
+def _script_store(key, stamps, output):
+    entry = dict(key=list(key), stamps=stamps, time=time.time(), output=output)
+    _scripts[key] = entry
+    if SCRIPT_CACHE:
+        if not os.path.isdir(SCRIPT_CACHE):
+            os.makedirs(SCRIPT_CACHE)
+        (fd, tmp) = tempfile.mkstemp(dir=SCRIPT_CACHE, prefix='.tmp')
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.rename(tmp, _script_cachefile(key))
+
+
+def _digest(output):
+    if isinstance(output, unicode):
+        # Read back from the JSON script cache.
+        output = output.encode('utf-8')
+    return hashlib.sha1(output).hexdigest()
+
+
+def script_digest(directive, cwd, cached=True):
+    """Return the SHA1 of the output of a !script command line.
+
+    'cwd'    : The directory the command is run from.
+    'cached' : Use the cached result while it is still valid.
+
+    Returns None if the command fails."""
+
+    key = _script_key(cwd, directive)
+    stamps = _script_stamps(directive, cwd)
+    output = _script_cached(key, stamps) if cached and SCRIPT_TTL > 0 else None
+    if output is None:
+        try:
+            p = subprocess.Popen(directive, shell=True, stdout=subprocess.PIPE, cwd=cwd)
+        except OSError:
+            return None
+        output = p.communicate()[0]
+        if p.returncode != 0:
+            return None
+        if SCRIPT_TTL > 0:
+            _script_store(key, stamps, output)
+    return _digest(output)
+
+
+class _TeeReader(object):
+    """Keep a copy of everything read from a stream."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.data = []
+
+    def read(self, size=-1):
+        s = self.stream.read(size)
+        self.data.append(s)
+        return s
+
+    def getvalue(self):
+        return "".join(self.data)
+
+
+# Yaml dynamic constructor. Allow dynamically generated yaml.
+def onlyaml_script(loader, node):
+    directive = interpolate(node.value, loader.variables)
+
+    #
+    # Results are reused while the environment and the files named on
+    # the command line are unchanged and the result is younger than
+    # SCRIPT_TTL.
+    #
+    key = _script_key(os.getcwd(), directive)
+    stamps = _script_stamps(directive, key[0])
+    output = _script_cached(key, stamps) if SCRIPT_TTL > 0 else None
+
+    if output is not None:
+        node = _compose(output, directive)
+    else:
+        # Parse the output as the script produces it.
+        p = subprocess.Popen(directive, shell=True, stdout=subprocess.PIPE)
+        stream = _TeeReader(p.stdout)
+        try:
+            node = _compose(stream, directive)
+        except OnlYamlError:
+            node = None
+        stream.read()
+        if p.wait() != 0:
+            raise OnlYamlError("Script execution '%s' failed." % directive)
+        output = stream.getvalue()
+        if node is None:
+            node = _compose(output, directive)
+        if SCRIPT_TTL > 0:
+            _script_store(key, stamps, output)
+
+    if loader.deps is not None:
+        loader.deps.append(key[:2] + (_digest(output),))
+
+    return _load(node, _include_options(node, [], set()), directive, loader.variables, None)
+
+
+OnlYamlLoader.add_constructor("!include", onlyaml_include)
+OnlYamlLoader.add_constructor("!script", onlyaml_script)
+
 
+def _load(node, options, fname, vard, deps):
+
+    variables = _Variables()
+
+    # Files can reference their own directory.
+    variables['__DIR__'] = os.path.dirname(os.path.abspath(fname))
+
+    # Files can reference invokation parameters.
+    variables.update(vard)
+
+    # Files can reference the options of their include directives.
+    variables.update(options)
+
+    if node is None:
+        return None
+
+    # Grab the variables dict
+    if isinstance(node, yaml.MappingNode):
+        for (k,v) in node.value:
+            if k.value == 'variables':
+                _v = OnlYamlLoader(fname, variables, None).construct_document(v)
+                _v = dflatten({}, _v or {})
+                variables.update(_v)
+
+                for (k,v) in _v.iteritems():
+                    k = interpolate(k, variables)
+                    v = interpolate(v, variables)
+                    variables[k] = v
 
     ############################################################
     #
     # Interpolate the entire package contents using the
-    # generated variables dict and reload it.
+    # generated variables dict and construct it.
     #
     ############################################################
-    string = interpolate(string, variables)
+    (node,) = _substitute(node, variables, {})
 
     try:
-        data = yaml.load(string)
+        return OnlYamlLoader(fname, variables, deps).construct_document(node)
     except OnlYamlError, e:
         raise e
     except Exception, e:
-        raise OnlYamlError("Interpolation produced invalid results:\n%s\n" %  string)
+        raise OnlYamlError("%s\n(filename: %s)" % (e, fname))
+
+
+def loadf(fname, vard={}, deps=None):
+    """Load an onlyaml file.
 
-    return data
+    'vard' : Additional interpolation variables.
+    'deps' : If given, a list to which the absolute path of this file
+             and of every file it includes will be appended, as well
+             as a (cwd, command line, output SHA1) tuple for every
+             !script (see script_digest())."""
+
+    if deps is not None:
+        deps.append(os.path.abspath(fname))
+
+    (node, options) = _parse(fname)
+    return _load(node, options, fname, vard, deps)
 
 
 if __name__ == '__main__':
@@ -143,5 +475,3 @@ if __name__ == '__main__':
             sys.stderr.write("usage: %s <yamlfile>\n" % sys.argv[0])
     except OnlYamlError, e:
         sys.stderr.write("error: %s\n" % e.value)
-
-
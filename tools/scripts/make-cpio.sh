@@ -6,7 +6,7 @@ if [ "${UID}" != 0 ]; then
 fi
 
 if [ -z "$1" ] || [ -z "$2" ]; then
-    echo "usage: $0 src-dir dst-cpio-gz-file"
+    echo "usage: $0 src-dir dst-cpio-gz-file [compressor]"
     exit 1
 fi
 
@@ -22,4 +22,7 @@ if [ -e "$DSTCPIOGZ" ]; then
     echo "Removing existing $DSTCPIOGZ"
 fi
 
-cd "$SRCDIR" && find . | cpio -H newc -o | gzip -f > "$DSTCPIOGZ"
+# The compressor reads the archive from stdin and writes stdout.
+COMPRESS="${3:-gzip -f}"
+
+cd "$SRCDIR" && find . | cpio -H newc -o | $COMPRESS > "$DSTCPIOGZ"